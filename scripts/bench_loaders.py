@@ -0,0 +1,105 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import db
+import get_regressions
+import get_stocks
+
+connPool = db.get_db_connection_pool()
+
+# the queries of the loaders before db.load_frame: the decimal columns come back as Decimal
+# objects converted to float by the code using them
+READ_SQL_QUERIES = {
+    'ff_factor': ('''SELECT date as "Date", mkt_rf as "Mkt-RF", smb as "SMB", hml as "HML", wml as "WML"
+        FROM ff_factor WHERE frequency = %(frequency)s ORDER BY date''', 'Date'),
+    'risk_free': ('''SELECT date as "Date", rf as "Rf"
+        FROM risk_free WHERE frequency = %(frequency)s ORDER BY date''', 'Date'),
+    'carbon_risk_factor': ('''SELECT date as "Date", bmg as "BMG"
+        FROM carbon_risk_factor WHERE factor_name = %(factor_name)s and frequency = %(frequency)s ORDER BY date''', 'Date'),
+    'stock_data': ('''SELECT date, close, return
+        FROM stock_data WHERE ticker = %(ticker)s and frequency = %(frequency)s ORDER BY date''', 'date'),
+    'all_stock_data': ('''SELECT * FROM stock_data WHERE frequency = %(frequency)s ORDER BY ticker, date''', 'date'),
+}
+
+
+def read_sql_query(name, params):
+    (sql, index_col) = READ_SQL_QUERIES[name]
+    with connPool.connection() as conn:
+        df = pd.read_sql_query(sql, con=conn, index_col=index_col, params=params)
+    for c in df.columns:
+        if c not in ('ticker', 'frequency'):
+            df[c] = df[c].astype(float)
+    return df
+
+
+def load_frame(name, params):
+    frequency = params['frequency']
+    if name == 'ff_factor':
+        return get_regressions.load_ff_data_from_db(frequency=frequency)
+    if name == 'risk_free':
+        return get_regressions.load_rf_data_from_db(frequency=frequency)
+    if name == 'carbon_risk_factor':
+        return get_regressions.load_carbon_data_from_db(params['factor_name'], frequency=frequency)
+    if name == 'stock_data':
+        return get_stocks.load_stocks_data_with_returns_from_db(params['ticker'], frequency=frequency)
+    return get_stocks.load_all_stocks_from_db(frequency=frequency)
+
+
+def best_time(func, repeat):
+    # (best seconds, last result) of repeat calls
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - start)
+    return (min(seconds), result)
+
+
+def same_values(a, b):
+    # the float columns of both frames hold the same values, NaN included
+    if len(a) != len(b):
+        return False
+    for c in b.columns:
+        if b[c].dtype.kind == 'f' and not np.array_equal(a[c].values, b[c].values, equal_nan=True):
+            return False
+    return True
+
+
+def print_loader_times(name, params, repeat):
+    (legacy_time, legacy) = best_time(lambda: read_sql_query(name, params), repeat)
+    (fast_time, fast) = best_time(lambda: load_frame(name, params), repeat)
+    print('  {:<20} {:>8} rows  read_sql_query {:>8.1f}ms  load_frame {:>8.1f}ms  x{:.1f}{}'.format(
+        name, len(fast), legacy_time * 1000, fast_time * 1000, legacy_time / fast_time if fast_time else 0,
+        '' if same_values(legacy, fast) else '  !! different values'))
+
+
+def main(args):
+    params = {'frequency': args.frequency, 'factor_name': args.factor_name}
+    print('*** best of {} loads, frequency {}'.format(args.repeat, args.frequency))
+    for name in ['ff_factor', 'risk_free', 'carbon_risk_factor']:
+        print_loader_times(name, params, args.repeat)
+    tickers = args.ticker or list(get_stocks.load_stocks_defined_in_db()[:3])
+    for ticker in tickers:
+        print_loader_times('stock_data', dict(params, ticker=ticker), args.repeat)
+    if args.all:
+        print_loader_times('all_stock_data', params, args.repeat)
+    return True
+
+
+# run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark loading the factor and stock series with pd.read_sql_query (Decimal values "
+                    "converted to float) against db.load_frame (float8 read by COPY)")
+    parser.add_argument("-n", "--factor_name", default='DEFAULT',
+                        help="Factor name of the carbon_risk_factor series to load")
+    parser.add_argument("-t", "--ticker", nargs='+',
+                        help="Tickers of the stock_data series to load, defaults to the first 3 of the stocks table")
+    parser.add_argument("--all", action='store_true',
+                        help="Also load all the stock_data of the frequency")
+    parser.add_argument("--frequency", default='MONTHLY',
+                        help="Frequency of the series, eg: MONTHLY, DAILY")
+    parser.add_argument("-r", "--repeat", default=3, type=int,
+                        help="Number of loads of each series, the best time is shown")
+    main(parser.parse_args())
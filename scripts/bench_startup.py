@@ -0,0 +1,100 @@
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+# imported by the workers started by the benchmark, like the workers of get_regressions.py
+import get_regressions
+import task_scheduler
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+# imports deferred until used, they should not show in the import time of the scripts
+DEFERRED_MODULES = ['statsmodels', 'yfinance']
+
+
+def import_times(module):
+    # (total, {module: (self, cumulative)}) in microseconds, from the -X importtime
+    # report of a fresh interpreter importing the module, run from the current
+    # directory like the scripts (for db.ini)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [SCRIPTS_DIR, os.environ.get('PYTHONPATH')])))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed: {}'.format(module, result.stderr.strip().splitlines()[-1]))
+    times = {}
+    total = 0
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        (self_us, cumulative, name) = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            # imported directly by the -c statement, its cumulative time includes the nested ones
+            total += int(cumulative)
+        times[name.strip()] = (int(self_us), int(cumulative))
+    return (total, times)
+
+
+def print_import_times(module, top):
+    (total, times) = import_times(module)
+    print('*** import {}: {:.0f}ms'.format(module, total / 1000))
+    packages = {}
+    for (name, (self_us, _)) in times.items():
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    for package in sorted(packages, key=packages.get, reverse=True)[:top]:
+        print('  {:<24} {:>8.0f}ms'.format(package, packages[package] / 1000))
+    for package in DEFERRED_MODULES:
+        if package in packages:
+            print('!! {} is imported by {}, it should be deferred until used'.format(package, module))
+
+
+def worker_ready(index):
+    # a worker has started once it runs a task
+    return os.getpid()
+
+
+def start_workers(method, processes):
+    # seconds to start a pool of worker processes and run a first task on each
+    context = multiprocessing.get_context(method)
+    start = time.perf_counter()
+    with context.Pool(processes=processes) as pool:
+        pool.map(worker_ready, range(processes), chunksize=1)
+    return time.perf_counter() - start
+
+
+def print_worker_startup(processes, repeat):
+    methods = [m for m in ['spawn', 'forkserver'] if m in multiprocessing.get_all_start_methods()]
+    if 'forkserver' in methods:
+        # like task_scheduler.set_start_method, the first pool also pays for starting the forkserver
+        multiprocessing.get_context('forkserver').set_forkserver_preload(task_scheduler.FORKSERVER_PRELOAD)
+    print('*** starting {} worker processes importing get_regressions'.format(processes))
+    for method in methods:
+        seconds = [start_workers(method, processes) for _ in range(repeat)]
+        print('  {:<12} first pool {:.2f}s, then {}'.format(
+            method, seconds[0], ', '.join('{:.2f}s'.format(s) for s in seconds[1:]) or '-'))
+
+
+def main(args):
+    for module in args.modules:
+        print_import_times(module, args.top)
+    if args.concurrency > 0:
+        print_worker_startup(args.concurrency, args.repeat)
+    return True
+
+
+# run
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the startup of the scripts: the python -X importtime report of their imports "
+                    "and the time to start their worker processes with spawn and forkserver")
+    parser.add_argument("-m", "--modules", nargs='+', default=['get_stocks', 'get_regressions'],
+                        help="Modules to report the import time of")
+    parser.add_argument("--top", default=10, type=int,
+                        help="Number of the slowest packages to show for each module")
+    parser.add_argument("-c", "--concurrency", default=4, type=int,
+                        help="Number of worker processes to start, 0 to skip")
+    parser.add_argument("-r", "--repeat", default=3, type=int,
+                        help="Number of pools started with each start method")
+    main(parser.parse_args())
@@ -6,7 +6,8 @@ import textwrap
 import pandas as pd
 import db
 
-conn = db.get_db_connection()
+connPool = db.get_db_connection_pool()
+
 
 def add_bmg_series(factor_name, green_ticker, brown_ticker, start_date=None, end_date=None, frequency='MONTHLY'):
     if not factor_name:
@@ -72,9 +73,10 @@ def delete_bmg_series(factor_name):
 def get_bmg_series():
     # show the current factors
     sql = 'select factor_name, frequency, min(date), max(date) from carbon_risk_factor where group by factor_name order by factor_name;'
-    with conn.cursor() as cursor:
-        cursor.execute(sql)
-        return cursor.fetchall()
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
 
 
 def show_bmg_series(factor_name, start_date=None, end_date=None, frequency='MONTHLY'):
@@ -118,7 +120,7 @@ def main(args):
         return args.delete or args.green_ticker or args.brown_ticker
 
 
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser(
         description="Manage BMG series",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -161,6 +163,11 @@ if __name__ == "__main__":
                         help="Frequency to use for the various series, eg: MONTHLY, DAILY")
     parser.add_argument("-v", "--verbose", action='store_true',
                         help="more output")
+    return parser
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     if not main(parser.parse_args()):
         parser.print_help()
 
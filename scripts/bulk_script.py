@@ -145,11 +145,11 @@ else:
         all_factor_df = merge_data(all_factor_df, ff_data)
 
         # Estimate regression
-        model, coef_df_simple = regfun.regression_input_output(
+        model, result = regfun.regression_input_output(
             all_factor_df, stock_name)
         if model is not False:
             print(stock_name)
-            coef_all = coef_all.append(coef_df_simple)
+            coef_all = pd.concat([coef_all, regfun.regression_results.summary_frame(result)])
         else:
             print(f'Error with stock {stock_name}')
 
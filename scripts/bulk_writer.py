@@ -0,0 +1,114 @@
+import io
+import math
+import pandas as pd
+
+# NULL marker of the COPY text format
+COPY_NULL = '\\N'
+# characters escaped in the COPY text format
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def copy_value(value):
+    # a value in the COPY text format, None and NaT are NULL while the float NaN
+    # are kept like the INSERT of a float NaN did
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        return repr(float(value))
+    if value is pd.NaT:
+        return COPY_NULL
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_rows(cursor, table, columns, rows):
+    # stream the rows into table with a single COPY FROM STDIN, returns the number of rows
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write('\t'.join(copy_value(v) for v in row))
+        buf.write('\n')
+        count += 1
+    buf.seek(0)
+    cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)), buf)
+    return count
+
+
+def unique_rows(rows, key_indexes):
+    # the last row of each key, ON CONFLICT cannot update the same row twice in a statement
+    by_key = {}
+    for row in rows:
+        row = tuple(row)
+        by_key[tuple(row[i] for i in key_indexes)] = row
+    return by_key.values()
+
+
+def create_staging_table(cursor, table, columns):
+    # temporary table dropped at the end of the transaction, with only the columns
+    # written, their types but not the constraints of the table
+    staging = '{}_staging'.format(table)
+    cursor.execute('''CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS
+        SELECT {columns} FROM {table} WITH NO DATA;'''.format(
+        staging=staging, table=table, columns=', '.join(columns)))
+    return staging
+
+
+def upsert_rows(cursor, table, columns, key_fields, rows, update_fields=None):
+    """Insert or update the rows of table in the transaction of the cursor: the rows
+    are copied into a temporary staging table then merged with one
+    INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+
+    Arguments:
+        table -- table to write to, its primary key (or a unique index) must be key_fields
+        columns -- columns of the rows
+        key_fields -- columns identifying a row, for the rows seen several times the last one is kept
+        update_fields -- columns updated on existing rows, defaults to the columns not in key_fields
+
+    Returns the number of rows written.
+    """
+    if update_fields is None:
+        update_fields = [c for c in columns if c not in key_fields]
+    rows = unique_rows(rows, [columns.index(k) for k in key_fields])
+    if not rows:
+        return 0
+    staging = create_staging_table(cursor, table, columns)
+    count = copy_rows(cursor, staging, columns, rows)
+    if update_fields:
+        conflict = 'UPDATE SET {}'.format(', '.join('{0} = EXCLUDED.{0}'.format(f) for f in update_fields))
+    else:
+        conflict = 'NOTHING'
+    cursor.execute('''INSERT INTO {table} ({columns})
+        SELECT {columns} FROM {staging}
+        ON CONFLICT ({keys}) DO {conflict};'''.format(
+        table=table, staging=staging, columns=', '.join(columns), keys=', '.join(key_fields), conflict=conflict))
+    # the same transaction may upsert into the table again
+    cursor.execute('DROP TABLE {};'.format(staging))
+    return count
+
+
+def replace_rows(cursor, table, columns, key_fields, rows):
+    """Replace the rows of table matching the keys of the given rows, in the transaction
+    of the cursor: the rows are copied into a temporary staging table, the matching
+    rows are deleted with one DELETE ... USING then the staging rows inserted.
+
+    Arguments:
+        table -- table to write to
+        columns -- columns of the rows
+        key_fields -- columns identifying the rows replaced, for the rows seen several times the last one is kept
+
+    Returns the number of rows written.
+    """
+    rows = unique_rows(rows, [columns.index(k) for k in key_fields])
+    if not rows:
+        return 0
+    staging = create_staging_table(cursor, table, columns)
+    count = copy_rows(cursor, staging, columns, rows)
+    cursor.execute('''DELETE FROM {table} t
+        USING {staging} s
+        WHERE {match};'''.format(
+        table=table, staging=staging, match='\n        AND '.join('t.{0} = s.{0}'.format(k) for k in key_fields)))
+    cursor.execute('''INSERT INTO {table} ({columns})
+        SELECT {columns} FROM {staging};'''.format(table=table, staging=staging, columns=', '.join(columns)))
+    cursor.execute('DROP TABLE {};'.format(staging))
+    return count
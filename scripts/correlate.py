@@ -34,7 +34,7 @@ def execute_batch(conn, df, table):
 
 
 def process_factor(bmg_factor_name, significance=0.1, verbose=False, frequency='MONTHLY'):
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         sql = '''SELECT
                 date as "date",
                 factor_name as "factor_name",
@@ -73,7 +73,6 @@ def process_factor(bmg_factor_name, significance=0.1, verbose=False, frequency='
 
         bmg_factors_df = pd.read_sql_query(sql, con=conn,
                                            index_col='date', params=(bmg_factor_name,frequency,))
-        connPool.putconn(conn)
 
     final_df = bmg_factors_df
     final_df = pd.merge(bmg_factors_df,
@@ -2,7 +2,11 @@ import pgdb
 import psycopg2.extras
 import psycopg2
 import configparser
-from psycopg2.pool import ThreadedConnectionPool
+import contextlib
+import io
+import os
+import threading
+import pandas as pd
 
 config = configparser.ConfigParser()
 config.read('db.ini')
@@ -14,6 +18,9 @@ DB_PASS = config['DEFAULT']['DatabasePassword']
 
 DB_CREDENTIALS = "postgresql://{}:{}@{}/{}".format(
     DB_USER, DB_PASS, DB_HOST, DB_NAME)
+# connections all the processes of a run may open together, one is kept for the
+# parent process and the others are split between the workers by init_worker_pool
+DB_MAX_CONNECTIONS = config['DEFAULT'].getint('DatabaseMaxConnections', 20)
 
 
 def get_db_connection():
@@ -28,29 +35,179 @@ def get_db_connection():
         raise SystemExit(1)
 
 
+class LazyConnectionPool:
+    """Connections shared by all the modules of a process, they are only opened
+    when first used and kept for reuse once put back.
+
+    Attributes:
+        maxconn -- number of connections the process may open
+    """
+
+    def __init__(self, maxconn=DB_MAX_CONNECTIONS):
+        self.maxconn = maxconn
+        self._free = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._available = None
+
+    def _check_process(self):
+        # a forked child cannot use the connections of its parent, it opens its own
+        if self._pid != os.getpid():
+            self._free = []
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            # the threads of the process (eg: the writer of the regression results) wait for
+            # a connection to be put back instead of failing when maxconn are in use
+            self._available = threading.BoundedSemaphore(self.maxconn)
+
+    def getconn(self):
+        self._check_process()
+        self._available.acquire()
+        try:
+            with self._lock:
+                if self._free:
+                    return self._free.pop()
+            try:
+                return psycopg2.connect(DB_CREDENTIALS)
+            except psycopg2.OperationalError as e:
+                print('Unable to connect PostgreSQL', e)
+                raise
+        except BaseException:
+            self._available.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        # the connection is kept for the next getconn unless closed
+        if close or conn.closed:
+            if not conn.closed:
+                conn.close()
+        else:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            with self._lock:
+                self._free.append(conn)
+        self._available.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        # connection of the pool for a with block: the transaction is committed at the end
+        # of the block or rolled back on an exception, the connection is always put back
+        conn = self.getconn()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.putconn(conn, close=bool(conn.closed))
+
+    def closeall(self):
+        # close the connections put back, the next getconn starts again with maxconn connections
+        if self._pid == os.getpid():
+            with self._lock:
+                for conn in self._free:
+                    conn.close()
+        self._free = []
+        self._pid = None
+
+
+_connection_pool = LazyConnectionPool()
+
+
 def get_db_connection_pool():
-    try:
-        pool = ThreadedConnectionPool(1, 20, DB_CREDENTIALS)
-        return pool
-    except Exception as e:
-        print('Unable to connect PostgreSQL', e)
-        raise SystemExit(1)
+    # the same lazy pool for all the modules of the process
+    return _connection_pool
 
 
-def refresh_views(verbose=False):
+def init_worker_pool(processes):
+    # pool initializer of the worker processes: split DB_MAX_CONNECTIONS between
+    # the workers, keeping one for the parent, each worker gets at least one
+    _connection_pool.closeall()
+    _connection_pool.maxconn = max(1, (DB_MAX_CONNECTIONS - 1) // max(1, processes))
+
+
+# materialized views built on stock_stats_latest, in the order they are refreshed
+MATERIALIZED_VIEWS = ['stock_and_stats', 'stock_component_and_stats', 'stock_parent_and_stats']
+
+
+def mark_views_stale(cursor):
+    # in the transaction writing the tables of the views, the next refresh_views refreshes
+    # them, only the first write after a refresh updates (and locks) the view_refresh row
+    cursor.execute('UPDATE view_refresh SET stale = true WHERE NOT stale;')
+
+
+def rebuild_stock_stats_latest(verbose=False):
+    # fill stock_stats_latest again from all the stock_stats, eg: for stock_stats written before it
+    # existed, get_regressions.py otherwise keeps it up to date
+    with _connection_pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute('DELETE FROM stock_stats_latest;')
+            cursor.execute('''INSERT INTO stock_stats_latest
+                SELECT ss.*
+                FROM stock_stats ss
+                JOIN (SELECT ticker, frequency, bmg_factor_name, max(thru_date) as thru_date
+                    FROM stock_stats
+                    GROUP BY ticker, frequency, bmg_factor_name) x
+                ON ss.ticker = x.ticker and ss.frequency = x.frequency
+                and ss.bmg_factor_name = x.bmg_factor_name and ss.thru_date = x.thru_date;''')
+            if verbose:
+                print('*** rebuilt stock_stats_latest: {} rows'.format(cursor.rowcount))
+            mark_views_stale(cursor)
+
+
+def refresh_views(verbose=False, force=False):
+    # refresh the views when their tables were written since the last refresh (or force), so the
+    # runs in a row refresh them once, CONCURRENTLY does not block the queries reading them
     conn = get_db_connection()
     cur = conn.cursor()
-    if verbose:
-        print("Refreshing stock_and_stats ...")
-    cur.execute("REFRESH MATERIALIZED VIEW stock_and_stats;")
-    if verbose:
-        print("Refreshing stock_component_and_stats ...")
-    cur.execute("REFRESH MATERIALIZED VIEW stock_component_and_stats;")
-    if verbose:
-        print("Refreshing stock_parent_and_stats ...")
-    cur.execute("REFRESH MATERIALIZED VIEW stock_parent_and_stats;")
-    cur.close()
-    conn.close()
+    # cleared before refreshing: the writes committed during the refresh mark the views again
+    cur.execute('UPDATE view_refresh SET stale = false, refreshed_at = now() WHERE stale OR %s;', (force,))
+    if not cur.rowcount:
+        if verbose:
+            print("Views up to date.")
+        cur.close()
+        conn.close()
+        return
+    try:
+        for view in MATERIALIZED_VIEWS:
+            if verbose:
+                print("Refreshing {} ...".format(view))
+            cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY {};".format(view))
+    except Exception:
+        # refresh them at the next run
+        cur.execute('UPDATE view_refresh SET stale = true;')
+        raise
+    finally:
+        cur.close()
+        conn.close()
     if verbose:
         print("Done.")
 
+
+def load_frame(sql, params=None, index_col=None, float_columns=(), date_columns=None, datetime_index=False):
+    """DataFrame of a query read with COPY (...) TO STDOUT and parsed by pd.read_csv,
+    instead of building a python object per value like pd.read_sql_query does.
+
+    Arguments:
+        float_columns -- columns read as float64, the query should cast them to float8
+                         (eg: the decimal columns) so they are not sent as Decimal text
+        date_columns -- date columns, defaults to index_col
+        datetime_index -- the dates are datetime64, otherwise datetime.date objects like pd.read_sql_query
+
+    NULL and NaN are read as NaN in the float_columns, the other columns keep their text.
+    """
+    if date_columns is None:
+        date_columns = [index_col] if index_col else []
+    buf = io.StringIO()
+    with _connection_pool.connection() as conn:
+        with conn.cursor() as cursor:
+            query = cursor.mogrify(sql.strip().rstrip(';'), params).decode(psycopg2.extensions.encodings[conn.encoding])
+            cursor.copy_expert('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(query), buf)
+    buf.seek(0)
+    df = pd.read_csv(buf, dtype={c: 'float64' for c in float_columns}, keep_default_na=False,
+                     na_values={c: ['', 'NaN'] for c in float_columns}, float_precision='round_trip')
+    for c in date_columns:
+        df[c] = pd.to_datetime(df[c], format='%Y-%m-%d')
+        if not datetime_index:
+            df[c] = df[c].dt.date
+    if index_col:
+        df = df.set_index(index_col)
+    return df
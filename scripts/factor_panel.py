@@ -0,0 +1,195 @@
+import numpy as np
+import pandas as pd
+import regression_engine
+from multiprocessing import shared_memory
+
+FACTOR_COLUMNS = ['BMG', 'Mkt-RF', 'SMB', 'HML', 'WML']
+
+
+def to_date(value):
+    return pd.Timestamp(value).date()
+
+
+class FactorPanel:
+    """Factor series of a (factor_name, frequency) aligned once per run.
+
+    Attributes:
+        dates -- sorted datetime64[ns] dates where all the factors and Rf are defined
+        factors -- float64 (n, k) matrix of the factors, FF already scaled from percent
+        exog -- the factors with the constant in the first column
+        rf -- float64 (n,) risk free rate, already scaled from percent
+        series_start -- common start date of the BMG, FF and Rf series
+        series_end -- common end date of the BMG, FF and Rf series
+    """
+
+    def __init__(self, factor_name, frequency, dates, factors, rf, series_start, series_end, factor_columns=FACTOR_COLUMNS):
+        dates = np.asarray(dates, dtype='datetime64[ns]')
+        exog = np.column_stack([np.ones(len(dates)), np.asarray(factors, dtype=np.float64)])
+        # rows kept by the outlier filter of regression_input_output
+        exog_ok = np.all(np.abs(exog[:, 1:]) < 0.5, axis=1)
+        self._set_series(factor_name, frequency, series_start, series_end, factor_columns)
+        self._set_arrays(dates, np.ascontiguousarray(exog), np.ascontiguousarray(rf, dtype=np.float64), exog_ok)
+
+    def _set_series(self, factor_name, frequency, series_start, series_end, factor_columns):
+        self.factor_name = factor_name
+        self.frequency = frequency
+        self.factor_columns = list(factor_columns)
+        self.exog_names = ['Constant'] + self.factor_columns
+        self.series_start = series_start
+        self.series_end = series_end
+        self._shm = None
+
+    def _set_arrays(self, dates, exog, rf, exog_ok):
+        self.dates = dates
+        self.exog = exog
+        self.factors = exog[:, 1:]
+        self.rf = rf
+        self.exog_ok = exog_ok
+
+    def share(self):
+        # copy the arrays once into a shared memory block, returns the block (to unlink
+        # when the workers are done) and a small picklable descriptor for attach()
+        arrays = [('dates', self.dates), ('exog', self.exog), ('rf', self.rf), ('exog_ok', self.exog_ok)]
+        shm = shared_memory.SharedMemory(create=True, size=max(1, sum(a.nbytes for (_, a) in arrays)))
+        layout = []
+        offset = 0
+        for (name, a) in arrays:
+            view = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf, offset=offset)
+            view[...] = a
+            layout.append((name, a.dtype.str, a.shape, offset))
+            offset += a.nbytes
+        descriptor = {
+            'shm_name': shm.name,
+            'layout': layout,
+            'factor_name': self.factor_name,
+            'frequency': self.frequency,
+            'series_start': self.series_start,
+            'series_end': self.series_end,
+            'factor_columns': self.factor_columns,
+        }
+        return (shm, descriptor)
+
+    @classmethod
+    def attach(cls, descriptor):
+        # panel published by share() in another process, the arrays are read only
+        # views of the shared memory block, nothing is copied
+        shm = shared_memory.SharedMemory(name=descriptor['shm_name'])
+        arrays = {}
+        for (name, dtype, shape, offset) in descriptor['layout']:
+            arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            arrays[name].flags.writeable = False
+        panel = cls.__new__(cls)
+        panel._set_series(descriptor['factor_name'], descriptor['frequency'], descriptor['series_start'],
+                          descriptor['series_end'], descriptor['factor_columns'])
+        panel._set_arrays(**arrays)
+        # the block stays mapped as long as the panel is used
+        panel._shm = shm
+        return panel
+
+    @classmethod
+    def from_frames(cls, factor_name, frequency, carbon_data, ff_data, rf_data, extra_data=None):
+        # same scaling as factor_regression.run_regression: FF and Rf are in percent,
+        # extra_data holds more factor columns (eg: bond factors) also in percent
+        factors = carbon_data[['BMG']].join(ff_data / 100, how='inner').join(rf_data / 100, how='inner')
+        factor_columns = list(FACTOR_COLUMNS)
+        series = [carbon_data, ff_data, rf_data]
+        if extra_data is not None:
+            factors = factors.join(extra_data / 100, how='inner')
+            factor_columns += list(extra_data.columns)
+            series.append(extra_data)
+        factors = factors.astype(float).sort_index()
+        series_start = max(min(s.index) for s in series)
+        series_end = min(max(s.index) for s in series)
+        return cls(factor_name, frequency,
+                   pd.to_datetime(factors.index).values,
+                   factors[factor_columns].values,
+                   factors['Rf'].values,
+                   to_date(series_start),
+                   to_date(series_end),
+                   factor_columns=factor_columns)
+
+    def column_order(self, names):
+        # positions in exog of the given regressors, for fitting them in that order
+        return [self.exog_names.index(name) for name in names]
+
+    def __len__(self):
+        return len(self.dates)
+
+    def rows_of(self, dates):
+        # integer join: position of each date in the panel, -1 when not in the panel
+        dates = np.asarray(pd.to_datetime(dates).values, dtype='datetime64[ns]')
+        pos = np.searchsorted(self.dates, dates)
+        found = pos < len(self.dates)
+        found[found] = self.dates[pos[found]] == dates[found]
+        return np.where(found, pos, -1)
+
+    def align(self, returns):
+        # align a stock returns series (date index) onto the panel
+        returns = returns.astype(float)
+        rows = self.rows_of(returns.index)
+        has_row = rows >= 0
+        rows = rows[has_row]
+        y = returns.values[has_row] - self.rf[rows]
+        stock_start = to_date(min(returns.index)) if len(returns) else None
+        stock_end = to_date(max(returns.index)) if len(returns) else None
+        return AlignedReturns(self, rows, y, stock_start, stock_end)
+
+
+class AlignedReturns:
+    """Excess returns of one stock aligned on a FactorPanel.
+
+    Attributes:
+        rows -- rows of the panel the stock has data for
+        dates -- datetime64[ns] dates of those rows
+        y -- excess returns
+        x -- design matrix for those rows, constant first
+        mask -- rows kept by the outlier filter of regression_input_output
+        common_start -- common start date of the stock and factor series
+        common_end -- common end date of the stock and factor series
+    """
+
+    def __init__(self, panel, rows, y, stock_start, stock_end):
+        self.panel = panel
+        self.rows = rows
+        self.dates = panel.dates[rows]
+        self.y = y
+        self.x = panel.exog[rows]
+        self.exog_names = panel.exog_names
+        self.mask = (np.abs(y) < 0.5) & panel.exog_ok[rows]
+        self.common_start = None
+        self.common_end = None
+        self._cross_products = None
+        if stock_start is not None:
+            self.common_start = max(stock_start, panel.series_start)
+            self.common_end = min(stock_end, panel.series_end)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def first_date(self):
+        return to_date(self.dates[0])
+
+    @property
+    def last_date(self):
+        return to_date(self.dates[-1])
+
+    def cross_products(self):
+        # prefix sums of the cross products, computed once and shared by all the windows
+        # and intervals fitted with regression_engine.rolling_ols
+        if self._cross_products is None:
+            self._cross_products = regression_engine.window_cross_products(self.y, self.x, self.mask)
+        return self._cross_products
+
+    def window(self, start_date, end_date):
+        # (lo, hi) positions of the rows between the two dates, inclusive
+        lo = np.searchsorted(self.dates, np.datetime64(start_date, 'ns'), side='left')
+        hi = np.searchsorted(self.dates, np.datetime64(end_date, 'ns'), side='right')
+        return (lo, hi)
+
+    def frame(self, lo, hi):
+        # rows [lo, hi) in the DataFrame form used by regression_input_output
+        df = pd.DataFrame(self.x[lo:hi, 1:], columns=self.panel.factor_columns,
+                          index=pd.Index([to_date(d) for d in self.dates[lo:hi]], name='Date'))
+        df.insert(0, 'Close', self.y[lo:hi])
+        return df
@@ -1,4 +1,3 @@
-import pdb
 import pandas as pd
 import regression_function as regfun
 import input_function
@@ -46,7 +45,8 @@ def parse_date(name, date_str):
             '{} Date {} not in correct format, must be YYYY-MM-DD'.format(name, date_str))
 
 
-def run_regression(stock_data, carbon_data, ff_data, rf_data, ticker, start_date=None, end_date=None, verbose=True, silent=False):
+def run_regression(stock_data, carbon_data, ff_data, rf_data, ticker, start_date=None, end_date=None, verbose=True, silent=False, engine=regfun.regression_engine.DEFAULT_ENGINE,
+                   diagnostics=regfun.regression_diagnostics.DEFAULT_DIAGNOSTICS):
     ff_data = ff_data/100
     rf_data = rf_data/100
 
@@ -120,16 +120,17 @@ def run_regression(stock_data, carbon_data, ff_data, rf_data, ticker, start_date
         print('Running {} - {} regression using data from {} to {} -- data has {} entries'.format(start_date,
                                                                                                   end_date, data_start_date, data_end_date, len(all_factor_df)))
 
-    model_output, coef_df_simple = regfun.regression_input_output(
-        all_factor_df, ticker)
+    model_output, result = regfun.regression_input_output(
+        all_factor_df, ticker, engine=engine, diagnostics=diagnostics)
 
     if (verbose or not silent) and model_output is not False:
         print(model_output.summary())
-        print(coef_df_simple.to_string())
-    return (start_date, end_date, data_start_date, data_end_date, model_output, coef_df_simple)
+        print(regfun.regression_results.summary_frame(result).to_string())
+    return (start_date, end_date, data_start_date, data_end_date, model_output, result)
 
 
-def run_regression_bulk(all_factor_df, ticker, start_date=None, end_date=None, verbose=True, silent=False):
+def run_regression_bulk(all_factor_df, ticker, start_date=None, end_date=None, verbose=True, silent=False, engine=regfun.regression_engine.DEFAULT_ENGINE,
+                        diagnostics=regfun.regression_diagnostics.DEFAULT_DIAGNOSTICS):
 
     if len(all_factor_df) == 0:
         raise ValueError('No data could be loaded!')
@@ -194,15 +195,84 @@ def run_regression_bulk(all_factor_df, ticker, start_date=None, end_date=None, v
         print('Running {} - {} regression using data from {} to {} -- data has {} entries'.format(start_date,
                                                                                                   end_date, data_start_date, data_end_date, len(all_factor_df)))
 
-    model_output, coef_df_simple = regfun.regression_input_output(
-        all_factor_df, ticker)
+    model_output, result = regfun.regression_input_output(
+        all_factor_df, ticker, engine=engine, diagnostics=diagnostics)
 
     if (verbose or not silent) and model_output is not False:
         print(model_output.summary())
-        print(coef_df_simple.to_string())
-    return (start_date, end_date, data_start_date, data_end_date, model_output, coef_df_simple)
+        print(regfun.regression_results.summary_frame(result).to_string())
+    return (start_date, end_date, data_start_date, data_end_date, model_output, result)
 
 
+def run_regression_aligned(aligned, ticker, start_date=None, end_date=None, verbose=True, silent=False, engine=regfun.regression_engine.DEFAULT_ENGINE,
+                           diagnostics=regfun.regression_diagnostics.DEFAULT_DIAGNOSTICS, window=None):
+    # same as run_regression for data already aligned on a factor_panel.FactorPanel,
+    # the window is sliced by integer offsets instead of merging the data frames,
+    # window can give the (lo, hi) rows of the dates already found by a window_planner.WindowPlan
+    if len(aligned) == 0:
+        raise ValueError('No data could be loaded!')
+
+    # Check start and end dates
+    max_date = aligned.last_date
+    min_date = aligned.first_date
+    if verbose:
+        print('Data available from {} to {}'.format(min_date, max_date))
+
+    if start_date is not None:
+        start_date = parse_date('Start', start_date)
+    else:
+        start_date = min_date
+
+    if end_date is not None:
+        end_date = parse_date('End', end_date)
+    else:
+        end_date = max_date
+
+    if verbose:
+        print('start_date is {}, end_date is {}'.format(start_date, end_date))
+    if start_date >= max_date:
+        raise DateInRangeError(start_date, min_date, max_date, 'Start date')
+    if end_date <= min_date:
+        raise DateInRangeError(end_date, min_date, max_date, 'End date')
+
+    data_start_date = start_date
+    data_end_date = end_date
+    if start_date < min_date:
+        if verbose or not silent:
+            print('Start Date too early, using {} instead.'.format(min_date))
+        data_start_date = min_date
+    if end_date > max_date:
+        if verbose or not silent:
+            print('End Date too late, using {} instead.'.format(max_date))
+        data_end_date = max_date
+    if window is None:
+        window = aligned.window(start_date, end_date)
+    (lo, hi) = window
+
+    # could be empty now if the ticker has no data after the start date
+    if hi - lo == 0:
+        raise ValueError('No data for stock {} overlapping the ff_factor and carbon_data after date {}'.format(
+            ticker, start_date))
+    # the statistical functions are not valid with less than 20 data points
+    if hi - lo < 20:
+        raise ValueError('Not enough data for stock {} overlapping the ff_factor and carbon_data after date {} (got {} data points)'.format(
+            ticker, start_date, hi - lo))
+
+    all_factor_df = aligned.frame(lo, hi)
+    if verbose:
+        print(all_factor_df)
+    if verbose or not silent:
+        print('Running {} - {} regression using data from {} to {} -- data has {} entries'.format(start_date,
+                                                                                                  end_date, data_start_date, data_end_date, len(all_factor_df)))
+
+    model_output, result = regfun.regression_input_output(
+        all_factor_df, ticker, engine=engine, diagnostics=diagnostics)
+
+    if (verbose or not silent) and model_output is not False:
+        print(model_output.summary())
+        print(regfun.regression_results.summary_frame(result).to_string())
+    return (start_date, end_date, data_start_date, data_end_date, model_output, result)
+
 # run
 if __name__ == "__main__":
     # Read in the data
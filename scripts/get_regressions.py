@@ -1,17 +1,48 @@
 import argparse
-from dateutil.relativedelta import relativedelta
+import numpy as np
 import pandas as pd
+import psycopg2.extras
 import db
 import get_stocks
 import factor_regression
+import factor_panel
+import window_planner
+import regression_engine
+import regression_diagnostics
+import regression_results
+import nested_models
 import input_function
 import datetime
+import os
 import traceback
-import multiprocessing
 import itertools
+import zlib
+import task_scheduler
+import job_ledger
+import bulk_writer
+import update_planner
 
 connPool = db.get_db_connection_pool()
 
+# number of tickers sent at a time to a worker process in bulk mode
+BULK_TICKERS_PER_TASK = 20
+
+# args, factor panels and job ledger of a worker process, set by set_worker_job for each run
+worker_job_id = None
+worker_args = None
+worker_panels = None
+worker_ledger = None
+# shared factor panels attached by a worker process, by shared memory block name
+attached_panels = {}
+# factor panels kept loaded between the runs of a long running process (see worker_daemon.py),
+# None when each run loads its own panels
+panel_cache = None
+job_ids = itertools.count()
+
+# args identifying a run in the job_ledger, with its tickers, factors, frequency and intervals
+LEDGER_FIELDS = ['file', 'start_date', 'end_date', 'update', 'engine', 'diagnostics',
+                 'nested_models', 'bond_factors', 'additional_factors', 'shard']
+
 
 def load_stocks_csv(filename):
     print('Loading stock tickers CSV {} ...'.format(filename))
@@ -20,101 +51,234 @@ def load_stocks_csv(filename):
 
 
 def load_carbon_data_from_db(factor_name, frequency='MONTHLY'):
+    # the factor series are read as float64 on datetime64 dates (see db.load_frame)
     sql = '''SELECT
             date as "Date",
-            bmg as "BMG"
+            bmg::float8 as "BMG"
         FROM carbon_risk_factor
         WHERE factor_name = %s and frequency = %s
         ORDER BY date
         '''
-    with connPool.getconn() as conn:
-        res = pd.read_sql_query(sql, con=conn,
-                             index_col='Date', params=(factor_name,frequency,))
-        connPool.putconn(conn)
-        return res
+    return db.load_frame(sql, (factor_name, frequency), index_col='Date', float_columns=['BMG'],
+                         datetime_index=True)
+
+
+def load_factor_names_from_db(frequency='MONTHLY'):
+    # every factor name of the carbon_risk_factor series, for --all_factors
+    sql = '''SELECT DISTINCT factor_name
+        FROM carbon_risk_factor
+        WHERE frequency = %s
+        ORDER BY factor_name
+        '''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (frequency,))
+            res = [r[0] for r in cursor.fetchall()]
+    return res
 
 
 def load_ff_data_from_db(frequency='MONTHLY'):
     sql = '''SELECT
             date as "Date",
-            mkt_rf as "Mkt-RF",
-            smb as "SMB",
-            hml as "HML",
-            wml as "WML"
+            mkt_rf::float8 as "Mkt-RF",
+            smb::float8 as "SMB",
+            hml::float8 as "HML",
+            wml::float8 as "WML"
         FROM ff_factor
         WHERE frequency = %s
         ORDER BY date
         '''
-    with connPool.getconn() as conn:
-        res = pd.read_sql_query(sql, con=conn,
-                             index_col='Date', params=(frequency,))
-        connPool.putconn(conn)
-        return res
+    return db.load_frame(sql, (frequency,), index_col='Date', float_columns=['Mkt-RF', 'SMB', 'HML', 'WML'],
+                         datetime_index=True)
 
 
 def load_rf_data_from_db(frequency='MONTHLY'):
     sql = '''SELECT
             date as "Date",
-            rf as "Rf"
+            rf::float8 as "Rf"
         FROM risk_free
         WHERE frequency = %s
         ORDER BY date
         '''
-    with connPool.getconn() as conn:
-        res = pd.read_sql_query(sql, con=conn,
-                             index_col='Date', params=(frequency,))
-        connPool.putconn(conn)
-        return res
+    return db.load_frame(sql, (frequency,), index_col='Date', float_columns=['Rf'], datetime_index=True)
 
 
-def bulk_regression_transformer(final_data, ff_names, rf_names, factor_name, interval, frequency='MONTHLY'):
+def load_bond_data_from_db(frequency='MONTHLY'):
+    sql = '''SELECT
+            date as "Date",
+            {}
+        FROM bond_factor
+        WHERE frequency = %s
+        ORDER BY date
+        '''.format(',\n            '.join('{0}::float8 as {0}'.format(c) for c in nested_models.BOND_FACTOR_COLUMNS))
+    return db.load_frame(sql, (frequency,), index_col='Date', float_columns=nested_models.BOND_FACTOR_COLUMNS,
+                         datetime_index=True)
+
+
+def load_additional_factors_from_db(factor_names, frequency='MONTHLY'):
+    # one column per additional factor
+    sql = '''SELECT
+            date as "Date",
+            factor_name,
+            factor_value::float8 as factor_value
+        FROM additional_factors
+        WHERE factor_name = ANY(%s) and frequency = %s
+        ORDER BY date
+        '''
+    res = db.load_frame(sql, (list(factor_names), frequency), float_columns=['factor_value'], date_columns=['Date'],
+                        datetime_index=True)
+    res = res.pivot(index='Date', columns='factor_name', values='factor_value')
+    return res[[f for f in factor_names if f in res.columns]]
+
+
+def load_extra_factors(frequency='MONTHLY', bond_factors=False, additional_factors=None):
+    # factors added to the panel for the nested models, None when there are none
+    extra = []
+    if bond_factors:
+        extra.append(load_bond_data_from_db(frequency=frequency))
+    if additional_factors:
+        extra.append(load_additional_factors_from_db(additional_factors, frequency=frequency))
+    if not extra:
+        return None
+    extra_data = extra[0]
+    for data in extra[1:]:
+        extra_data = extra_data.join(data, how='inner')
+    return extra_data
+
+
+def bulk_regression_transformer(stock_returns, panels, date_ranges, interval, frequency='MONTHLY', engine=regression_engine.DEFAULT_ENGINE,
+                                diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS, verbose=True):
+    # stock_returns: iterable of (ticker, returns) one ticker at a time (eg: streamed from the DB),
+    # each is aligned on the panel of each factor and regressed over its own common dates, the
+    # (start_date, end_date, total) of date_ranges[factor_name] only give the number of tickers
     start_time = datetime.datetime.now()
-    ticker_names = final_data['ticker'].unique().tolist()
-    start_date = min(final_data.index.values)
-    end_date = max(final_data.index.values)
-    t = len(ticker_names)
     i = 0
-    for temp_ticker in ticker_names:
-        temp_data = final_data.loc[final_data.ticker == temp_ticker, :]
-        stock_data = temp_data[['ticker', 'return']]
-        stock_data = input_function.convert_to_form_db(stock_data)
-        if stock_data is None:
-            print('!! error processing {}'.format(temp_ticker))
+    # the results of the tickers are written by the sink while the next tickers run
+    sink = regression_results.get_result_sink()
+    try:
+        for (temp_ticker, returns) in stock_returns:
+            for (factor_name, panel) in panels.items():
+                t = date_ranges[factor_name][2]
+                # the returns are already computed, align them on the factor panel
+                aligned = panel.align(returns)
+                if len(aligned) == 0:
+                    continue
+                for temp_interval in window_planner.get_intervals(frequency, interval):
+                    run_ticker_regressions(aligned, temp_ticker, factor_name, None, None, temp_interval,
+                                           frequency, verbose=False, silent=True, store=True, index=i, total=t,
+                                           engine=engine, diagnostics=diagnostics)
+            if verbose:
+                print(temp_ticker)
+            i = i+1
+    finally:
+        sink.drain()
+    end_time = datetime.datetime.now()
+    if verbose:
+        print(end_time - start_time)
+    return i
+
+
+def load_bulk_date_ranges(panels, frequency='MONTHLY'):
+    # {factor_name: (start_date, end_date, number of tickers)} of the stock returns
+    # on the dates of each panel, the factors without any stock data are left out
+    date_ranges = {}
+    for (factor_name, panel) in panels.items():
+        res = get_stocks.load_stock_returns_range_from_db(panel.dates.astype('datetime64[D]').tolist(),
+                                                          frequency=frequency)
+        if res is None or res[0] is None:
+            print('No stock data overlapping the {} factors !'.format(factor_name))
             continue
-        stock_data = stock_data.rename(columns={'return': 'Close'})
-        stock_data = stock_data.drop(columns=['ticker'])
-        ff_data = temp_data[ff_names]
-        # ff_data.insert(0, 'date', ff_data.index.values)
-        rf_data = temp_data[rf_names]
-        # rf_data.insert(0, 'date', rf_data.index.values)
-        carbon_data = temp_data['BMG'].to_frame()
-        carbon_data.insert(0, 'date', carbon_data.index.values)
-        running = True
-        while running:
-            (start_date, running) = run_regression_internal(stock_data, carbon_data, ff_data, rf_data,
-                                                 temp_ticker, factor_name, start_date, end_date, interval,
-                                                 frequency, verbose=False, silent=True, store=True, index=i, total=t)
-        print(temp_ticker)
-        i = i+1
+        date_ranges[factor_name] = res
+    return date_ranges
+
+
+def run_bulk_regressions(panels, args, pool=None):
+    # bulk regressions of all the stocks streamed from the DB one ticker at a time,
+    # with --concurrency blocks of tickers are sent to a pool of workers (pool when given)
+    date_ranges = load_bulk_date_ranges(panels, frequency=args.frequency)
+    panels = {factor_name: panels[factor_name] for factor_name in date_ranges}
+    if not panels:
+        return
+    stock_returns = get_stocks.iter_stock_returns_from_db(frequency=args.frequency)
+    if args.concurrency <= 1:
+        bulk_regression_transformer(stock_returns, panels, date_ranges, args.interval, frequency=args.frequency,
+                                    engine=args.engine, diagnostics=args.diagnostics)
+        return
+    (blocks, descriptors) = share_factor_panels(panels)
+    try:
+        with task_scheduler.process_pool(args.concurrency, pool) as pool:
+            run_bulk_partitions(pool, new_job(args, descriptors), stock_returns, date_ranges, args.concurrency)
+    finally:
+        release_factor_panels(blocks)
+
+
+def run_bulk_partitions(pool, job, stock_returns, date_ranges, concurrency):
+    # send the streamed tickers to the pool by blocks of BULK_TICKERS_PER_TASK, the pool
+    # pulls the next block when its task queue has room, the progress and timing are reported here
+    start_time = datetime.datetime.now()
+    t = max(total for (_, _, total) in date_ranges.values())
+    tasks = ((job, block, date_ranges) for block in iter_blocks(stock_returns, BULK_TICKERS_PER_TASK))
+    done = 0
+    worker_time = datetime.timedelta(0)
+    for (n, elapsed) in pool.imap_unordered(run_bulk_partition, tasks):
+        done += n
+        worker_time += elapsed
+        print('*** [{} / {}] bulk regressions done ...'.format(done, t))
     end_time = datetime.datetime.now()
-    print(end_time - start_time)
+    print('*** bulk regressions of {} tickers in {} ({} of worker time over {} processes)'.format(
+        done, end_time - start_time, worker_time, concurrency))
 
 
-def run_regression(ticker,
-                   factor_name,
-                   start_date,
-                   end_date,
-                   interval,
-                   frequency='MONTHLY',
-                   carbon_data=None,
-                   ff_data=None,
-                   rf_data=None,
-                   update=False,
-                   verbose=False,
-                   silent=False,
-                   store=False,
-                   index=None,
-                   total=None):
+def iter_blocks(items, size):
+    # lists of up to size consecutive items
+    items = iter(items)
+    block = list(itertools.islice(items, size))
+    while block:
+        yield block
+        block = list(itertools.islice(items, size))
+
+
+def run_bulk_partition(task):
+    # worker side of run_bulk_partitions, returns the number of tickers and the time taken
+    (job, stock_returns, date_ranges) = task
+    set_worker_job(job)
+    start_time = datetime.datetime.now()
+    n = bulk_regression_transformer(stock_returns, worker_panels, date_ranges, worker_args.interval,
+                                    frequency=worker_args.frequency, engine=worker_args.engine,
+                                    diagnostics=worker_args.diagnostics, verbose=False)
+    return (n, datetime.datetime.now() - start_time)
+
+
+def get_last_regression_start(ticker, factor_name, interval, frequency, start_date=None, table='stock_stats'):
+    # get the last date entry for this ticker and frequency
+    sql = '''SELECT
+    from_date,
+    thru_date
+    FROM ''' + table + '''
+    WHERE ticker = %s
+    AND frequency = %s
+    AND bmg_factor_name = %s
+    AND interval = %s
+    ORDER BY from_date DESC
+    LIMIT 1'''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (ticker, frequency, factor_name, interval))
+            result = cursor.fetchone()
+            if result:
+                start_date = result[0]
+    return start_date
+
+
+def load_factor_panel(factor_name,
+                      frequency='MONTHLY',
+                      carbon_data=None,
+                      ff_data=None,
+                      rf_data=None,
+                      verbose=False,
+                      extra_data=None):
+    # load the BMG, FF and Rf series and align them once, the stocks are then
+    # joined onto the panel instead of merging the data frames for each window
     if carbon_data is None:
         carbon_data = load_carbon_data_from_db(factor_name, frequency=frequency)
         if verbose:
@@ -140,6 +304,70 @@ def run_regression(ticker,
         print('Got risk-free rate')
         print(rf_data)
 
+    if carbon_data is None or carbon_data.empty:
+        print('No carbon_data !')
+        return None
+
+    if ff_data is None or ff_data.empty:
+        print('No ff_data !')
+        return None
+
+    if rf_data is None or rf_data.empty:
+        print('No rf_data !')
+        return None
+
+    return factor_panel.FactorPanel.from_frames(factor_name, frequency, carbon_data, ff_data, rf_data,
+                                                extra_data=extra_data)
+
+
+def load_factor_panels(factor_names,
+                       frequency='MONTHLY',
+                       ff_data=None,
+                       rf_data=None,
+                       verbose=False,
+                       extra_data=None):
+    # {factor_name: panel} of several BMG factors, the FF and Rf series are loaded
+    # once and shared by all the panels, only the BMG series is loaded for each factor
+    if panel_cache is not None and ff_data is None and rf_data is None and extra_data is None:
+        return panel_cache.load(factor_names, frequency=frequency, verbose=verbose)
+    if ff_data is None:
+        ff_data = load_ff_data_from_db(frequency=frequency)
+    if rf_data is None:
+        rf_data = load_rf_data_from_db(frequency=frequency)
+    panels = {}
+    for factor_name in factor_names:
+        panel = load_factor_panel(factor_name, frequency=frequency, ff_data=ff_data, rf_data=rf_data,
+                                  verbose=verbose, extra_data=extra_data)
+        if panel is None:
+            print("No carbon data found for factor {} and frequency {}".format(factor_name, frequency))
+            continue
+        panels[factor_name] = panel
+    return panels
+
+
+def get_factor_panels(factor_name,
+                      frequency='MONTHLY',
+                      carbon_data=None,
+                      ff_data=None,
+                      rf_data=None,
+                      verbose=False,
+                      panel=None):
+    # {factor_name: panel} for a factor name or a list of factor names,
+    # panel is the already loaded panel, or the dict of panels for a list
+    if isinstance(factor_name, (list, tuple)):
+        if panel is None:
+            panel = load_factor_panels(factor_name, frequency=frequency, ff_data=ff_data, rf_data=rf_data,
+                                       verbose=verbose)
+        return panel
+    if panel is None:
+        panel = load_factor_panel(factor_name, frequency=frequency, carbon_data=carbon_data,
+                                  ff_data=ff_data, rf_data=rf_data, verbose=verbose)
+        if panel is None:
+            return {}
+    return {factor_name: panel}
+
+
+def load_stock_returns(ticker, frequency='MONTHLY', verbose=False):
     stock_data = get_stocks.load_stocks_from_db(ticker, frequency=frequency)
     stock_data = input_function.convert_to_form_db(stock_data)
     if stock_data is None or stock_data.empty:
@@ -150,73 +378,174 @@ def run_regression(ticker,
 
     if stock_data is None or stock_data.empty:
         print('No stock data for {} !'.format(ticker))
+        return None
+
+    # convert to pct change
+    return stock_data['Close'].astype(float).pct_change(periods=1)
+
+
+def run_regression(ticker,
+                   factor_name,
+                   start_date,
+                   end_date,
+                   interval,
+                   frequency='MONTHLY',
+                   carbon_data=None,
+                   ff_data=None,
+                   rf_data=None,
+                   update=False,
+                   verbose=False,
+                   silent=False,
+                   store=False,
+                   index=None,
+                   total=None,
+                   engine=regression_engine.DEFAULT_ENGINE,
+                   diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS,
+                   panel=None,
+                   models=None,
+                   ledger=None,
+                   starts=None):
+    # interval can be a list of intervals, run from the same stock data
+    # factor_name can be a list of factor names, the stock is then loaded once and aligned on
+    # the panel of each factor, panel is then the dict of the panels by factor name
+    # models: list of nested_models.model_specs to fit the nested models instead,
+    # the panel must then hold their extra factors
+    # ledger: job_ledger.JobLedger recording each (factor, interval) of the ticker, the ones
+    # already done (or not claimed from the queue) are skipped
+    # starts: with update, {(factor_name, interval): start date} of the regressions to run
+    # (see update_planner.plan_regression_updates), the others are up to date, when None
+    # the start date of each one is looked up
+    panels = get_factor_panels(factor_name, frequency=frequency, carbon_data=carbon_data,
+                               ff_data=ff_data, rf_data=rf_data, verbose=verbose, panel=panel)
+    if not panels:
         return
 
-    if carbon_data is None or carbon_data.empty:
-        print('No carbon_data !')
+    returns = load_stock_returns(ticker, frequency=frequency, verbose=verbose)
+    if returns is None:
         return
 
-    if ff_data is None or ff_data.empty:
-        print('No ff_data !')
+    intervals = window_planner.get_intervals(frequency, interval)
+    # the results are written by the sink while the next regressions run, the tasks of
+    # the ledger are done once their results are written, all of them before returning
+    sink = regression_results.get_result_sink()
+    try:
+        for (factor_name, panel) in panels.items():
+            aligned = panel.align(returns)
+
+            # all the intervals reuse the loaded and aligned data
+            for interval in intervals:
+                # already done by the run being resumed, or up to date
+                if ledger is not None and not ledger.should_run(ticker, factor_name, interval):
+                    continue
+                if update and starts is not None and (factor_name, interval) not in starts:
+                    continue
+                with job_ledger.track(ledger, ticker, factor_name, interval, sink=sink):
+                    # if we update, get the latest date we had data for
+                    # if we had no data just use the given start_date
+                    t_start = start_date
+                    if update and starts is not None:
+                        t_start = starts[(factor_name, interval)]
+                    elif update:
+                        t_start = get_last_regression_start(ticker, factor_name, interval, frequency, start_date,
+                                                            table=('stock_model_stats' if models else 'stock_stats'))
+                        if verbose:
+                            print('*** updating stock {} regression {} - {} from {}'.format(ticker, factor_name, interval, t_start))
+
+                    run_ticker_regressions(aligned,
+                                           ticker,
+                                           factor_name,
+                                           t_start,
+                                           end_date,
+                                           interval,
+                                           frequency,
+                                           verbose,
+                                           silent,
+                                           store,
+                                           index,
+                                           total,
+                                           engine,
+                                           diagnostics,
+                                           models)
+    finally:
+        sink.drain()
+
+
+def plan_regression_windows(aligned, start_date, end_date, interval, frequency):
+    # all the windows of a ticker, from the given dates or the common dates of all the series,
+    # bound to the rows of the aligned data
+    if not start_date:
+        # use the common start date of all series:
+        start_date = aligned.common_start
+    if end_date:
+        end_date = window_planner.period_end_date(end_date, frequency)
+    else:
+        # use the common end date of all series:
+        end_date = aligned.common_end
+    plan = window_planner.plan_windows(start_date, end_date, interval, frequency)
+    return (plan.bind(aligned.dates), end_date)
+
+
+def run_ticker_regressions(aligned,
+                           ticker,
+                           factor_name,
+                           start_date,
+                           end_date,
+                           interval,
+                           frequency,
+                           verbose,
+                           silent,
+                           store,
+                           index,
+                           total,
+                           engine=regression_engine.DEFAULT_ENGINE,
+                           diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS,
+                           models=None):
+    # check we have data or some of the code below will throw an exception
+    if aligned is None or len(aligned) == 0:
+        print('No stock data for {} overlapping the ff_factor and carbon_data !'.format(ticker))
         return
 
-    if rf_data is None or rf_data.empty:
-        print('No rf_data !')
+    interval = window_planner.get_interval(frequency, interval)
+    try:
+        (plan, end_date) = plan_regression_windows(aligned, start_date, end_date, interval, frequency)
+    except ValueError as e:
+        print('!! Error running regression on stock {} from {} to {}: {}'.format(
+            ticker, start_date, end_date, e))
         return
 
-    # convert to pct change
-    stock_data = stock_data.pct_change(periods=1)
+    if models:
+        results = regression_results.ResultBuffer(store_model_stats_into_db, sink=regression_results.get_result_sink())
+        try:
+            run_nested_model_regressions(aligned, plan, models, ticker, factor_name, interval, frequency,
+                                         verbose, silent, store, index, total, results)
+        finally:
+            results.flush()
+        return
 
-    # if we update, get the latest date we had data for
-    # if we had no data just use the given start_date
-    if update:
-        # get the last date entry for this ticker and frequency
-        sql = '''SELECT
-        from_date,
-        thru_date
-        FROM stock_stats
-        WHERE ticker = %s
-        AND frequency = %s
-        AND bmg_factor_name = %s
-        AND interval = %s
-        ORDER BY from_date DESC
-        LIMIT 1'''
-        with connPool.getconn() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(sql, (ticker, frequency, factor_name, interval))
-                result = cursor.fetchone()
-                if result:
-                    start_date = result[0]
-            connPool.putconn(conn)
-        if verbose:
-            print('*** updating stock {} regression {} from {}'.format(ticker, factor_name, start_date))
-
-    running = True
-    while running:
-        (start_date, running) = run_regression_internal(stock_data,
-                            carbon_data,
-                            ff_data,
-                            rf_data,
-                            ticker,
-                            factor_name,
-                            start_date,
-                            end_date,
-                            interval,
-                            frequency,
-                            verbose,
-                            silent,
-                            store,
-                            index,
-                            total)
+    # the results of the ticker are written in bulk, by the writer thread of the sink
+    results = regression_results.ResultBuffer(store_regressions_into_db, sink=regression_results.get_result_sink())
+    try:
+        if engine == 'rolling':
+            run_rolling_regression(aligned, plan, ticker, factor_name, interval, frequency,
+                                   verbose, silent, store, index, total, diagnostics, results)
+            return
 
+        # stop at the first window that fails
+        for w in range(len(plan)):
+            if not run_regression_internal(aligned, plan, w, ticker, factor_name, end_date, interval, frequency,
+                                           verbose, silent, store, index, total, engine, diagnostics, results):
+                return
+    finally:
+        results.flush()
+    print('!! Done running regression on stock {} from {} to {} (next regression would end in {})'.format(
+        ticker, plan.next_from_date, end_date, plan.next_thru_date))
 
-def run_regression_internal(stock_data,
-                            carbon_data,
-                            ff_data,
-                            rf_data,
+
+def run_regression_internal(aligned,
+                            plan,
+                            w,
                             ticker,
                             factor_name,
-                            start_date,
                             end_date,
                             interval,
                             frequency,
@@ -224,65 +553,17 @@ def run_regression_internal(stock_data,
                             silent,
                             store,
                             index,
-                            total):
-    if frequency == 'DAILY':
-        freq = 'D'
-        if interval == 0:
-            interval = 730
-        interval_dt = relativedelta(days=interval)
-        interval_freq = relativedelta(days=1)
-    elif frequency == 'MONTHLY':
-        freq = 'M'
-        if interval == 0:
-            interval = 60
-        interval_dt = relativedelta(months=interval)
-        interval_freq = relativedelta(months=1)
-    else:
-        raise Exception("Unsupported frequency: {}".format(frequency))
-
-    # check we have data or some of the code below will throw an exception
-    if stock_data is None or stock_data.empty:
-        print('No stock data for {} !'.format(ticker))
-        return (None, False)
-
-    if carbon_data is None or carbon_data.empty:
-        print('No carbon_data !')
-        return (None, False)
-
-    if ff_data is None or ff_data.empty:
-        print('No ff_data !')
-        return (None, False)
-
-    if rf_data is None or rf_data.empty:
-        print('No rf_data !')
-        return (None, False)
-
-
+                            total,
+                            engine=regression_engine.DEFAULT_ENGINE,
+                            diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS,
+                            results=None):
+    # run the regression of the window w of the plan, returns False when it failed,
+    # the result is added to the results buffer when storing
+    (start_date, r_end_date) = plan.window_dates(w)
     try:
-        if start_date:
-            start_date = pd.Period(start_date, freq=freq).end_time.date()
-            start_date = factor_regression.parse_date('Start', start_date)
-        else:
-            # use the common start date of all series:
-            start_date = max(min(stock_data.index), min(
-                carbon_data.index), min(ff_data.index), min(rf_data.index))
-
-        if end_date:
-            end_date = pd.Period(end_date, freq=freq).end_time.date()
-            end_date = factor_regression.parse_date('End Date', end_date)
-        else:
-            # use the common end date of all series:
-            end_date = min(max(stock_data.index), max(
-                carbon_data.index), max(ff_data.index), max(rf_data.index))
-        r_end_date = start_date+interval_dt
-        r_end_date = pd.Period(r_end_date, freq=freq).end_time.date()
-        if r_end_date > end_date:
-            print('!! Done running regression on stock {} from {} to {} (next regression would end in {})'.format(
-                ticker, start_date, end_date, r_end_date))
-            return (None, False)
-        start_date += datetime.timedelta(days=1)
-        start_date, r_end_date, data_start_date, data_end_date, model_output, coef_df_simple = factor_regression.run_regression(
-            stock_data, carbon_data, ff_data, rf_data, ticker, start_date, end_date=r_end_date, verbose=verbose, silent=silent)
+        start_date, r_end_date, data_start_date, data_end_date, model_output, result = factor_regression.run_regression_aligned(
+            aligned, ticker, start_date, end_date=r_end_date, verbose=verbose, silent=silent,
+            engine=engine, diagnostics=diagnostics, window=(plan.lo[w], plan.hi[w]))
         if verbose:
             print("-- {} ran regression start={} end={} data_start={} data_end={} wanted_end={}".format(
                 ticker, start_date, r_end_date, data_start_date, data_end_date, end_date))
@@ -290,70 +571,448 @@ def run_regression_internal(stock_data,
         print('!! Error running regression on stock {} from {} to {}: {}'.format(
             ticker, start_date, end_date, e))
         traceback.print_tb(e.__traceback__)
-        return (None, False)
+        return False
     except ValueError as e:
         print('!! Error running regression on stock {} from {} to {}: {}'.format(
             ticker, start_date, end_date, e))
         traceback.print_tb(e.__traceback__)
-        return (None, False)
+        return False
 
     if model_output is False:
         print('!! Error running regression on stock {} from {} to {}'.format(
             ticker, start_date, end_date))
-        return (None, False)
+        return False
 
     # stop running when the data_end_date is > end_date (we no longer have enough data)
     if data_end_date > end_date:
         print('!! Finished running regression on stock {} from {} to {} (data ends in {})'.format(
             ticker, start_date, end_date, data_end_date))
-        return (None, False)
+        return False
 
     if store:
         print('[{} / {}] Ran {} - {} regression for {} from {} to {} ...'.format(index+1, total, frequency, interval,
             ticker, start_date, r_end_date))
-        # store results in the DB
-        fields = ['Constant', 'BMG', 'Mkt-RF', 'SMB', 'HML', 'WML',
-                  'Jarque-Bera', 'Breusch-Pagan', 'Durbin-Watson', 'R Squared']
-        index_to_sql_dict = {
-            'std err': '_std_error',
-            't': '_t_stat',
-            'P>|t|': '_p_gt_abs_t',
-        }
-        sql_params = {
-            'ticker': ticker,
-            'frequency': frequency,
-            'bmg_factor_name': factor_name,
-            'from_date': start_date,
-            'thru_date': r_end_date,
-            'data_from_date': data_start_date,
-            'data_thru_date': data_end_date,
-            'interval': interval,
-        }
-        for index, row in coef_df_simple.iterrows():
-            for f in fields:
-                sql_field = f.lower().replace(' ', '_').replace('-', '_')
-                if index != 'coef':
-                    sql_field += index_to_sql_dict[index]
-                if row[f] is not None and row[f] != '':
-                    sql_params[sql_field] = row[f]
-        store_regression_into_db(sql_params)
-
-    # setup the new interval, note we can't use recursion as
-    # there are too many steps
-    start_date += interval_freq
-    start_date -= datetime.timedelta(days=1)
-    return (start_date, True)
-
-
-def run(index, total, stocks, args, carbon_data, ff_data, rf_data):
+        regression_results.fill_keys(result, ticker, frequency, factor_name, interval,
+                                     start_date, r_end_date, data_start_date, data_end_date)
+        results.append(result)
+
+    return True
+
+
+def run_batched_regressions(tickers,
+                            factor_name,
+                            start_date,
+                            end_date,
+                            interval,
+                            frequency='MONTHLY',
+                            carbon_data=None,
+                            ff_data=None,
+                            rf_data=None,
+                            update=False,
+                            verbose=False,
+                            store=False,
+                            diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS,
+                            panel=None):
+    # Cross-sectional mode: the excess returns of all the tickers are stacked
+    # into one matrix and every window is solved once for all the tickers
+    # that share the same missing-data pattern.
+    # interval can be a list, the stocks are then loaded once for all the intervals.
+    # factor_name can be a list, panel is then the dict of the panels by factor name,
+    # the stocks are also loaded once for all the factors.
+    intervals = window_planner.get_intervals(frequency, interval)
+    panels = get_factor_panels(factor_name, frequency=frequency, carbon_data=carbon_data,
+                               ff_data=ff_data, rf_data=rf_data, verbose=verbose, panel=panel)
+    if not panels:
+        return
+
+    all_returns = []
+    for ticker in tickers:
+        returns = load_stock_returns(ticker, frequency=frequency)
+        if returns is not None:
+            all_returns.append((ticker, returns))
+
+    # with update, the start dates of all the tickers from one query
+    last_starts = {}
+    if update:
+        last_starts = update_planner.load_regression_watermarks([t for (t, _) in all_returns], list(panels), intervals,
+                                                                frequency=frequency)
+    results = regression_results.ResultBuffer(store_regressions_into_db, sink=regression_results.get_result_sink())
+    for (factor_name, panel) in panels.items():
+        stocks = stack_stock_returns(panel, all_returns)
+        names = stocks['names']
+        for interval in intervals:
+            windows = {}
+            for j in range(len(names)):
+                t_start = start_date
+                if update:
+                    t_start = last_starts.get((names[j], factor_name, interval)) or start_date
+                (plan, _) = plan_regression_windows(stocks['aligned'][j], t_start, end_date, interval, frequency)
+                for window in plan.windows():
+                    windows.setdefault(window, []).append(j)
+            print('*** Running {} batched {} {} - {} windows for {} tickers ...'.format(
+                len(windows), factor_name, frequency, interval, len(names)))
+            run_batched_windows(panel, stocks, windows, factor_name, interval, frequency, verbose, store, diagnostics, results)
+    results.flush()
+    results.sink.drain()
+
+
+def stack_stock_returns(panel, all_returns):
+    # align the (ticker, returns) on the panel and stack them, one column per ticker with data
+    dates = panel.dates
+    names = []
+    aligned_stocks = []
+    y_all = np.full((len(panel), len(all_returns)), np.nan)
+    present = np.zeros((len(panel), len(all_returns)), dtype=bool)
+    first_date = []
+    last_date = []
+    for (ticker, returns) in all_returns:
+        aligned = panel.align(returns)
+        rows = aligned.rows
+        if len(rows) == 0:
+            print('!! No data for stock {} overlapping the ff_factor and carbon_data'.format(ticker))
+            continue
+        j = len(names)
+        names.append(ticker)
+        aligned_stocks.append(aligned)
+        y_all[rows, j] = aligned.y
+        present[rows, j] = True
+        first_date.append(dates[rows.min()])
+        last_date.append(dates[rows.max()])
+
+    m = len(names)
+    return {
+        'names': np.array(names, dtype=object),
+        'aligned': aligned_stocks,
+        'y': y_all[:, :m],
+        'present': present[:, :m],
+        'first_date': np.array(first_date, dtype='datetime64[ns]'),
+        'last_date': np.array(last_date, dtype='datetime64[ns]'),
+    }
+
+
+def run_batched_windows(panel, stocks, windows, factor_name, interval, frequency, verbose, store, diagnostics, results):
+    # solve the windows {(from, thru): [stock columns]} of one interval for the stacked stocks
+    dates = panel.dates
+    x_all = panel.exog
+    exog_names = panel.exog_names
+    # outlier filter of regression_input_output applied on the factors
+    x_ok = panel.exog_ok
+    # regression_input_output requires more rows than columns (y + factors) + 10
+    min_obs = len(panel.factor_columns) + 1 + 10
+    names = stocks['names']
+    y_all = stocks['y']
+    present = stocks['present']
+    first_date = stocks['first_date']
+    last_date = stocks['last_date']
+    active = np.ones(len(names), dtype=bool)
+
+    for (w_start, w_end) in sorted(windows):
+        cols = np.array([j for j in windows[(w_start, w_end)] if active[j]], dtype=int)
+        if len(cols) == 0:
+            continue
+        w_start64 = np.datetime64(w_start, 'ns')
+        w_end64 = np.datetime64(w_end, 'ns')
+        lo = np.searchsorted(dates, w_start64, side='left')
+        hi = np.searchsorted(dates, w_end64, side='right')
+        y = y_all[lo:hi, cols]
+        x = x_all[lo:hi]
+        mask = present[lo:hi, cols] & (np.abs(y) < 0.5) & x_ok[lo:hi, None]
+
+        # a ticker stops at its first window that factor_regression would reject
+        ok = (w_start64 < last_date[cols]) & (w_end64 > first_date[cols])
+        ok &= present[lo:hi, cols].sum(axis=0) >= 20
+        ok &= mask.sum(axis=0) > min_obs
+        for j in cols[~ok]:
+            print('!! Finished running regression on stock {} from {} (not enough data for the window to {})'.format(
+                names[j], w_start, w_end))
+        active[cols[~ok]] = False
+        cols = cols[ok]
+        if len(cols) == 0:
+            continue
+        y = y[:, ok]
+        mask = mask[:, ok]
+
+        res = regression_engine.fit_ols_masked(y, x, mask, exog_names=exog_names)
+        if verbose:
+            print('-- window {} - {}: {} tickers'.format(w_start, w_end, len(cols)))
+        if not store:
+            continue
+        coef_tables = np.stack([res.params, res.bse, res.tvalues, res.pvalues])
+        window_diagnostics = regression_diagnostics.masked_diagnostics(res.resid, x, mask, mode=diagnostics)
+        records = regression_results.new_records(len(cols), exog_names=exog_names)
+        regression_results.fill_stats(records, exog_names, coef_tables, res.rsquared, diagnostics=window_diagnostics)
+        regression_results.fill_keys(records, names[cols], frequency, factor_name, interval, w_start, w_end,
+                                     np.maximum(w_start64, first_date[cols]),
+                                     np.minimum(w_end64, last_date[cols]))
+        results.append(records)
+
+
+def run_rolling_regression(aligned,
+                           plan,
+                           ticker,
+                           factor_name,
+                           interval,
+                           frequency,
+                           verbose,
+                           silent,
+                           store,
+                           index,
+                           total,
+                           diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS,
+                           results=None):
+    # Same windows as looping over run_regression_internal, but all the windows
+    # are fitted from prefix sums of the cross products of the aligned data
+    # (see regression_engine.rolling_ols)
+    (dates, y, x, mask) = (aligned.dates, aligned.y, aligned.x, aligned.mask)
+    exog_names = aligned.exog_names
+    min_obs = len(exog_names) + 10
+
+    windows = plan.windows()
+    if not windows:
+        print('!! Done running regression on stock {} (no complete interval, next regression would end in {})'.format(
+            ticker, plan.next_thru_date))
+        return
+    w_start = plan.from_dates.astype(dates.dtype)
+    w_end = plan.thru_dates.astype(dates.dtype)
+    (lo, hi) = (plan.lo, plan.hi)
+    counts = np.concatenate([[0], np.cumsum(mask)])
+
+    # stop at the first window factor_regression would reject, like the loop does
+    ok = (w_start < dates[-1]) & (w_end > dates[0]) & (hi - lo >= 20)
+    ok &= counts[hi] - counts[lo] > min_obs
+    n_windows = len(windows) if ok.all() else int(np.argmin(ok))
+    if n_windows < len(windows):
+        print('!! Finished running regression on stock {} from {} (not enough data for the window to {})'.format(
+            ticker, windows[n_windows][0], windows[n_windows][1]))
+    if n_windows == 0:
+        return
+    lo = lo[:n_windows]
+    hi = hi[:n_windows]
+
+    # the cumulative sums are shared by all the intervals of the ticker
+    res = regression_engine.rolling_ols(y, x, mask, lo, hi, exog_names=exog_names,
+                                        cross_products=aligned.cross_products())
+    coef_tables = np.stack([res.params, res.bse, res.tvalues, res.pvalues])
+    window_diagnostics = None
+    if store:
+        window_diagnostics = regression_diagnostics.rolling_diagnostics(
+            y, x, mask, lo, hi, res.params, mode=diagnostics)
+    records = regression_results.new_records(n_windows, exog_names=exog_names)
+    regression_results.fill_stats(records, exog_names, coef_tables, res.rsquared, diagnostics=window_diagnostics)
+    regression_results.fill_keys(records, ticker, frequency, factor_name, interval,
+                                 plan.from_dates[:n_windows], plan.thru_dates[:n_windows],
+                                 np.maximum(w_start[:n_windows], dates[0]),
+                                 np.minimum(w_end[:n_windows], dates[-1]))
+    if verbose or not silent:
+        for w in range(n_windows):
+            print('Running {} - {} regression using data from {} to {} -- data has {} entries'.format(
+                records['from_date'][w], records['thru_date'][w],
+                records['data_from_date'][w], records['data_thru_date'][w], hi[w] - lo[w]))
+            print(regression_results.summary_frame(records, w).to_string())
+    if store:
+        print('[{} / {}] Ran {} {} - {} regressions for {} from {} to {} ...'.format(index+1, total, n_windows, frequency, interval,
+            ticker, windows[0][0], windows[n_windows - 1][1]))
+        results.append(records)
+
+
+def run_nested_model_regressions(aligned,
+                                 plan,
+                                 models,
+                                 ticker,
+                                 factor_name,
+                                 interval,
+                                 frequency,
+                                 verbose,
+                                 silent,
+                                 store,
+                                 index,
+                                 total,
+                                 results=None):
+    # Fit all the nested models of each window from one QR decomposition
+    # (see regression_engine.fit_nested_ols), on the same windows and rows
+    # as the stock_stats regressions
+    exog_names = nested_models.ordered_exog_names(models)
+    order = aligned.panel.column_order(exog_names)
+    sizes = nested_models.model_sizes(models)
+    min_obs = sizes[-1] + 10
+    dates = aligned.dates
+    counts = np.concatenate([[0], np.cumsum(aligned.mask)])
+
+    for w in range(len(plan)):
+        (start_date, r_end_date) = plan.window_dates(w)
+        (lo, hi) = (plan.lo[w], plan.hi[w])
+        w_start = plan.from_dates[w].astype(dates.dtype)
+        w_end = plan.thru_dates[w].astype(dates.dtype)
+        # stop at the first window factor_regression would reject
+        if not (w_start < dates[-1] and w_end > dates[0] and hi - lo >= 20 and counts[hi] - counts[lo] > min_obs):
+            print('!! Finished running regression on stock {} from {} (not enough data for the window to {})'.format(
+                ticker, start_date, r_end_date))
+            return
+        fits = nested_models.fit_window(aligned, lo, hi, order, sizes, exog_names)
+        data_start_date = max(w_start, dates[0])
+        data_end_date = min(w_end, dates[-1])
+        if verbose or not silent:
+            print('Running {} - {} nested regressions using data from {} to {} -- data has {} entries'.format(
+                start_date, r_end_date, data_start_date.astype('datetime64[D]'), data_end_date.astype('datetime64[D]'), hi - lo))
+            for ((model_name, _), fit) in zip(models, fits):
+                print('{}: R Squared {:.4f}, F {:.4f} (P>F {:.4f})'.format(model_name, fit.rsquared, fit.fvalue, fit.f_pvalue))
+                print(pd.DataFrame(fit.coef_table(), index=regression_engine.COEF_TABLE_INDEX,
+                                   columns=fit.exog_names).to_string())
+        if store:
+            print('[{} / {}] Ran {} - {} nested regressions for {} from {} to {} ...'.format(index+1, total, frequency, interval,
+                ticker, start_date, r_end_date))
+            results.append(nested_models.model_records(ticker, frequency, factor_name, interval, start_date, r_end_date,
+                                                       data_start_date, data_end_date, models, fits))
+
+
+def get_regressions_missing_diagnostics(ticker, factor_name, interval, frequency):
+    sql = '''SELECT from_date, thru_date
+        FROM stock_stats
+        WHERE ticker = %s
+        AND frequency = %s
+        AND bmg_factor_name = %s
+        AND interval = %s
+        AND durbin_watson IS NULL
+        ORDER BY from_date'''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (ticker, frequency, factor_name, interval))
+            result = cursor.fetchall()
+    return result
+
+
+def store_diagnostics_into_db(ticker, factor_name, interval, frequency, windows, window_diagnostics):
+    # in stock_stats and the same rows of stock_stats_latest
+    sql = '''UPDATE {} SET
+        jarque_bera = %s,
+        jarque_bera_p_gt_abs_t = %s,
+        breusch_pagan = %s,
+        breusch_pagan_p_gt_abs_t = %s,
+        durbin_watson = %s
+        WHERE ticker = %s
+        AND frequency = %s
+        AND bmg_factor_name = %s
+        AND from_date = %s
+        AND thru_date = %s
+        AND interval = %s'''
+    params = []
+    for w, (from_date, thru_date) in enumerate(windows):
+        values = regression_diagnostics.column_diagnostics(window_diagnostics, w)
+        params.append([values[f] for f in regression_diagnostics.DIAGNOSTICS_FIELDS] +
+                      [ticker, frequency, factor_name, from_date, thru_date, interval])
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            # like store_regressions_into_db, so a writer cannot move the series to a later
+            # thru_date between the two updates
+            lock_latest_stats(cursor, [(ticker, frequency, factor_name)])
+            for table in ['stock_stats', 'stock_stats_latest']:
+                psycopg2.extras.execute_batch(cursor, sql.format(table), params)
+            db.mark_views_stale(cursor)
+
+
+def backfill_diagnostics(ticker,
+                         factor_name,
+                         interval,
+                         frequency='MONTHLY',
+                         carbon_data=None,
+                         ff_data=None,
+                         rf_data=None,
+                         diagnostics='fast',
+                         verbose=False,
+                         panel=None):
+    # fill the diagnostics columns of the stock_stats rows stored with --diagnostics none,
+    # the windows are refitted from the stored from / thru dates, interval can be a list
+    if diagnostics == 'none':
+        diagnostics = regression_diagnostics.DEFAULT_DIAGNOSTICS
+    missing = []
+    for interval in window_planner.get_intervals(frequency, interval):
+        windows = get_regressions_missing_diagnostics(ticker, factor_name, interval, frequency)
+        if windows:
+            missing.append((interval, windows))
+    if not missing:
+        if verbose:
+            print('*** no missing diagnostics for {}'.format(ticker))
+        return
+    if panel is None:
+        panel = load_factor_panel(factor_name, frequency=frequency, carbon_data=carbon_data,
+                                  ff_data=ff_data, rf_data=rf_data)
+        if panel is None:
+            return
+    returns = load_stock_returns(ticker, frequency=frequency)
+    if returns is None:
+        return
+
+    aligned = panel.align(returns)
+    (y, x, mask) = (aligned.y, aligned.x, aligned.mask)
+    for (interval, windows) in missing:
+        lo = np.searchsorted(aligned.dates, np.array([np.datetime64(w[0], 'ns') for w in windows]), side='left')
+        hi = np.searchsorted(aligned.dates, np.array([np.datetime64(w[1], 'ns') for w in windows]), side='right')
+        res = regression_engine.rolling_ols(y, x, mask, lo, hi, cross_products=aligned.cross_products())
+        window_diagnostics = regression_diagnostics.rolling_diagnostics(
+            y, x, mask, lo, hi, res.params, mode=diagnostics)
+        store_diagnostics_into_db(ticker, factor_name, interval, frequency, windows, window_diagnostics)
+        print('*** backfilled the diagnostics of {} {} - {} regressions for {}'.format(len(windows), frequency, interval, ticker))
+
+
+def share_factor_panels(panels):
+    # publish the panels once in shared memory for the worker processes, returns
+    # the shared memory blocks to unlink after the run and the descriptors for new_job,
+    # the panels of the panel_cache stay shared between the runs
+    blocks = []
+    descriptors = []
+    for panel in panels.values():
+        descriptor = panel_cache.share(panel) if panel_cache is not None else None
+        if descriptor is None:
+            (shm, descriptor) = panel.share()
+            blocks.append(shm)
+        descriptors.append(descriptor)
+    return (blocks, descriptors)
+
+
+def release_factor_panels(blocks):
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+def new_job(args, descriptors, ledger=None):
+    # what the worker processes need for the tasks of a run, sent with each task so a
+    # pool can be reused by several runs, the descriptors are small and the panels are not copied
+    return ('{}-{}'.format(os.getpid(), next(job_ids)), args, descriptors, ledger)
+
+
+def set_worker_job(job):
+    # worker side: set the args, panels and ledger of the run of the task, the shared
+    # factor panels are attached once and kept while the following runs use them
+    global worker_job_id, worker_args, worker_panels, worker_ledger
+    (job_id, args, descriptors, ledger) = job
+    if job_id == worker_job_id:
+        return
+    names = {descriptor['shm_name'] for descriptor in descriptors}
+    for name in [name for name in attached_panels if name not in names]:
+        attached_panels.pop(name)._shm.close()
+    worker_panels = {}
+    for descriptor in descriptors:
+        if descriptor['shm_name'] not in attached_panels:
+            attached_panels[descriptor['shm_name']] = factor_panel.FactorPanel.attach(descriptor)
+        worker_panels[descriptor['factor_name']] = attached_panels[descriptor['shm_name']]
+    (worker_job_id, worker_args, worker_ledger) = (job_id, args, ledger)
+
+
+def run(index, total, stocks, args=None, panels=None, ledger=None, starts=None):
+    # args, panels and ledger default to the ones of the worker process set by set_worker_job,
+    # starts: the start dates planned for -u (see plan_run_updates)
+    if args is None:
+        args = worker_args
+    if panels is None:
+        panels = worker_panels
+    if ledger is None:
+        ledger = worker_ledger
     stock_name = stocks.item(0)
     print('*** [{} / {}] Running regression for {} ...'.format(index+1, total, stock_name))
     # print('*** with args: {}'.format(args))
-    # print('*** with carbon_data: {}'.format(carbon_data))
-    # print('*** with ff_data: {}'.format(ff_data))
-    # print('*** with rf_data: {}'.format(rf_data))
     return run_regression(ticker=stock_name,
-                          factor_name=args.factor_name,
+                          factor_name=list(panels),
                           start_date=args.start_date,
                           end_date=args.end_date,
                           interval=args.interval,
@@ -362,46 +1021,259 @@ def run(index, total, stocks, args, carbon_data, ff_data, rf_data):
                           verbose=args.verbose,
                           store=(not args.dryrun),
                           silent=(not args.dryrun),
-                          carbon_data=carbon_data,
-                          ff_data=ff_data,
-                          rf_data=rf_data,
+                          panel=panels,
                           index=index,
-                          total=total)
+                          total=total,
+                          engine=args.engine,
+                          diagnostics=args.diagnostics,
+                          models=get_models(args),
+                          ledger=ledger,
+                          starts=starts)
 
 
-def store_regression_into_db(sql_params):
-    del_sql = '''DELETE FROM stock_stats
-    WHERE ticker = %s
-    and frequency = %s
-    and bmg_factor_name = %s
-    and from_date = %s
-    and thru_date = %s
-    and interval = %s;'''
-    placeholder = ", ".join(["%s"] * len(sql_params))
-    stmt = "INSERT INTO stock_stats ({columns}) values ({values});".format(
-        columns=",".join(sql_params.keys()),
-        values=placeholder)
-    with connPool.getconn() as conn:
+def get_models(args):
+    # nested model specs when running with --nested_models
+    if not args.nested_models:
+        return None
+    return nested_models.model_specs(bond_factors=args.bond_factors, additional_factors=args.additional_factors)
+
+
+def get_factor_names(args):
+    # factor names given by -n, or all the carbon_risk_factor series with --all_factors
+    if args.all_factors:
+        return load_factor_names_from_db(frequency=args.frequency)
+    return args.factor_name
+
+
+def load_run_tickers(args):
+    # tickers of the -f file or of the stocks table, only the ones of --shard i/n
+    if args.file:
+        tickers = [s.item(0) for s in load_stocks_csv(args.file)]
+    else:
+        tickers = list(get_stocks.load_stocks_defined_in_db())
+    return job_ledger.shard_tickers(tickers, args.shard)
+
+
+def run_job(job, index, total, stocks, starts=None, ledger=None):
+    # pool task of a run, ledger: the ledger of the ticker with its done tasks (see
+    # JobLedger.ticker_ledgers), the job only carries the tracker of the run
+    set_worker_job(job)
+    return run(index, total, stocks, ledger=ledger, starts=starts)
+
+
+def plan_run_updates(args, tickers, panels, ledger):
+    # with -u: {ticker: {(factor_name, interval): start date}} of the tickers having regressions
+    # to run, from one query for all the tickers, the regressions up to date are done in the
+    # ledger without starting a task; None without -u
+    if not args.update:
+        return None
+    intervals = window_planner.get_intervals(args.frequency, args.interval)
+    plan = update_planner.plan_regression_updates(tickers, panels, intervals, frequency=args.frequency,
+                                                  start_date=args.start_date, end_date=args.end_date,
+                                                  table=('stock_model_stats' if args.nested_models else 'stock_stats'))
+    if ledger is not None:
+        ledger.mark_done([(t, f, i) for t in tickers for f in panels for i in intervals
+                          if (f, i) not in plan.get(t, {})])
+    return plan
+
+
+def run_queue_worker(args, panels):
+    # claim batches of the tasks queued by --enqueue with the same command until none is left,
+    # the factors and intervals claimed for a ticker are run from one load of the stock
+    name = job_ledger.job_name('get_regressions', args, LEDGER_FIELDS)
+    worker = job_ledger.worker_id()
+    models = get_models(args)
+    n = 0
+    with job_ledger.Heartbeat(worker):
+        while True:
+            tasks = job_ledger.claim_tasks(name, args.frequency, worker)
+            if not tasks:
+                break
+            tickers = [(ticker, set(claimed)) for (ticker, claimed) in itertools.groupby(tasks, key=lambda task: task[0])]
+            for (i, (ticker, claimed)) in enumerate(tickers):
+                ledger = job_ledger.JobLedger(name, args.frequency, claimed=claimed)
+                # the factors without data were left out of the panels of the run
+                missing = {task for task in claimed if task[1] not in panels}
+                for task in sorted(missing):
+                    print('!! no factor data for {}, task {} failed'.format(task[1], task))
+                    ledger.set_status(*task, job_ledger.FAILED)
+                n += len(missing)
+                claimed -= missing
+                if not claimed:
+                    continue
+                factor_names = sorted({f for (_, f, _) in claimed})
+                print('*** {} running {} tasks for {} ...'.format(worker, len(claimed), ticker))
+                try:
+                    run_regression(ticker=ticker,
+                                   index=i,
+                                   total=len(tickers),
+                                   factor_name=factor_names,
+                                   start_date=args.start_date,
+                                   end_date=args.end_date,
+                                   interval=sorted({i for (_, _, i) in claimed}),
+                                   frequency=args.frequency,
+                                   update=args.update,
+                                   verbose=args.verbose,
+                                   store=True,
+                                   silent=True,
+                                   panel={f: panels[f] for f in factor_names},
+                                   engine=args.engine,
+                                   diagnostics=args.diagnostics,
+                                   models=models,
+                                   ledger=ledger)
+                    status = job_ledger.DONE
+                except Exception:
+                    traceback.print_exc()
+                    status = job_ledger.FAILED
+                # the claimed tasks not run (eg: no stock data, or after a failure) are not left running
+                for task in claimed - ledger.done:
+                    ledger.set_status(*task, status)
+                n += len(claimed)
+    print('*** {} done, ran {} tasks'.format(worker, n))
+    return n
+
+
+def run_queue_worker_process(job):
+    # queue worker of a pool process
+    set_worker_job(job)
+    return run_queue_worker(worker_args, dict(worker_panels))
+
+
+def open_run_ledger(args, tickers, factor_names):
+    # job ledger of the run, None for a dry run, with --resume the tasks done are kept
+    if args.dryrun:
+        return None
+    return job_ledger.open_ledger(job_ledger.job_name('get_regressions', args, LEDGER_FIELDS),
+                                  args.frequency, tickers, factor_names,
+                                  window_planner.get_intervals(args.frequency, args.interval),
+                                  resume=args.resume)
+
+
+def load_run_factor_panels(args):
+    # {factor_name: panel} of the run, with the extra factors of the nested models
+    extra_data = None
+    if args.nested_models:
+        extra_data = load_extra_factors(frequency=args.frequency, bond_factors=args.bond_factors,
+                                        additional_factors=args.additional_factors)
+    return load_factor_panels(get_factor_names(args), frequency=args.frequency, extra_data=extra_data)
+
+
+def replace_records_in_db(table, records, key_fields):
+    # replace the rows of table matching the key_fields of the records, in one transaction
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            bulk_writer.replace_rows(cursor, table, list(records.dtype.names), key_fields,
+                                     regression_results.to_rows(records))
+
+
+def series_lock_key(series):
+    # advisory lock key of a (ticker, frequency, bmg_factor_name) series
+    return zlib.crc32(' '.join(series).encode('utf-8'))
+
+
+def lock_latest_stats(cursor, series):
+    # lock the series until the end of the transaction, in the same order for all the writers
+    # so they cannot wait on each other, returns {series: last thru_date in stock_stats_latest}
+    cursor.execute('''SELECT pg_advisory_xact_lock(k)
+        FROM (SELECT k FROM unnest(%s::bigint[]) k ORDER BY k) l''',
+                   (sorted(set(series_lock_key(s) for s in series)),))
+    cursor.execute('''SELECT ticker, frequency, bmg_factor_name, max(thru_date)
+        FROM stock_stats_latest
+        WHERE (ticker, frequency, bmg_factor_name) IN (SELECT * FROM unnest(%s::text[], %s::text[], %s::text[]))
+        GROUP BY ticker, frequency, bmg_factor_name''', [list(c) for c in zip(*series)])
+    return {(t, f, n): d for (t, f, n, d) in cursor.fetchall()}
+
+
+def update_latest_stats(cursor, columns, rows, last_dates):
+    # keep the stock_stats rows of the last thru_date of each series in stock_stats_latest: the rows
+    # of the series moved to a later thru_date are deleted and the rows of the last thru_date upserted,
+    # last_dates are the last thru_dates before the rows from lock_latest_stats
+    series_indexes = [columns.index(f) for f in regression_results.SERIES_FIELDS]
+    thru = columns.index('thru_date')
+    ends = dict(last_dates)
+    for row in rows:
+        series = tuple(row[i] for i in series_indexes)
+        if series not in ends or row[thru] > ends[series]:
+            ends[series] = row[thru]
+    moved = [s + (d,) for (s, d) in ends.items() if s in last_dates and d > last_dates[s]]
+    if moved:
+        cursor.execute('''DELETE FROM stock_stats_latest l
+            USING unnest(%s::text[], %s::text[], %s::text[], %s::date[]) m(ticker, frequency, bmg_factor_name, thru_date)
+            WHERE l.ticker = m.ticker
+            AND l.frequency = m.frequency
+            AND l.bmg_factor_name = m.bmg_factor_name
+            AND l.thru_date < m.thru_date''', [list(c) for c in zip(*moved)])
+    latest = [row for row in rows if row[thru] == ends[tuple(row[i] for i in series_indexes)]]
+    bulk_writer.upsert_rows(cursor, 'stock_stats_latest', columns, regression_results.PRIMARY_KEY_FIELDS, latest)
+
+
+def store_regressions_into_db(records):
+    # regression_results records into stock_stats, with stock_stats_latest in the same transaction
+    columns = list(records.dtype.names)
+    rows = regression_results.to_rows(records)
+    if not rows:
+        return
+    series_indexes = [columns.index(f) for f in regression_results.SERIES_FIELDS]
+    series = sorted(set(tuple(row[i] for i in series_indexes) for row in rows))
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(
-                del_sql, (
-                    sql_params['ticker'],
-                    sql_params['frequency'],
-                    sql_params['bmg_factor_name'],
-                    sql_params['from_date'],
-                    sql_params['thru_date'],
-                    sql_params['interval']))
-            cursor.execute(stmt, list(sql_params.values()))
-            cursor.execute("COMMIT;")
-        connPool.putconn(conn)
-
-
-def main(args):
-    multiprocessing.set_start_method('spawn')
+            last_dates = lock_latest_stats(cursor, series)
+            bulk_writer.replace_rows(cursor, 'stock_stats', columns, regression_results.KEY_FIELDS, rows)
+            update_latest_stats(cursor, columns, rows, last_dates)
+            db.mark_views_stale(cursor)
+
+
+def store_model_stats_into_db(records):
+    # nested_models records into stock_model_stats
+    replace_records_in_db('stock_model_stats', records, nested_models.MODEL_KEY_FIELDS)
+
+
+def main(args, pool=None):
+    # pool: the worker processes of a long running process, used instead of starting -c processes
     start_time = datetime.datetime.now()
-    if args.ticker:
+    if args.backfill_diagnostics:
+        panels = load_factor_panels(get_factor_names(args), frequency=args.frequency)
+        if args.ticker:
+            stocks = [args.ticker]
+        elif args.file:
+            stocks = [s.item(0) for s in load_stocks_csv(args.file)]
+        else:
+            stocks = list(get_stocks.load_stocks_defined_in_db())
+        for (factor_name, panel) in panels.items():
+            for stock_name in stocks:
+                backfill_diagnostics(stock_name,
+                                     factor_name=factor_name,
+                                     interval=args.interval,
+                                     frequency=args.frequency,
+                                     panel=panel,
+                                     diagnostics=args.diagnostics,
+                                     verbose=args.verbose)
+    elif args.enqueue:
+        tickers = load_run_tickers(args)
+        n = job_ledger.enqueue(job_ledger.job_name('get_regressions', args, LEDGER_FIELDS), args.frequency,
+                               tickers, get_factor_names(args),
+                               window_planner.get_intervals(args.frequency, args.interval))
+        print('*** {} tasks pending in the queue for {} tickers'.format(n, len(tickers)))
+        return
+    elif args.queue_worker:
+        panels = load_run_factor_panels(args)
+        if args.concurrency <= 1:
+            run_queue_worker(args, panels)
+        else:
+            (blocks, descriptors) = share_factor_panels(panels)
+            try:
+                with task_scheduler.process_pool(args.concurrency, pool) as pool:
+                    n = sum(pool.map(run_queue_worker_process, [new_job(args, descriptors)] * args.concurrency,
+                                     chunksize=1))
+                print('*** ran {} tasks'.format(n))
+            finally:
+                release_factor_panels(blocks)
+    elif args.ticker:
+        panels = load_run_factor_panels(args)
+        if not panels:
+            return
         run_regression(ticker=args.ticker,
-                       factor_name=args.factor_name,
+                       factor_name=list(panels),
                        start_date=args.start_date,
                        end_date=args.end_date,
                        interval=args.interval,
@@ -409,44 +1281,80 @@ def main(args):
                        update=args.update,
                        verbose=args.verbose,
                        store=(not args.dryrun),
-                       silent=(not args.dryrun))
+                       silent=(not args.dryrun),
+                       panel=panels,
+                       engine=args.engine,
+                       diagnostics=args.diagnostics,
+                       models=get_models(args))
+    elif args.batched:
+        panels = load_factor_panels(get_factor_names(args), frequency=args.frequency)
+        if not panels:
+            return
+        stocks = load_run_tickers(args)
+        run_batched_regressions(stocks,
+                                factor_name=list(panels),
+                                start_date=args.start_date,
+                                end_date=args.end_date,
+                                interval=args.interval,
+                                frequency=args.frequency,
+                                panel=panels,
+                                update=args.update,
+                                verbose=args.verbose,
+                                store=(not args.dryrun),
+                                diagnostics=args.diagnostics)
     elif args.file:
-        carbon_data = load_carbon_data_from_db(args.factor_name, frequency=args.frequency)
-        if carbon_data is None or carbon_data.empty:
-            print("No carbon data found for factor {} and frequency {}".format(args.factor_name, args.frequency))
+        panels = load_run_factor_panels(args)
+        if not panels:
             return
-        ff_data = load_ff_data_from_db(frequency=args.frequency)
-        rf_data = load_rf_data_from_db(frequency=args.frequency)
         stocks = load_stocks_csv(args.file)
+        if args.shard:
+            shard = set(job_ledger.shard_tickers([s.item(0) for s in stocks], args.shard))
+            stocks = [s for s in stocks if s.item(0) in shard]
+        ledger = open_run_ledger(args, [s.item(0) for s in stocks], list(panels))
+        if ledger is not None:
+            # only dispatch the tickers with tasks left
+            pending = set(ledger.pending_tickers([s.item(0) for s in stocks], list(panels),
+                                                 window_planner.get_intervals(args.frequency, args.interval)))
+            stocks = [s for s in stocks if s.item(0) in pending]
+        plan = plan_run_updates(args, [s.item(0) for s in stocks], panels, ledger)
+        if plan is not None:
+            stocks = [s for s in stocks if s.item(0) in plan]
         t = len(stocks)
-        with multiprocessing.Pool(processes=args.concurrency) as pool:
-            pool.starmap(run, zip(
-                range(0,t),
-                itertools.repeat(t),
-                stocks,
-                itertools.repeat(args),
-                itertools.repeat(carbon_data),
-                itertools.repeat(ff_data),
-                itertools.repeat(rf_data)
-            ))
+        # the longest histories are run first, the number of windows grows with the history
+        names = [s.item(0) for s in stocks]
+        costs = task_scheduler.history_costs(names, get_stocks.load_history_lengths_from_db(names, frequency=args.frequency))
+        # the panels are published once in shared memory instead of being pickled with each task
+        (blocks, descriptors) = share_factor_panels(panels)
+        try:
+            with task_scheduler.process_pool(args.concurrency, pool) as pool:
+                task_scheduler.run_longest_first(pool, run_job, list(zip(
+                    itertools.repeat(new_job(args, descriptors, ledger and ledger.tracker())),
+                    range(0,t),
+                    itertools.repeat(t),
+                    stocks,
+                    [plan and plan[n] for n in names],
+                    ledger.ticker_ledgers(names) if ledger is not None else itertools.repeat(None)
+                )), costs, args.concurrency)
+        finally:
+            release_factor_panels(blocks)
     elif args.bulk_regression:
-        carbon_data = load_carbon_data_from_db(args.factor_name, frequency=args.frequency)
-        # print(carbon_data)
-        ff_data = load_ff_data_from_db(frequency=args.frequency)
-        rf_data = load_rf_data_from_db(frequency=args.frequency)
-        stock_data = get_stocks.load_all_stocks_from_db()
-        # stock_data = input_function.convert_to_form_db(stock_data)
-        # stock_data['date'] = stock_data.index
-        # print(stock_data)
-        final_data = stock_data.join(carbon_data).join(ff_data).join(rf_data)
-        final_data = final_data.dropna()
-        bulk_regression_transformer(
-            final_data, ff_data.columns, rf_data.columns, args.factor_name, args.interval, frequency=args.frequency)
+        # the stocks are streamed once for all the factors, the FF and Rf series are shared
+        panels = load_factor_panels(get_factor_names(args), frequency=args.frequency)
+        if not panels:
+            return
+        run_bulk_regressions(panels, args, pool=pool)
     else:
-        carbon_data = load_carbon_data_from_db(args.factor_name, frequency=args.frequency)
-        ff_data = load_ff_data_from_db(frequency=args.frequency)
-        rf_data = load_rf_data_from_db(frequency=args.frequency)
-        stocks = get_stocks.load_stocks_defined_in_db()
+        panels = load_run_factor_panels(args)
+        if not panels:
+            return
+        stocks = load_run_tickers(args)
+        ledger = open_run_ledger(args, stocks, list(panels))
+        if ledger is not None:
+            stocks = ledger.pending_tickers(stocks, list(panels),
+                                            window_planner.get_intervals(args.frequency, args.interval))
+        plan = plan_run_updates(args, stocks, panels, ledger)
+        if plan is not None:
+            stocks = [s for s in stocks if s in plan]
         t = len(stocks)
         for i in range(0, t):
             stock_name = stocks[i]
@@ -454,26 +1362,28 @@ def main(args):
             run_regression(stock_name,
                            index=i,
                            total=t,
-                           factor_name=args.factor_name,
+                           factor_name=list(panels),
                            start_date=args.start_date,
                            end_date=args.end_date,
                            interval=args.interval,
                            frequency=args.frequency,
-                           carbon_data=carbon_data,
-                           ff_data=ff_data,
-                           rf_data=rf_data,
+                           panel=panels,
                            update=args.update,
                            verbose=args.verbose,
                            silent=(not args.dryrun),
-                           store=(not args.dryrun))
+                           store=(not args.dryrun),
+                           engine=args.engine,
+                           diagnostics=args.diagnostics,
+                           models=get_models(args),
+                           ledger=ledger,
+                           starts=plan and plan[stock_name])
     end_time = datetime.datetime.now()
     print("Total run time: ", end_time - start_time)
     # refresh the View tables in the DB
     db.refresh_views(verbose=True)
 
 
-# run
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--from_db", action='store_true',
                         help="import of tickers in the stocks table of the Database instead of using a CSV file, this is the default unless -t or -f is used")
@@ -487,10 +1397,12 @@ if __name__ == "__main__":
                         help="Sets the start date for the regression, must be in the YYYY-MM-DD format, defaults to the start date of all the data series for a given stock")
     parser.add_argument("-e", "--end_date",
                         help="Sets the end date for the regression, must be in the YYYY-MM-DD format, defaults to the last date of all the data series for a given stock")
-    parser.add_argument("-i", "--interval", default=0, type=int,
-                        help="Sets number of months for the regression interval, defaults to 60 months for MONTHLY frequency or 730 days for DAILY frequency")
-    parser.add_argument("-n", "--factor_name", default='DEFAULT',
-                        help="Sets the factor name of the carbon_risk_factor used")
+    parser.add_argument("-i", "--interval", default=[0], type=window_planner.parse_intervals,
+                        help="Sets number of months (or days for DAILY frequency) for the regression interval, defaults to 60 months for MONTHLY frequency or 730 days for DAILY frequency. Can be a comma separated list, eg: 730,365,180,90 to run all the intervals from the same stock data")
+    parser.add_argument("-n", "--factor_name", default=['DEFAULT'], nargs='+',
+                        help="Sets the factor name of the carbon_risk_factor used, can be several names (eg: -n DEFAULT XOP-SMOG) to run all of them from a single load of each stock")
+    parser.add_argument("--all_factors", action='store_true',
+                        help="Run the regressions for every factor name of the carbon_risk_factor series at the given frequency, instead of -n")
     parser.add_argument("--frequency", default='MONTHLY',
                         help="Frequency to use for the various series, eg: MONTHLY, DAILY")
     parser.add_argument("-u", "--update", action='store_true',
@@ -498,7 +1410,35 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action='store_true',
                         help="More verbose output")
     parser.add_argument("-b", "--bulk_regression", action='store_true',
-                        help="Run bulk regression that should run faster")
+                        help="Run bulk regression that should run faster, the tickers are split across -c processes")
+    parser.add_argument("--batched", action='store_true',
+                        help="Solve each regression window once for all the tickers (cross-sectional mode), used with -f or the stocks in the Database")
+    parser.add_argument("--engine", default=regression_engine.DEFAULT_ENGINE, choices=regression_engine.ENGINES,
+                        help="Regression engine to use, numpy (closed form, default), rolling (all the windows of a stock from cumulative sums) or statsmodels (reference engine for verification)")
+    parser.add_argument("--diagnostics", default=regression_diagnostics.DEFAULT_DIAGNOSTICS, choices=regression_diagnostics.DIAGNOSTICS_MODES,
+                        help="How to compute the Jarque-Bera, Breusch-Pagan and Durbin-Watson residual diagnostics: fast (default, in batch), full (statsmodels) or none (skip them, fill them later with --backfill_diagnostics)")
+    parser.add_argument("--backfill_diagnostics", action='store_true',
+                        help="Compute the missing residual diagnostics of the stored regressions for the stocks given by -t, -f or the Database, for the given factor name, frequency and interval")
+    parser.add_argument("--nested_models", action='store_true',
+                        help="Fit the nested CAPM, FF3, Carhart and Carhart + BMG models of each window from a single QR decomposition and store them in stock_model_stats, used with -t, -f or the stocks in the Database")
+    parser.add_argument("--bond_factors", action='store_true',
+                        help="With --nested_models, add a model with the bond_factor changes (rate, curve, high yield and BBB spreads)")
+    parser.add_argument("--additional_factors", nargs='+',
+                        help="With --nested_models, add a model with the given additional_factors series")
+    parser.add_argument("--resume", action='store_true',
+                        help="With -f or the stocks in the Database, only run the ticker, factor and interval tasks not done by the previous run of the same command, as recorded in the job_ledger table")
+    parser.add_argument("--enqueue", action='store_true',
+                        help="Queue the ticker, factor and interval tasks of -f or the stocks in the Database in the job_ledger table instead of running them, for the --queue_worker processes started with the same command")
+    parser.add_argument("--queue_worker", action='store_true',
+                        help="Run the tasks queued by --enqueue with the same command, on any number of hosts using the same DB, until none is left, with -c processes")
+    parser.add_argument("--shard", type=job_ledger.parse_shard,
+                        help="Only run the tickers of shard i/n (eg: 0/4), the same split on every host, for running without the queue")
     parser.add_argument("-c", "--concurrency", default=1, type=int,
                         help="Number of concurrent processes to run to speed up the regression generation over large datasets")
-    main(parser.parse_args())
+    return parser
+
+
+# run
+if __name__ == "__main__":
+    task_scheduler.set_start_method()
+    main(get_parser().parse_args())
@@ -5,14 +5,23 @@ import stock_price_function as spf
 import input_function
 import db
 from pg import DataError
-from decimal import Decimal
 import numpy as np
-import multiprocessing
 import itertools
+import traceback
+import task_scheduler
+import job_ledger
+import bulk_writer
+import update_planner
 
 
 connPool = db.get_db_connection_pool()
 
+# number of rows fetched at a time when streaming the stock_data
+STREAM_ITERSIZE = 10000
+
+# args identifying an import run in the job_ledger, with its tickers and frequency
+LEDGER_FIELDS = ['file', 'from_db', 'update', 'update_stocks_details', 'shard']
+
 
 def load_stocks_csv(filename):
     if not filename:
@@ -22,13 +31,17 @@ def load_stocks_csv(filename):
     return all_stock_data.values
 
 
-def import_stock(stock_name, update=False, always_update_details=False, frequency='MONTHLY', verbose=False):
+def import_stock(stock_name, update=False, always_update_details=False, frequency='MONTHLY', verbose=False, last_date=None):
+    # last_date: with update, the last stock_data date of the stock when already known
+    # (see update_planner.plan_stock_updates), looked up otherwise
     try:
         start=None
         if verbose:
             print("*** importing stock {}".format(stock_name))
         if update:
-            start = get_last_stock_data_date(stock_name, frequency=frequency)
+            start = last_date
+            if start is None:
+                start = get_last_stock_data_date(stock_name, frequency=frequency)
             # if start is today's date, skip
             today = pd.Timestamp.today().date()
             if start == today:
@@ -80,24 +93,24 @@ def update_stocks_info_data(stock_name):
             shares_outstanding = EXCLUDED.shares_outstanding
         ;COMMIT;
     '''
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(sql, (stock_name, info.get('longName'), info.get('sector'), info.get('industry'),
                                  info.get('ebitda'), info.get('enterpriseValue'), info.get('enterpriseToEbitda'),
                                  info.get('priceToBook'), info.get('totalCash'), info.get('totalDebt'),
                                  info.get('sharesOutstanding')))
-        connPool.putconn(conn)
+            # the views show the stocks details
+            db.mark_views_stale(cursor)
 
 
 def check_stocks_info_exist(stock_name):
     # check if the stock is in the DB stocks table
     sql = 'SELECT 1 FROM stocks WHERE ticker = %s;'
     result = None
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(sql, (stock_name,))
             result = cursor.fetchone()
-        connPool.putconn(conn)
     if not result:
         return False
     return True
@@ -109,11 +122,10 @@ def get_last_stock_data_date(ticker, frequency='MONTHLY'):
         ORDER BY date DESC
         LIMIT 1'''
     result = None
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(sql, (ticker, frequency))
             result = cursor.fetchone()
-        connPool.putconn(conn)
     if result:
         return result[0]
     return None
@@ -132,33 +144,27 @@ def delete_stock_from_db(ticker):
     sql = '''DELETE FROM
         stock_data
         WHERE ticker = %s;COMMIT;'''
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(sql, (ticker,))
-        connPool.putconn(conn)
 
 
 def delete_carbon_risk_factor_from_db(factor_name):
     sql = '''DELETE FROM
         carbon_risk_factor
         WHERE factor_name = %s;COMMIT;'''
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(sql, (factor_name,))
-        connPool.putconn(conn)
 
 
 def load_carbon_risk_factor_from_db(factor_name, frequency='MONTHLY'):
-    sql = '''SELECT date, bmg
+    sql = '''SELECT date, bmg::float8 as bmg
         FROM carbon_risk_factor
         WHERE factor_name = %s and frequency = %s
         ORDER BY date
         '''
-    with connPool.getconn() as conn:
-        res = pd.read_sql_query(sql, con=conn,
-                             index_col='date', params=(factor_name,frequency,))
-        connPool.putconn(conn)
-        return res
+    return db.load_frame(sql, (factor_name, frequency), index_col='date', float_columns=['bmg'])
 
 
 def get_components_from_db(stock_name):
@@ -167,58 +173,42 @@ def get_components_from_db(stock_name):
              WHERE ticker = %s
              ORDER BY component_stock'''
     res = None
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(sql, (stock_name,))
             res = cursor.fetchall()
-        connPool.putconn(conn)
     return res
 
 
 def import_carbon_risk_factor_into_db(data, frequency='MONTHLY'):
-    sql = '''INSERT INTO
-        carbon_risk_factor (date, frequency, factor_name, bmg)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (date, frequency, factor_name) DO
-        UPDATE SET bmg = EXCLUDED.bmg;COMMIT;'''
-    with connPool.getconn() as conn:
+    rows = zip(data.index, itertools.repeat(frequency), data['factor_name'], data['bmg'])
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
-            for index, row in data.iterrows():
-                cursor.execute(sql, (index, frequency, row['factor_name'], row['bmg']))
-        connPool.putconn(conn)
+            bulk_writer.upsert_rows(cursor, 'carbon_risk_factor', ['date', 'frequency', 'factor_name', 'bmg'],
+                                    ['date', 'frequency', 'factor_name'], rows)
 
 
 def import_stocks_into_db(stock_name, stock_data, frequency='MONTHLY'):
-    sql = '''INSERT INTO
-        stock_data (ticker, frequency, date, close, return)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (ticker, frequency, date) DO
-        UPDATE SET close = EXCLUDED.close, return = EXCLUDED.return;COMMIT;'''
-    with connPool.getconn() as conn:
+    # we store both the values of Close and the Returns from pct_change
+    pc = stock_data.pct_change()
+    pc.rename(columns={'Close': 'r'}, inplace=True)
+    stock_data = pd.merge(stock_data, pc, on='date_converted')
+    # Remove abnormal return values
+    stock_data = stock_data[stock_data['r'] <= 1]
+    rows = zip(itertools.repeat(stock_name), itertools.repeat(frequency), stock_data.index,
+               stock_data['Close'], stock_data['r'])
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
-            # we store both the values of Close and the Returns from pct_change
-            pc = stock_data.pct_change()
-            pc.rename(columns={'Close': 'r'}, inplace=True)
-            stock_data = pd.merge(stock_data, pc, on='date_converted')
-            # Remove abnormal return values
-            stock_data = stock_data[stock_data['r'] <= 1]
-            for index, row in stock_data.iterrows():
-                #print('-- {} = {} : {}%'.format(index, row['Close'], row['r']))
-                cursor.execute(sql, (stock_name, frequency, index, row['Close'], row['r']))
-        connPool.putconn(conn)
+            bulk_writer.upsert_rows(cursor, 'stock_data', ['ticker', 'frequency', 'date', 'close', 'return'],
+                                    ['ticker', 'frequency', 'date'], rows)
 
 
 def import_stocks_returns_into_db(stock_name, stock_data, frequency='MONTHLY'):
-    sql = '''INSERT INTO
-        stock_data (ticker, frequency, date, return)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (ticker, frequency, date) DO
-        UPDATE SET return = EXCLUDED.return;COMMIT;'''
-    with connPool.getconn() as conn:
+    rows = zip(itertools.repeat(stock_name), itertools.repeat(frequency), stock_data.index, stock_data['return'])
+    with connPool.connection() as conn:
         with conn.cursor() as cursor:
-            for index, row in stock_data.iterrows():
-                cursor.execute(sql, (stock_name, frequency, index, row['return']))
-        connPool.putconn(conn)
+            bulk_writer.upsert_rows(cursor, 'stock_data', ['ticker', 'frequency', 'date', 'return'],
+                                    ['ticker', 'frequency', 'date'], rows)
 
 
 def load_stocks_returns_from_db(stock_name, frequency='MONTHLY', verbose=False):
@@ -237,25 +227,18 @@ def load_stocks_returns_from_db(stock_name, frequency='MONTHLY', verbose=False):
 
 
 def load_stocks_data_with_returns_from_db(stock_name, with_components=False, import_when_missing=False, update=False, always_update_details=False, frequency='MONTHLY', verbose=False):
-    sql = '''SELECT date, close, return
+    sql = '''SELECT date, close::float8 as close, return::float8 as return
         FROM stock_data
         WHERE ticker = %s and frequency = %s
         ORDER BY date
         '''
-    df = None
-    with connPool.getconn() as conn:
-        df = pd.read_sql_query(sql, con=conn,
-                           index_col='date', params=(stock_name,frequency,))
-        connPool.putconn(conn)
+    df = db.load_frame(sql, (stock_name, frequency), index_col='date', float_columns=['close', 'return'])
     if (df is None or df.empty) and import_when_missing:
         if verbose:
             print("*** no data in DB for {}, will import it".format(stock_name))
         import_stock(stock_name, update=update, always_update_details=always_update_details, frequency=frequency)
         # try again
-        with connPool.getconn() as conn:
-            df = pd.read_sql_query(sql, con=conn,
-                               index_col='date', params=(stock_name,frequency,))
-            connPool.putconn(conn)
+        df = db.load_frame(sql, (stock_name, frequency), index_col='date', float_columns=['close', 'return'])
 
     if with_components:
         components = get_components_from_db(stock_name)
@@ -273,16 +256,16 @@ def load_stocks_data_with_returns_from_db(stock_name, with_components=False, imp
                 if not percentage:
                     print("!!! Missing percentage of {} as component of {}".format(ticker, stock_name))
                     continue
+                percentage = float(percentage)
                 df2 = load_stocks_data_with_returns_from_db(
                     ticker, import_when_missing=import_when_missing, frequency=frequency, verbose=verbose)
                 df = df.join(df2, how="outer",
                              rsuffix='_{}'.format(ticker))
                 df['percentage_{}'.format(ticker)] = percentage
-                df['p_return_{}'.format(ticker)] = df['return_{}'.format(
-                    ticker)].astype(str).apply(Decimal) * percentage
+                df['p_return_{}'.format(ticker)] = df['return_{}'.format(ticker)] * percentage
             # sum the specific columns
             df['sum_p_returns'] = df.filter(
-                regex="p_return").astype(float).sum(axis=1)
+                regex="p_return").sum(axis=1)
             df['sum_percentages'] = df.filter(
                 regex="percentage").sum(axis=1)
             df['composite_return'] = df['sum_p_returns'] / \
@@ -291,46 +274,87 @@ def load_stocks_data_with_returns_from_db(stock_name, with_components=False, imp
 
 
 def load_stocks_from_db(stock_name, frequency='MONTHLY'):
-    sql = '''SELECT date, close
+    # on datetime64 dates, like the data of import_stock
+    sql = '''SELECT date, close::float8 as close
         FROM stock_data
         WHERE ticker = %s and frequency = %s
         ORDER BY date
         '''
-    with connPool.getconn() as conn:
-        res = pd.read_sql_query(sql, con=conn,
-                             index_col='date', params=(stock_name,frequency,))
-        connPool.putconn(conn)
-        return res
+    return db.load_frame(sql, (stock_name, frequency), index_col='date', float_columns=['close'],
+                         datetime_index=True)
 
 
 def load_all_stocks_from_db(frequency='MONTHLY'):
-    sql = '''SELECT *
+    sql = '''SELECT ticker, frequency, date, close::float8 as close, return::float8 as return
         FROM stock_data
         WHERE frequency = %s
         ORDER BY ticker, date
         '''
-    with connPool.getconn() as conn:
-        res = pd.read_sql_query(sql, con=conn,
-                             index_col='date', params=(frequency,))
-        connPool.putconn(conn)
-        return res
+    return db.load_frame(sql, (frequency,), index_col='date', float_columns=['close', 'return'])
+
+
+def iter_stock_returns_from_db(frequency='MONTHLY', itersize=STREAM_ITERSIZE):
+    # stream the stock_data returns ordered by ticker through a server side cursor,
+    # yields (ticker, returns Series indexed by date) one ticker at a time so only
+    # itersize rows and one ticker are held in memory
+    sql = '''SELECT ticker, date, return::float8
+        FROM stock_data
+        WHERE frequency = %s and close IS NOT NULL and return IS NOT NULL
+        ORDER BY ticker, date
+        '''
+    with connPool.connection() as conn:
+        with conn.cursor(name='stock_data_stream') as cursor:
+            cursor.itersize = itersize
+            cursor.execute(sql, (frequency,))
+            for (ticker, rows) in itertools.groupby(cursor, key=lambda r: r[0]):
+                rows = list(rows)
+                yield (ticker, pd.Series([r[2] for r in rows],
+                                         index=pd.Index([r[1] for r in rows], name='date'),
+                                         name='return'))
+
+
+def load_stock_returns_range_from_db(dates, frequency='MONTHLY'):
+    # first and last dates of the stock_data returns on the given dates, and the number
+    # of tickers having returns on them, the same rows as iter_stock_returns_from_db
+    sql = '''SELECT min(date), max(date), count(DISTINCT ticker)
+        FROM stock_data
+        WHERE frequency = %s and close IS NOT NULL and return IS NOT NULL
+        and date = ANY(%s)
+        '''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (frequency, list(dates)))
+            res = cursor.fetchone()
+    return res
+
+
+def load_history_lengths_from_db(tickers, frequency='MONTHLY'):
+    # {ticker: number of stock_data rows}, used to schedule the longest tickers first
+    sql = '''SELECT ticker, count(*)
+        FROM stock_data
+        WHERE frequency = %s and ticker = ANY(%s)
+        GROUP BY ticker
+        '''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (frequency, list(tickers)))
+            res = dict(cursor.fetchall())
+    return res
 
 
 def load_stocks_defined_in_db():
     sql = '''SELECT ticker FROM stocks ORDER BY ticker'''
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         df = pd.read_sql_query(sql, con=conn,
                            index_col='ticker')
-        connPool.putconn(conn)
     return df.index
 
 
 def get_stock_details(ticker):
     sql = '''SELECT * FROM stocks WHERE ticker = %s'''
-    with connPool.getconn() as conn:
+    with connPool.connection() as conn:
         df = pd.read_sql_query(sql, con=conn,
                            index_col='ticker', params=(ticker,))
-        connPool.putconn(conn)
     return df
 
 
@@ -348,35 +372,100 @@ def import_stock_or_returns(stock_name, update=False, always_update_details=Fals
         print("-> imported {} rows".format(len(df)))
 
 
-def run(index, total, stocks, args):
+def run(index, total, stocks, args, ledger=None, last_date=None):
     stock_name = stocks.item(0)
-    run2(index, total, stock_name, args)
+    run2(index, total, stock_name, args, ledger, last_date)
 
 
-def run2(index, total, stock_name, args):
+def run2(index, total, stock_name, args, ledger=None, last_date=None):
     print("[{} / {}] loading stocks for: {}".format(index+1, total, stock_name))
-    import_stock(stock_name, update=args.update, always_update_details=args.update_stocks_details, frequency=args.frequency, verbose=args.verbose)
+    with job_ledger.track(ledger, stock_name):
+        import_stock(stock_name, update=args.update, always_update_details=args.update_stocks_details, frequency=args.frequency, verbose=args.verbose, last_date=last_date)
 
 
-def main(args):
-    multiprocessing.set_start_method('spawn')
+def plan_run_updates(args, tickers, ledger):
+    # with -u: (tickers to import, {ticker: last stock_data date}) from one query for all the
+    # tickers, the ones already up to date are done in the ledger without starting a task
+    if not args.update:
+        return (tickers, {})
+    (pending, last_dates) = update_planner.plan_stock_updates(tickers, frequency=args.frequency)
+    planned = set(pending)
+    ledger.mark_done([(t, '', 0) for t in tickers if t not in planned])
+    return (pending, last_dates)
+
+
+def load_run_tickers(args):
+    # tickers of the -f file or of the stocks table, only the ones of --shard i/n
+    if args.file:
+        tickers = [s.item(0) for s in load_stocks_csv(args.file)]
+    else:
+        tickers = load_stocks_defined_in_db()
+    return job_ledger.shard_tickers(tickers, args.shard)
+
+
+def run_queue_worker(args):
+    # import the tickers queued by --enqueue with the same command until none is left
+    name = job_ledger.job_name('get_stocks', args, LEDGER_FIELDS)
+    worker = job_ledger.worker_id()
+    n = 0
+    with job_ledger.Heartbeat(worker):
+        while True:
+            tasks = job_ledger.claim_tasks(name, args.frequency, worker)
+            if not tasks:
+                break
+            ledger = job_ledger.JobLedger(name, args.frequency, claimed=set(tasks))
+            for (i, (ticker, _, _)) in enumerate(tasks):
+                try:
+                    run2(i, len(tasks), ticker, args, ledger)
+                except Exception:
+                    traceback.print_exc()
+            n += len(tasks)
+    print('*** {} done, imported {} tickers'.format(worker, n))
+    return n
+
+
+def open_run_ledger(args, tickers):
+    # job ledger of the import run, with --resume the tickers already imported are kept
+    return job_ledger.open_ledger(job_ledger.job_name('get_stocks', args, LEDGER_FIELDS),
+                                  args.frequency, tickers, resume=args.resume)
+
+
+def main(args, pool=None):
+    # pool: the worker processes of a long running process, used instead of starting -c processes
     if args.clean_bad_returns:
-        with connPool.getconn() as conn:
+        with connPool.connection() as conn:
             with conn.cursor() as cursor:
                 cleanup_abnormal_returns(cursor)
                 print("-- {} entries affected.".format(cursor.rowcount))
-        connPool.putconn(conn)
         return True
-    if args.from_db:
-        stocks = load_stocks_defined_in_db()
+    if args.enqueue:
+        stocks = load_run_tickers(args)
+        n = job_ledger.enqueue(job_ledger.job_name('get_stocks', args, LEDGER_FIELDS), args.frequency, stocks)
+        print('*** {} tickers pending in the queue'.format(n))
+    elif args.queue_worker:
+        if args.concurrency <= 1:
+            run_queue_worker(args)
+        else:
+            with task_scheduler.process_pool(args.concurrency, pool) as pool:
+                n = sum(pool.map(run_queue_worker, [args] * args.concurrency, chunksize=1))
+            print('*** imported {} tickers'.format(n))
+    elif args.from_db:
+        stocks = load_run_tickers(args)
+        ledger = open_run_ledger(args, stocks)
+        stocks = ledger.pending_tickers(stocks)
+        (stocks, last_dates) = plan_run_updates(args, stocks, ledger)
         t = len(stocks)
-        with multiprocessing.Pool(processes=args.concurrency) as pool:
-            pool.starmap(run2, zip(
+        # the longest histories first so they do not end up last on a single process
+        costs = task_scheduler.history_costs(stocks, load_history_lengths_from_db(stocks, frequency=args.frequency))
+        with task_scheduler.process_pool(args.concurrency, pool) as pool:
+            task_scheduler.run_longest_first(pool, run2, list(zip(
                 range(0,t),
                 itertools.repeat(t),
                 stocks,
                 itertools.repeat(args),
-            ))
+                itertools.repeat(ledger.tracker()),
+                [last_dates.get(s) for s in stocks],
+            )), costs, args.concurrency)
 
     elif args.delete:
         delete_stock_from_db(args.delete)
@@ -402,21 +491,31 @@ def main(args):
             print('Error reading CSV file {}'.format(args.file))
             return False
 
+        if args.shard:
+            shard = set(job_ledger.shard_tickers([s.item(0) for s in stocks], args.shard))
+            stocks = [s for s in stocks if s.item(0) in shard]
+        ledger = open_run_ledger(args, [s.item(0) for s in stocks])
+        (pending, last_dates) = plan_run_updates(args, ledger.pending_tickers([s.item(0) for s in stocks]), ledger)
+        pending = set(pending)
+        stocks = [s for s in stocks if s.item(0) in pending]
         t = len(stocks)
-        with multiprocessing.Pool(processes=args.concurrency) as pool:
-            pool.starmap(run, zip(
+        names = [s.item(0) for s in stocks]
+        costs = task_scheduler.history_costs(names, load_history_lengths_from_db(names, frequency=args.frequency))
+        with task_scheduler.process_pool(args.concurrency, pool) as pool:
+            task_scheduler.run_longest_first(pool, run, list(zip(
                 range(0,t),
                 itertools.repeat(t),
                 stocks,
                 itertools.repeat(args),
-            ))
+                itertools.repeat(ledger.tracker()),
+                [last_dates.get(n) for n in names],
+            )), costs, args.concurrency)
     else:
         return False
     return True
 
 
-# run
-if __name__ == "__main__":
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--file",
                         help="specify the CSV file of stock tickers to import")
@@ -444,7 +543,22 @@ if __name__ == "__main__":
                         help="Only update the data by fetching from the last DB entry date.")
     parser.add_argument("-v", "--verbose", action='store_true',
                         help="More verbose output.")
+    parser.add_argument("--resume", action='store_true',
+                        help="With -f or -d, only import the tickers not done by the previous run of the same command, as recorded in the job_ledger table")
+    parser.add_argument("--enqueue", action='store_true',
+                        help="With -f or -d, queue the tickers in the job_ledger table instead of importing them, for the --queue_worker processes started with the same command")
+    parser.add_argument("--queue_worker", action='store_true',
+                        help="Import the tickers queued by --enqueue with the same command, on any number of hosts using the same DB, until none is left, with -c processes")
+    parser.add_argument("--shard", type=job_ledger.parse_shard,
+                        help="With -f or -d, only import the tickers of shard i/n (eg: 0/4), the same split on every host")
     parser.add_argument("-c", "--concurrency", default=1, type=int,
                         help="Number of concurrent processes to run to speed up the regression generation over large datasets")
+    return parser
+
+
+# run
+if __name__ == "__main__":
+    task_scheduler.set_start_method()
+    parser = get_parser()
     if not main(parser.parse_args()):
         parser.print_help()
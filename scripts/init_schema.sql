@@ -145,174 +145,62 @@ CREATE INDEX frequencies ON stock_stats (frequency);
 CREATE INDEX series_names ON stock_stats (ticker, bmg_factor_name, interval);
 CREATE INDEX count_all_stats ON stock_stats (bmg_factor_name, frequency);
 
-DROP MATERIALIZED VIEW IF EXISTS stock_and_stats;
-DROP VIEW IF EXISTS stock_and_stats;
-CREATE MATERIALIZED VIEW stock_and_stats AS
-select
-s.* ,
-ss.frequency,
-ss.bmg_factor_name,
-ss.from_date,
-x.thru_date,
-ss.data_from_date,
-ss.data_thru_date,
-ss.constant,
-ss.constant_std_error,
-ss.constant_t_stat,
-ss.constant_p_gt_abs_t,
-ss.bmg,
-ss.bmg_std_error,
-ss.bmg_t_stat,
-ss.bmg_p_gt_abs_t,
-ss.mkt_rf,
-ss.mkt_rf_std_error,
-ss.mkt_rf_t_stat,
-ss.mkt_rf_p_gt_abs_t,
-ss.smb,
-ss.smb_std_error,
-ss.smb_t_stat,
-ss.smb_p_gt_abs_t,
-ss.hml,
-ss.hml_std_error,
-ss.hml_t_stat,
-ss.hml_p_gt_abs_t,
-ss.wml,
-ss.wml_std_error,
-ss.wml_t_stat,
-ss.wml_p_gt_abs_t,
-ss.jarque_bera,
-ss.jarque_bera_p_gt_abs_t,
-ss.breusch_pagan,
-ss.breusch_pagan_p_gt_abs_t,
-ss.durbin_watson,
-ss.r_squared
-from stocks s
-left join (
-select
-    ticker,
-    frequency,
-    bmg_factor_name,
-    max(thru_date) as thru_date
-from stock_stats ss
-group by
-    ticker, frequency, bmg_factor_name
-) x on x.ticker = s.ticker
-left join stock_stats ss on ss.ticker = s.ticker and ss.frequency = x.frequency and ss.bmg_factor_name = x.bmg_factor_name and ss.thru_date = x.thru_date;
+DROP TABLE IF EXISTS stock_model_stats CASCADE;
+CREATE TABLE stock_model_stats (
+    ticker text,
+    frequency text,
+    bmg_factor_name text,
+    model_name text,
+    from_date date,
+    thru_date date,
+    data_from_date date,
+    data_thru_date date,
+    interval integer,
+    factor text,
+    coef decimal(12, 5),
+    std_error decimal(12, 5),
+    t_stat decimal(12, 5),
+    p_gt_abs_t decimal(12, 5),
+    nobs integer,
+    r_squared decimal(12, 5),
+    f_stat decimal(12, 5),
+    f_p_gt_f decimal(12, 5),
+    PRIMARY KEY (ticker, frequency, bmg_factor_name, model_name, from_date, thru_date, interval, factor)
+);
 
--- query this parent_ticker to get data of the components of that stock
-DROP MATERIALIZED VIEW IF EXISTS stock_component_and_stats;
-DROP VIEW IF EXISTS stock_component_and_stats;
-CREATE MATERIALIZED VIEW stock_component_and_stats AS
-select
-s.*,
-sc.ticker as parent_ticker,
-sc.percentage,
-ss.frequency,
-ss.bmg_factor_name,
-ss.from_date,
-x.thru_date,
-ss.data_from_date,
-ss.data_thru_date,
-ss.constant,
-ss.constant_std_error,
-ss.constant_t_stat,
-ss.constant_p_gt_abs_t,
-ss.bmg,
-ss.bmg_std_error,
-ss.bmg_t_stat,
-ss.bmg_p_gt_abs_t,
-ss.mkt_rf,
-ss.mkt_rf_std_error,
-ss.mkt_rf_t_stat,
-ss.mkt_rf_p_gt_abs_t,
-ss.smb,
-ss.smb_std_error,
-ss.smb_t_stat,
-ss.smb_p_gt_abs_t,
-ss.hml,
-ss.hml_std_error,
-ss.hml_t_stat,
-ss.hml_p_gt_abs_t,
-ss.wml,
-ss.wml_std_error,
-ss.wml_t_stat,
-ss.wml_p_gt_abs_t,
-ss.jarque_bera,
-ss.jarque_bera_p_gt_abs_t,
-ss.breusch_pagan,
-ss.breusch_pagan_p_gt_abs_t,
-ss.durbin_watson,
-ss.r_squared
-from stock_components sc
-left join stocks s on s.ticker = sc.component_stock
-left join (
-select
-    ticker,
-    frequency,
-    bmg_factor_name,
-    max(thru_date) as thru_date
-from stock_stats ss
-group by
-    ticker, frequency, bmg_factor_name
-) x on x.ticker = s.ticker
-left join stock_stats ss on ss.ticker = s.ticker and ss.frequency = x.frequency and ss.bmg_factor_name = x.bmg_factor_name and ss.thru_date = x.thru_date;
+CREATE INDEX model_series_names ON stock_model_stats (ticker, bmg_factor_name, interval, model_name);
 
+DROP TABLE IF EXISTS job_ledger CASCADE;
+CREATE TABLE job_ledger (
+    job_name text,
+    ticker text,
+    bmg_factor_name text,
+    frequency text,
+    interval integer,
+    status text,
+    started_at timestamp,
+    finished_at timestamp,
+    worker text,
+    heartbeat_at timestamp,
+    PRIMARY KEY (job_name, frequency, ticker, bmg_factor_name, interval)
+);
 
--- query this component_stock to get data of the parent stocks
-DROP MATERIALIZED VIEW IF EXISTS stock_parent_and_stats;
-DROP VIEW IF EXISTS stock_parent_and_stats;
-CREATE MATERIALIZED VIEW stock_parent_and_stats AS
-select
-s.*,
-sc.component_stock,
-sc.percentage,
-ss.frequency,
-ss.bmg_factor_name,
-ss.from_date,
-x.thru_date,
-ss.data_from_date,
-ss.data_thru_date,
-ss.constant,
-ss.constant_std_error,
-ss.constant_t_stat,
-ss.constant_p_gt_abs_t,
-ss.bmg,
-ss.bmg_std_error,
-ss.bmg_t_stat,
-ss.bmg_p_gt_abs_t,
-ss.mkt_rf,
-ss.mkt_rf_std_error,
-ss.mkt_rf_t_stat,
-ss.mkt_rf_p_gt_abs_t,
-ss.smb,
-ss.smb_std_error,
-ss.smb_t_stat,
-ss.smb_p_gt_abs_t,
-ss.hml,
-ss.hml_std_error,
-ss.hml_t_stat,
-ss.hml_p_gt_abs_t,
-ss.wml,
-ss.wml_std_error,
-ss.wml_t_stat,
-ss.wml_p_gt_abs_t,
-ss.jarque_bera,
-ss.jarque_bera_p_gt_abs_t,
-ss.breusch_pagan,
-ss.breusch_pagan_p_gt_abs_t,
-ss.durbin_watson,
-ss.r_squared
-from stock_components sc
-left join stocks s on s.ticker = sc.ticker
-left join (
-select
-    ticker,
-    bmg_factor_name,
-    frequency,
-    max(thru_date) as thru_date
-from stock_stats ss
-group by
-    ticker, frequency, bmg_factor_name
-) x on x.ticker = s.ticker
-left join stock_stats ss on ss.ticker = s.ticker and ss.frequency = x.frequency and ss.bmg_factor_name = x.bmg_factor_name and ss.thru_date = x.thru_date;
+CREATE INDEX job_ledger_status ON job_ledger (job_name, frequency, status);
+
+-- the stock_stats rows of the last thru_date of each ticker, frequency and bmg_factor_name, written by
+-- get_regressions.py in the transactions writing the stock_stats, the views of init_views.sql are built on it
+DROP TABLE IF EXISTS stock_stats_latest CASCADE;
+CREATE TABLE stock_stats_latest (
+    LIKE stock_stats,
+    PRIMARY KEY (ticker, frequency, bmg_factor_name, from_date, thru_date)
+);
+
+-- set in the transactions writing the tables of the views, db.refresh_views only refreshes the
+-- views when set: a run refreshes them at most once, and not at all when it wrote nothing
+DROP TABLE IF EXISTS view_refresh CASCADE;
+CREATE TABLE view_refresh (
+    stale boolean,
+    refreshed_at timestamp
+);
 
+INSERT INTO view_refresh (stale) VALUES (false);
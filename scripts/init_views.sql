@@ -0,0 +1,149 @@
+-- the views of the stocks with their last regression of each frequency and factor, built on
+-- stock_stats_latest, run by setup_db.py after init_schema.sql and by setup_db.py --upgrade
+
+DROP MATERIALIZED VIEW IF EXISTS stock_and_stats;
+DROP VIEW IF EXISTS stock_and_stats;
+CREATE MATERIALIZED VIEW stock_and_stats AS
+select
+s.* ,
+ss.frequency,
+ss.bmg_factor_name,
+ss.from_date,
+ss.thru_date,
+ss.data_from_date,
+ss.data_thru_date,
+ss.constant,
+ss.constant_std_error,
+ss.constant_t_stat,
+ss.constant_p_gt_abs_t,
+ss.bmg,
+ss.bmg_std_error,
+ss.bmg_t_stat,
+ss.bmg_p_gt_abs_t,
+ss.mkt_rf,
+ss.mkt_rf_std_error,
+ss.mkt_rf_t_stat,
+ss.mkt_rf_p_gt_abs_t,
+ss.smb,
+ss.smb_std_error,
+ss.smb_t_stat,
+ss.smb_p_gt_abs_t,
+ss.hml,
+ss.hml_std_error,
+ss.hml_t_stat,
+ss.hml_p_gt_abs_t,
+ss.wml,
+ss.wml_std_error,
+ss.wml_t_stat,
+ss.wml_p_gt_abs_t,
+ss.jarque_bera,
+ss.jarque_bera_p_gt_abs_t,
+ss.breusch_pagan,
+ss.breusch_pagan_p_gt_abs_t,
+ss.durbin_watson,
+ss.r_squared
+from stocks s
+left join stock_stats_latest ss on ss.ticker = s.ticker;
+
+CREATE UNIQUE INDEX stock_and_stats_key ON stock_and_stats (ticker, frequency, bmg_factor_name, from_date, thru_date);
+
+-- query this parent_ticker to get data of the components of that stock
+DROP MATERIALIZED VIEW IF EXISTS stock_component_and_stats;
+DROP VIEW IF EXISTS stock_component_and_stats;
+CREATE MATERIALIZED VIEW stock_component_and_stats AS
+select
+s.*,
+sc.ticker as parent_ticker,
+sc.percentage,
+ss.frequency,
+ss.bmg_factor_name,
+ss.from_date,
+ss.thru_date,
+ss.data_from_date,
+ss.data_thru_date,
+ss.constant,
+ss.constant_std_error,
+ss.constant_t_stat,
+ss.constant_p_gt_abs_t,
+ss.bmg,
+ss.bmg_std_error,
+ss.bmg_t_stat,
+ss.bmg_p_gt_abs_t,
+ss.mkt_rf,
+ss.mkt_rf_std_error,
+ss.mkt_rf_t_stat,
+ss.mkt_rf_p_gt_abs_t,
+ss.smb,
+ss.smb_std_error,
+ss.smb_t_stat,
+ss.smb_p_gt_abs_t,
+ss.hml,
+ss.hml_std_error,
+ss.hml_t_stat,
+ss.hml_p_gt_abs_t,
+ss.wml,
+ss.wml_std_error,
+ss.wml_t_stat,
+ss.wml_p_gt_abs_t,
+ss.jarque_bera,
+ss.jarque_bera_p_gt_abs_t,
+ss.breusch_pagan,
+ss.breusch_pagan_p_gt_abs_t,
+ss.durbin_watson,
+ss.r_squared
+from stock_components sc
+left join stocks s on s.ticker = sc.component_stock
+left join stock_stats_latest ss on ss.ticker = s.ticker;
+
+CREATE UNIQUE INDEX stock_component_and_stats_key ON stock_component_and_stats (parent_ticker, ticker, frequency, bmg_factor_name, from_date, thru_date);
+
+
+-- query this component_stock to get data of the parent stocks
+DROP MATERIALIZED VIEW IF EXISTS stock_parent_and_stats;
+DROP VIEW IF EXISTS stock_parent_and_stats;
+CREATE MATERIALIZED VIEW stock_parent_and_stats AS
+select
+s.*,
+sc.component_stock,
+sc.percentage,
+ss.frequency,
+ss.bmg_factor_name,
+ss.from_date,
+ss.thru_date,
+ss.data_from_date,
+ss.data_thru_date,
+ss.constant,
+ss.constant_std_error,
+ss.constant_t_stat,
+ss.constant_p_gt_abs_t,
+ss.bmg,
+ss.bmg_std_error,
+ss.bmg_t_stat,
+ss.bmg_p_gt_abs_t,
+ss.mkt_rf,
+ss.mkt_rf_std_error,
+ss.mkt_rf_t_stat,
+ss.mkt_rf_p_gt_abs_t,
+ss.smb,
+ss.smb_std_error,
+ss.smb_t_stat,
+ss.smb_p_gt_abs_t,
+ss.hml,
+ss.hml_std_error,
+ss.hml_t_stat,
+ss.hml_p_gt_abs_t,
+ss.wml,
+ss.wml_std_error,
+ss.wml_t_stat,
+ss.wml_p_gt_abs_t,
+ss.jarque_bera,
+ss.jarque_bera_p_gt_abs_t,
+ss.breusch_pagan,
+ss.breusch_pagan_p_gt_abs_t,
+ss.durbin_watson,
+ss.r_squared
+from stock_components sc
+left join stocks s on s.ticker = sc.ticker
+left join stock_stats_latest ss on ss.ticker = s.ticker;
+
+CREATE UNIQUE INDEX stock_parent_and_stats_key ON stock_parent_and_stats (component_stock, ticker, frequency, bmg_factor_name, from_date, thru_date);
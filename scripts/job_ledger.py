@@ -0,0 +1,243 @@
+import argparse
+import contextlib
+import os
+import socket
+import threading
+import zlib
+import psycopg2.extras
+import db
+
+connPool = db.get_db_connection_pool()
+
+# status of the tasks in the job_ledger table
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# tasks claimed at a time by a queue worker
+CLAIM_BATCH_SIZE = 20
+# a running task is requeued when its worker did not send a heartbeat for that long
+HEARTBEAT_TIMEOUT = 600
+HEARTBEAT_SECONDS = 60
+
+
+def job_name(script, args, fields):
+    # identifies a command by its script and the args selecting its tasks,
+    # eg: get_regressions file=data/stocks.csv start_date=2018-01-01
+    return ' '.join([script] + ['{}={}'.format(f, getattr(args, f, None)) for f in fields])
+
+
+class JobLedger:
+    """Status of the (ticker, factor, frequency, interval) tasks of a run, in the job_ledger table.
+
+    The tasks without a factor or an interval (eg: importing the stocks) use '' and 0.
+
+    Attributes:
+        job_name -- identifies the command the tasks belong to
+        frequency -- frequency of the tasks
+        done -- set of (ticker, factor_name, interval) already done when the ledger was opened
+        claimed -- set of (ticker, factor_name, interval) claimed from the queue, the only ones to run
+    """
+
+    def __init__(self, job_name, frequency, done=None, claimed=None):
+        self.job_name = job_name
+        self.frequency = frequency
+        self.done = done if done is not None else set()
+        self.claimed = claimed
+
+    def is_done(self, ticker, factor_name='', interval=0):
+        return (ticker, factor_name, interval) in self.done
+
+    def should_run(self, ticker, factor_name='', interval=0):
+        task = (ticker, factor_name, interval)
+        return task not in self.done and (self.claimed is None or task in self.claimed)
+
+    def pending_tickers(self, tickers, factor_names=('',), intervals=(0,)):
+        # the tickers having at least one task not done yet
+        return [t for t in tickers
+                if not all(self.is_done(t, f, i) for f in factor_names for i in intervals)]
+
+    def tracker(self):
+        # same ledger without the done set, to send with each task
+        return JobLedger(self.job_name, self.frequency)
+
+    def ticker_ledgers(self, tickers):
+        # ledger of each ticker with only its done tasks, to send with the task of the ticker
+        done = {}
+        for task in self.done:
+            done.setdefault(task[0], set()).add(task)
+        return [JobLedger(self.job_name, self.frequency, done=done.get(t, set())) for t in tickers]
+
+    def set_status(self, ticker, factor_name, interval, status):
+        sql = '''UPDATE job_ledger SET
+            status = %s,
+            started_at = CASE WHEN %s = 'running' THEN now() ELSE started_at END,
+            finished_at = CASE WHEN %s = 'running' THEN NULL ELSE now() END
+            WHERE job_name = %s and ticker = %s and bmg_factor_name = %s and frequency = %s and interval = %s'''
+        with connPool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, (status, status, status, self.job_name, ticker, factor_name,
+                                     self.frequency, interval))
+
+    def mark_done(self, tasks):
+        # set the (ticker, factor_name, interval) tasks done in one query, eg: the ones already up to date
+        tasks = list(tasks)
+        if not tasks:
+            return
+        sql = '''UPDATE job_ledger SET status = %s, finished_at = now()
+            WHERE job_name = %s and frequency = %s
+            and (ticker, bmg_factor_name, interval) IN (SELECT * FROM unnest(%s::text[], %s::text[], %s::int[]))'''
+        (tickers, factor_names, intervals) = zip(*tasks)
+        with connPool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, (DONE, self.job_name, self.frequency, list(tickers), list(factor_names),
+                                     list(intervals)))
+        self.done.update(tasks)
+
+    @contextlib.contextmanager
+    def track(self, ticker, factor_name='', interval=0, sink=None):
+        # the task is running during the with block, then done, or failed on an exception,
+        # with a regression_results.ResultSink the task is only done once its results are written
+        self.set_status(ticker, factor_name, interval, RUNNING)
+        try:
+            yield
+        except BaseException:
+            self.set_status(ticker, factor_name, interval, FAILED)
+            raise
+        if sink is None:
+            self.set_status(ticker, factor_name, interval, DONE)
+        else:
+            sink.after_writes(lambda ok: self.set_status(ticker, factor_name, interval, DONE if ok else FAILED))
+        self.done.add((ticker, factor_name, interval))
+
+
+def insert_tasks(cursor, job_name, frequency, tickers, factor_names, intervals):
+    # pending tasks for all the given tickers, factors and intervals, keeping the existing ones
+    tasks = [(job_name, t, f, frequency, i, PENDING) for t in tickers for f in factor_names for i in intervals]
+    psycopg2.extras.execute_values(cursor, '''INSERT INTO job_ledger
+        (job_name, ticker, bmg_factor_name, frequency, interval, status)
+        VALUES %s ON CONFLICT DO NOTHING''', tasks, page_size=1000)
+    return tasks
+
+
+def open_ledger(job_name, frequency, tickers, factor_names=('',), intervals=(0,), resume=False):
+    # ledger of the tasks of all the given tickers, factors and intervals: a new run starts
+    # them all as pending, with resume the tasks already done are kept and will be skipped
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            if not resume:
+                cursor.execute('DELETE FROM job_ledger WHERE job_name = %s and frequency = %s',
+                               (job_name, frequency))
+            tasks = insert_tasks(cursor, job_name, frequency, tickers, factor_names, intervals)
+            cursor.execute('''SELECT ticker, bmg_factor_name, interval FROM job_ledger
+                WHERE job_name = %s and frequency = %s and status = %s''', (job_name, frequency, DONE))
+            done = set(cursor.fetchall())
+    if resume:
+        print('*** resuming {}: {} of {} tasks already done'.format(job_name, len(done), len(tasks)))
+    return JobLedger(job_name, frequency, done)
+
+
+def enqueue(job_name, frequency, tickers, factor_names=('',), intervals=(0,)):
+    # queue the tasks for the workers started with the same command, the tasks
+    # already queued (or done) are kept, returns the number of pending tasks
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            insert_tasks(cursor, job_name, frequency, tickers, factor_names, intervals)
+            cursor.execute('''SELECT count(*) FROM job_ledger
+                WHERE job_name = %s and frequency = %s and status = %s''', (job_name, frequency, PENDING))
+            return cursor.fetchone()[0]
+
+
+def worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def claim_tasks(job_name, frequency, worker, batch_size=CLAIM_BATCH_SIZE, timeout=HEARTBEAT_TIMEOUT):
+    # claim a batch of pending tasks, or running ones whose worker stopped sending heartbeats,
+    # SKIP LOCKED lets any number of workers claim at the same time without waiting on each other,
+    # returns the (ticker, factor_name, interval) claimed sorted by ticker, none when the queue is done
+    sql = '''UPDATE job_ledger j SET
+        status = %s,
+        worker = %s,
+        heartbeat_at = now(),
+        started_at = now(),
+        finished_at = NULL
+    FROM (SELECT job_name, frequency, ticker, bmg_factor_name, interval
+        FROM job_ledger
+        WHERE job_name = %s and frequency = %s
+        and (status = %s or (status = %s and heartbeat_at < now() - %s * interval '1 second'))
+        ORDER BY ticker, bmg_factor_name, interval
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED) c
+    WHERE j.job_name = c.job_name and j.frequency = c.frequency and j.ticker = c.ticker
+    and j.bmg_factor_name = c.bmg_factor_name and j.interval = c.interval
+    RETURNING j.ticker, j.bmg_factor_name, j.interval'''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (RUNNING, worker, job_name, frequency, PENDING, RUNNING, timeout, batch_size))
+            return sorted(cursor.fetchall())
+
+
+class Heartbeat:
+    """Thread updating the heartbeat of the running tasks of a queue worker, so they are
+    not requeued while the worker is alive.
+
+    Attributes:
+        worker -- worker_id() of the tasks
+        seconds -- time between two heartbeats
+    """
+
+    def __init__(self, worker, seconds=HEARTBEAT_SECONDS):
+        self.worker = worker
+        self.seconds = seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.seconds):
+            try:
+                with connPool.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute('''UPDATE job_ledger SET heartbeat_at = now()
+                            WHERE worker = %s and status = %s''', (self.worker, RUNNING))
+            except Exception as e:
+                # try again at the next beat, the tasks are only requeued after HEARTBEAT_TIMEOUT
+                print('!! heartbeat of {} failed: {}'.format(self.worker, e))
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def parse_shard(value):
+    # argparse type for --shard i/n, with 0 <= i < n
+    try:
+        (i, n) = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Shard must be given as i/n, got {}'.format(value))
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError('Shard i/n must have 0 <= i < n, got {}'.format(value))
+    return (i, n)
+
+
+def shard_tickers(tickers, shard):
+    # the tickers of shard (i, n), the same on every host: the CRC32 of the ticker modulo n
+    if shard is None:
+        return list(tickers)
+    (i, n) = shard
+    return [t for t in tickers if zlib.crc32(t.encode('utf-8')) % n == i]
+
+
+@contextlib.contextmanager
+def track(ledger, ticker, factor_name='', interval=0, sink=None):
+    # ledger.track when running with a ledger, nothing otherwise
+    if ledger is None:
+        yield
+    else:
+        with ledger.track(ticker, factor_name, interval, sink=sink):
+            yield
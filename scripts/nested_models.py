@@ -0,0 +1,102 @@
+import numpy as np
+import regression_engine
+import regression_results
+
+# bond_factor columns used as factors (the monthly changes, in percent)
+BOND_FACTOR_COLUMNS = ['rate_chg', 'curve_chg', 'hi_yield_spread_chg', 'bbb_spread_chg']
+
+# nested models in the order they are fitted, each adds its regressors to the previous one
+BASE_MODELS = [
+    ('CAPM', ['Mkt-RF']),
+    ('FF3', ['SMB', 'HML']),
+    ('CARHART', ['WML']),
+    ('CARHART_BMG', ['BMG']),
+]
+
+MODEL_STATS_DTYPE = np.dtype([
+    ('ticker', object),
+    ('frequency', object),
+    ('bmg_factor_name', object),
+    ('model_name', object),
+    ('from_date', 'datetime64[D]'),
+    ('thru_date', 'datetime64[D]'),
+    ('data_from_date', 'datetime64[D]'),
+    ('data_thru_date', 'datetime64[D]'),
+    ('interval', np.int32),
+    ('factor', object),
+    ('coef', np.float64),
+    ('std_error', np.float64),
+    ('t_stat', np.float64),
+    ('p_gt_abs_t', np.float64),
+    ('nobs', np.int32),
+    ('r_squared', np.float64),
+    ('f_stat', np.float64),
+    ('f_p_gt_f', np.float64),
+])
+# columns used to replace the existing rows of a model regression
+MODEL_KEY_FIELDS = ['ticker', 'frequency', 'bmg_factor_name', 'model_name', 'from_date', 'thru_date', 'interval']
+
+
+def model_specs(bond_factors=False, additional_factors=None):
+    # list of (model_name, regressors added by the model)
+    specs = list(BASE_MODELS)
+    name = specs[-1][0]
+    if bond_factors:
+        name += '_BOND'
+        specs.append((name, list(BOND_FACTOR_COLUMNS)))
+    if additional_factors:
+        name += '_ADDITIONAL'
+        specs.append((name, list(additional_factors)))
+    return specs
+
+
+def model_sizes(specs):
+    # number of columns (with the constant) of each nested model
+    sizes = []
+    p = 1
+    for (_, added) in specs:
+        p += len(added)
+        sizes.append(p)
+    return sizes
+
+
+def ordered_exog_names(specs):
+    return ['Constant'] + [name for (_, added) in specs for name in added]
+
+
+def model_records(ticker, frequency, factor_name, interval, from_date, thru_date,
+                  data_from_date, data_thru_date, specs, fits):
+    # one record per (model, regressor) of the fits of a window
+    n = sum(len(fit.exog_names) for fit in fits)
+    records = np.zeros(n, dtype=MODEL_STATS_DTYPE)
+    records['ticker'] = ticker
+    records['frequency'] = frequency
+    records['bmg_factor_name'] = factor_name
+    records['interval'] = interval
+    records['from_date'] = from_date
+    records['thru_date'] = thru_date
+    records['data_from_date'] = data_from_date
+    records['data_thru_date'] = data_thru_date
+    i = 0
+    for ((model_name, _), fit) in zip(specs, fits):
+        rows = slice(i, i + len(fit.exog_names))
+        records['model_name'][rows] = model_name
+        records['factor'][rows] = [regression_results.sql_field(name) for name in fit.exog_names]
+        records['coef'][rows] = fit.params
+        records['std_error'][rows] = fit.bse
+        records['t_stat'][rows] = fit.tvalues
+        records['p_gt_abs_t'][rows] = fit.pvalues
+        records['nobs'][rows] = fit.nobs
+        # stored rounded to 4 decimals like the stock_stats R squared
+        records['r_squared'][rows] = round(float(fit.rsquared), 4)
+        records['f_stat'][rows] = round(float(fit.fvalue), 4)
+        records['f_p_gt_f'][rows] = round(float(fit.f_pvalue), 4)
+        i = rows.stop
+    return records
+
+
+def fit_window(aligned, lo, hi, order, sizes, exog_names):
+    # nested fits of the rows lo:hi kept by the outlier filter
+    rows = np.arange(lo, hi)[aligned.mask[lo:hi]]
+    return regression_engine.fit_nested_ols(aligned.y[rows], aligned.x[np.ix_(rows, order)], sizes,
+                                            exog_names=exog_names)
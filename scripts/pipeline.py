@@ -0,0 +1,288 @@
+import argparse
+import datetime
+import queue
+import shlex
+import threading
+import numpy as np
+import bmg_series
+import db
+import get_regressions
+import get_stocks
+import task_scheduler
+import update_planner
+import window_planner
+
+try:
+    import tomllib
+except ImportError:
+    # before python 3.11
+    import tomli as tomllib
+
+# defaults of the [pipeline] section of the configuration
+DEFAULT_CONCURRENCY = 4
+DEFAULT_IMPORT_CONCURRENCY = 4
+DEFAULT_QUEUE_SIZE = 64
+
+
+class Stage:
+    """A step of the pipeline, its tasks run on a pool of worker processes.
+
+    Attributes:
+        name -- name of the stage in the progress output
+        pool -- the worker processes, can be shared by several stages
+        inbox -- bounded queue of the (key, func, args) tasks ready to run
+        slots -- bounds the tasks sent to the pool and not finished yet
+        events -- queue of the (stage, key, ok) finished tasks read by the pipeline
+    """
+
+    def __init__(self, name, pool, processes, queue_size, events):
+        self.name = name
+        self.pool = pool
+        self.inbox = queue.Queue(maxsize=queue_size)
+        self.slots = threading.Semaphore(2 * processes)
+        self.events = events
+        self.done = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def put(self, key, func, args):
+        # waits while the inbox is full
+        self.inbox.put((key, func, args))
+
+    def _dispatch(self):
+        while True:
+            task = self.inbox.get()
+            if task is None:
+                return
+            (key, func, args) = task
+            self.slots.acquire()
+            self.pool.apply_async(func, args,
+                                  callback=lambda result, key=key: self._finished(key, result is not False),
+                                  error_callback=lambda e, key=key: self._finished(key, False, e))
+
+    def _finished(self, key, ok, error=None):
+        # in the result thread of the pool
+        self.slots.release()
+        if error is not None:
+            print('!! {} {} failed: {}'.format(self.name, key, error))
+        self.events.put((self, key, ok))
+
+    def close(self):
+        self.inbox.put(None)
+        self._thread.join()
+
+
+class Pipeline:
+    """Runs the stock imports, BMG series and regressions of a configuration, each
+    ticker goes to the next stage as soon as what it needs is done instead of
+    waiting for the whole previous stage.
+
+    Attributes:
+        stocks -- args of get_stocks.py for each [[stocks]] entry
+        series -- args of bmg_series.py for each [[bmg_series]] entry
+        regressions -- args of get_regressions.py for each [[regressions]] entry
+        refresh_views -- refresh the materialized views at the end
+    """
+
+    def __init__(self, config):
+        settings = config.get('pipeline', {})
+        self.concurrency = settings.get('concurrency', DEFAULT_CONCURRENCY)
+        self.import_concurrency = settings.get('import_concurrency', DEFAULT_IMPORT_CONCURRENCY)
+        self.queue_size = settings.get('queue_size', DEFAULT_QUEUE_SIZE)
+        self.refresh_views = settings.get('refresh_views', True)
+        self.stocks = [parse_args(get_stocks, entry) for entry in config.get('stocks', [])]
+        self.series = [parse_args(bmg_series, entry) for entry in config.get('bmg_series', [])]
+        self.regressions = [parse_args(get_regressions, entry) for entry in config.get('regressions', [])]
+        for args in self.regressions:
+            if args.bulk_regression or args.batched or args.ticker:
+                print('!! the pipeline runs the regressions of each ticker, -b, --batched and -t are ignored')
+
+    def run(self):
+        start_time = datetime.datetime.now()
+        processes = self.import_concurrency + self.concurrency
+        # the DB connections are split between the processes of both pools
+        import_pool = task_scheduler.new_pool(self.import_concurrency, processes)
+        regression_pool = task_scheduler.new_pool(self.concurrency, processes)
+        events = queue.Queue()
+        imports = Stage('import', import_pool, self.import_concurrency, self.queue_size, events)
+        series = Stage('bmg_series', import_pool, self.import_concurrency, self.queue_size, events)
+        regressions = Stage('regressions', regression_pool, self.concurrency, self.queue_size, events)
+        stages = [imports, series, regressions]
+        pools = [import_pool, regression_pool]
+        blocks = []
+        try:
+            self._run(imports, series, regressions, events, blocks)
+            for stage in stages:
+                stage.close()
+            for pool in pools:
+                pool.close()
+        except BaseException:
+            for pool in pools:
+                pool.terminate()
+            raise
+        finally:
+            for pool in pools:
+                pool.join()
+            get_regressions.release_factor_panels(blocks)
+        if self.refresh_views:
+            db.refresh_views(verbose=True)
+        print('*** pipeline done in {}'.format(datetime.datetime.now() - start_time))
+        for stage in stages:
+            print('  {}: {} tasks done, {} failed'.format(stage.name, stage.done, stage.failed))
+        return not any(stage.failed for stage in stages)
+
+    def _run(self, imports, series, regressions, events, blocks):
+        # import tasks not finished yet for each ticker
+        pending_imports = {}
+        import_tasks = []
+        for (i, args) in enumerate(self.stocks):
+            tickers = get_stocks.load_run_tickers(args)
+            last_dates = {}
+            if args.update:
+                # the tickers already up to date are not imported again
+                (tickers, last_dates) = update_planner.plan_stock_updates(tickers, frequency=args.frequency)
+            for (j, ticker) in enumerate(tickers):
+                pending_imports[ticker] = pending_imports.get(ticker, 0) + 1
+                import_tasks.append(((i, ticker), get_stocks.run,
+                                     (j, len(tickers), np.array([ticker]), args, None, last_dates.get(ticker))))
+        # BMG series not built yet, by (factor_name, frequency)
+        pending_series = {}
+        for args in self.series:
+            key = (args.factor_name, args.frequency)
+            pending_series[key] = pending_series.get(key, 0) + 1
+        waiting_series = list(range(len(self.series)))
+        # tickers and factors of each regressions entry, its job once its factor series are built
+        regression_tickers = [get_regressions.load_run_tickers(args) for args in self.regressions]
+        factor_names = [get_regressions.get_factor_names(args) for args in self.regressions]
+        jobs = [None] * len(self.regressions)
+        # the ledger of each ticker of an entry, sent with its task instead of the done set of the run
+        ledgers = [None] * len(self.regressions)
+        # with -u, the start dates of the regressions of each ticker of an entry
+        plans = [None] * len(self.regressions)
+        # (entry, position) of the regressions of each ticker
+        ticker_regressions = {}
+        for (i, tickers) in enumerate(regression_tickers):
+            for (j, ticker) in enumerate(tickers):
+                ticker_regressions.setdefault(ticker, []).append((i, j))
+        outstanding = len(import_tasks)
+
+        def ticker_ready(ticker):
+            return not pending_imports.get(ticker)
+
+        def send_regression(i, j):
+            nonlocal outstanding
+            tickers = regression_tickers[i]
+            regressions.put((i, tickers[j]), get_regressions.run_job,
+                            (jobs[i], j, len(tickers), np.array([tickers[j]]), plans[i] and plans[i].get(tickers[j], {}),
+                             ledgers[i] and ledgers[i][j]))
+            outstanding += 1
+
+        def start_series():
+            # series whose green and brown stocks are imported
+            nonlocal outstanding
+            for i in list(waiting_series):
+                args = self.series[i]
+                if ticker_ready(args.green_ticker) and ticker_ready(args.brown_ticker):
+                    waiting_series.remove(i)
+                    series.put(i, bmg_series.main, (args,))
+                    outstanding += 1
+
+        def start_regressions():
+            # entries whose factor series are built: their imported tickers are sent now, the others
+            # when their import is done
+            for (i, args) in enumerate(self.regressions):
+                if jobs[i] is not None or any(pending_series.get((f, args.frequency)) for f in factor_names[i]):
+                    continue
+                (jobs[i], plans[i], ledgers[i]) = self._regressions_job(args, regression_tickers[i], blocks)
+                if jobs[i]:
+                    for (j, ticker) in enumerate(regression_tickers[i]):
+                        if ticker_ready(ticker):
+                            send_regression(i, j)
+
+        # the imports are fed from another thread, the regressions of the first tickers
+        # can start while the last ones are still waiting for the import stage
+        def feed_imports():
+            for task in import_tasks:
+                imports.put(*task)
+        threading.Thread(target=feed_imports, daemon=True).start()
+
+        start_series()
+        start_regressions()
+        while outstanding:
+            (stage, key, ok) = events.get()
+            outstanding -= 1
+            if ok:
+                stage.done += 1
+            else:
+                stage.failed += 1
+            # a failed task still lets the next stages run, like the stages of update.sh
+            if stage is imports:
+                ticker = key[1]
+                pending_imports[ticker] -= 1
+                if ticker_ready(ticker):
+                    for (i, j) in ticker_regressions.get(ticker, []):
+                        if jobs[i]:
+                            send_regression(i, j)
+                    start_series()
+                if stage.done + stage.failed == len(import_tasks):
+                    print('*** [import] all {} imports done'.format(len(import_tasks)))
+            elif stage is series:
+                args = self.series[key]
+                pending_series[(args.factor_name, args.frequency)] -= 1
+                print('*** [bmg_series] {} {} done'.format(args.factor_name, args.frequency))
+                start_regressions()
+
+    def _regressions_job(self, args, tickers, blocks):
+        # (job, plan, ledgers) of a regressions entry: the job has its factor panels shared with the
+        # workers and the tracker of its job ledger, False when it has no factor data, ledgers has the
+        # ledger of each ticker with its done tasks (None for a dry run), with -u the plan has the start
+        # dates of the regressions of each ticker from one query, none is left out as up to date since
+        # their stock data may still be importing
+        panels = get_regressions.load_run_factor_panels(args)
+        if not panels:
+            print('!! no factor data for the regressions {}'.format(' '.join(args.factor_name)))
+            return (False, None, None)
+        plan = None
+        if args.update:
+            table = 'stock_model_stats' if args.nested_models else 'stock_stats'
+            plan = update_planner.plan_regression_updates(tickers, panels,
+                                                          window_planner.get_intervals(args.frequency, args.interval),
+                                                          frequency=args.frequency, start_date=args.start_date,
+                                                          end_date=args.end_date, table=table, last_dates={})
+        ledger = get_regressions.open_run_ledger(args, tickers, list(panels))
+        (shared, descriptors) = get_regressions.share_factor_panels(panels)
+        blocks.extend(shared)
+        if ledger is None:
+            return (get_regressions.new_job(args, descriptors), plan, None)
+        return (get_regressions.new_job(args, descriptors, ledger.tracker()), plan, ledger.ticker_ledgers(tickers))
+
+
+def parse_args(script, entry):
+    # args of an entry of the configuration, given as the command line of the script
+    args = entry.get('args', '')
+    if isinstance(args, str):
+        args = shlex.split(args)
+    return script.get_parser().parse_args(args)
+
+
+def load_config(filename):
+    with open(filename, 'rb') as f:
+        return tomllib.load(f)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Run the stock imports, BMG series and regressions of a TOML configuration (eg: update.toml), "
+                    "the regressions of each ticker start as soon as its stock data and the BMG series they use are updated")
+    parser.add_argument("config",
+                        help="TOML configuration of the pipeline")
+    return parser
+
+
+# run
+if __name__ == "__main__":
+    task_scheduler.set_start_method()
+    args = get_parser().parse_args()
+    if not Pipeline(load_config(args.config)).run():
+        raise SystemExit(1)
@@ -0,0 +1,164 @@
+import numpy as np
+from scipy import stats as sp_stats
+
+# none: skip the residual diagnostics (backfill them later with --backfill_diagnostics)
+# fast: computed in batch with array operations
+# full: computed with statsmodels for each regression, reference for verification
+DIAGNOSTICS_MODES = ['none', 'fast', 'full']
+DEFAULT_DIAGNOSTICS = 'fast'
+
+# stock_stats columns filled by the diagnostics
+DIAGNOSTICS_FIELDS = ['jarque_bera', 'jarque_bera_p_gt_abs_t',
+                      'breusch_pagan', 'breusch_pagan_p_gt_abs_t',
+                      'durbin_watson']
+
+# rows of the windows built at once when computing the rolling diagnostics
+WINDOW_CHUNK_SIZE = 256
+
+
+def compact(values, valid):
+    # move the valid entries of each row of values (m, L, ...) first, keeping
+    # their order, and zero the rest
+    order = np.argsort(~valid, axis=1, kind='stable')
+    valid = np.take_along_axis(valid, order, axis=1)
+    if values.ndim == 3:
+        values = np.take_along_axis(values, order[:, :, None], axis=1)
+        values = np.where(valid[:, :, None], values, 0.0)
+    else:
+        values = np.take_along_axis(values, order, axis=1)
+        values = np.where(valid, values, 0.0)
+    return values
+
+
+def batch_diagnostics(resid, exog, nobs):
+    # Jarque-Bera, Breusch-Pagan (Koenker, as statsmodels het_breuschpagan)
+    # and Durbin-Watson of m regressions at once.
+    # resid (m, L) and exog (m, L, k) hold the nobs (m,) observations of
+    # each regression first, in order, the rest padded with zeros.
+    nobs = np.asarray(nobs)
+    n = nobs.astype(np.float64)
+    k = exog.shape[2]
+    used = np.arange(resid.shape[1])[None, :] < nobs[:, None]
+
+    # Durbin-Watson
+    diffs = np.diff(resid, axis=1)
+    diffs = np.where(used[:, 1:], diffs, 0.0)
+    ssr = np.sum(resid ** 2, axis=1)
+    durbin_watson = np.sum(diffs ** 2, axis=1) / ssr
+
+    # Jarque-Bera from the biased skew and kurtosis
+    centered = np.where(used, resid - (np.sum(resid, axis=1) / n)[:, None], 0.0)
+    m2 = np.sum(centered ** 2, axis=1) / n
+    m3 = np.sum(centered ** 3, axis=1) / n
+    m4 = np.sum(centered ** 4, axis=1) / n
+    skew = m3 / m2 ** 1.5
+    kurtosis = m4 / m2 ** 2
+    jarque_bera = n / 6 * (skew ** 2 + (kurtosis - 3) ** 2 / 4)
+    jarque_bera_p = sp_stats.chi2.sf(jarque_bera, 2)
+
+    # Breusch-Pagan: n * R^2 of the squared residuals regressed on exog
+    u = resid ** 2
+    xtx = np.einsum('mli,mlj->mij', exog, exog)
+    xtu = np.einsum('mli,ml->mi', exog, u)
+    beta = np.einsum('mij,mj->mi', np.linalg.pinv(xtx), xtu)
+    utu = np.sum(u ** 2, axis=1)
+    aux_ssr = utu - np.sum(beta * xtu, axis=1)
+    aux_tss = utu - np.sum(u, axis=1) ** 2 / n
+    breusch_pagan = n * (1 - aux_ssr / aux_tss)
+    breusch_pagan_p = sp_stats.chi2.sf(breusch_pagan, k - 1)
+
+    return {
+        'jarque_bera': jarque_bera,
+        'jarque_bera_p_gt_abs_t': jarque_bera_p,
+        'breusch_pagan': breusch_pagan,
+        'breusch_pagan_p_gt_abs_t': breusch_pagan_p,
+        'durbin_watson': durbin_watson,
+    }
+
+
+def masked_diagnostics(resid, exog, mask, mode=DEFAULT_DIAGNOSTICS):
+    # diagnostics of the m columns of resid (n, m) fitted on the same exog (n, k),
+    # each column only using the rows flagged in mask (n, m)
+    if mode == 'none':
+        return None
+    if mode == 'full':
+        return stack_diagnostics([statsmodels_diagnostics(resid[mask[:, i], i], exog[mask[:, i]])
+                                  for i in range(resid.shape[1])])
+    valid = mask.T
+    m = valid.shape[0]
+    e = compact(np.nan_to_num(resid.T), valid)
+    x = compact(np.broadcast_to(exog, (m,) + exog.shape), valid)
+    return batch_diagnostics(e, x, valid.sum(axis=1))
+
+
+def rolling_diagnostics(y, exog, mask, lo, hi, params, mode=DEFAULT_DIAGNOSTICS):
+    # diagnostics of the windows [lo, hi) of y and exog fitted with params (k, w),
+    # only using the rows flagged in mask; built by chunks of windows to
+    # bound the memory used by the padded arrays
+    lo = np.asarray(lo)
+    hi = np.asarray(hi)
+    if mode == 'none':
+        return None
+    if mode == 'full':
+        results = []
+        for w in range(len(lo)):
+            rows = np.arange(lo[w], hi[w])[mask[lo[w]:hi[w]]]
+            resid = y[rows] - exog[rows] @ params[:, w]
+            results.append(statsmodels_diagnostics(resid, exog[rows]))
+        return stack_diagnostics(results)
+    results = {f: np.empty(len(lo)) for f in DIAGNOSTICS_FIELDS}
+    if len(lo) == 0:
+        return results
+    length = int(np.max(hi - lo))
+    offsets = np.arange(length)
+    for c in range(0, len(lo), WINDOW_CHUNK_SIZE):
+        chunk = slice(c, c + WINDOW_CHUNK_SIZE)
+        idx = lo[chunk, None] + offsets[None, :]
+        in_window = idx < hi[chunk, None]
+        idx = np.where(in_window, idx, lo[chunk, None])
+        valid = in_window & mask[idx]
+        x = exog[idx]
+        e = y[idx] - np.einsum('wlk,kw->wl', x, params[:, chunk])
+        d = batch_diagnostics(compact(np.nan_to_num(e), valid), compact(np.nan_to_num(x), valid),
+                              valid.sum(axis=1))
+        for f in DIAGNOSTICS_FIELDS:
+            results[f][chunk] = d[f]
+    return results
+
+
+def statsmodels_diagnostics(resid, exog):
+    # reference values for one regression
+    from statsmodels.stats import diagnostic, stattools
+    jb = stattools.jarque_bera(resid)
+    bp = diagnostic.het_breuschpagan(resid, exog)
+    return {
+        'jarque_bera': jb[0],
+        'jarque_bera_p_gt_abs_t': jb[1],
+        'breusch_pagan': bp[0],
+        'breusch_pagan_p_gt_abs_t': bp[1],
+        'durbin_watson': stattools.durbin_watson(resid),
+    }
+
+
+def stack_diagnostics(results):
+    # list of per regression dicts -> dict of arrays
+    return {f: np.array([r[f] for r in results], dtype=np.float64) for f in DIAGNOSTICS_FIELDS}
+
+
+def single_diagnostics(resid, exog, mode=DEFAULT_DIAGNOSTICS):
+    # diagnostics of one regression for the given mode, None for 'none'
+    if mode == 'none':
+        return None
+    if mode == 'full':
+        return statsmodels_diagnostics(resid, exog)
+    d = batch_diagnostics(np.asarray(resid, dtype=np.float64)[None, :],
+                          np.asarray(exog, dtype=np.float64)[None, :, :],
+                          [len(resid)])
+    return {f: d[f][0] for f in DIAGNOSTICS_FIELDS}
+
+
+def column_diagnostics(diagnostics, i):
+    # the rounded values stored in stock_stats for the regression i of a batch
+    if diagnostics is None:
+        return {}
+    return {f: round(float(diagnostics[f][i]), 4) for f in DIAGNOSTICS_FIELDS}
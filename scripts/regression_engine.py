@@ -0,0 +1,232 @@
+import numpy as np
+from scipy import stats as sp_stats
+from scipy.linalg import solve_triangular
+
+# statsmodels is kept as the reference engine to verify the numpy results,
+# rolling fits all the windows of a ticker from prefix sums
+ENGINES = ['numpy', 'rolling', 'statsmodels']
+DEFAULT_ENGINE = 'numpy'
+
+COEF_TABLE_INDEX = ['coef', 'std err', 't', 'P>|t|']
+
+
+class OLSResult:
+    """Result of a closed-form OLS fit.
+
+    Exposes the same attributes as the statsmodels results we use
+    (params, bse, tvalues, pvalues, rsquared, resid) as numpy arrays.
+    For a batched fit of m series the coefficient arrays are (k, m),
+    rsquared and nobs are (m,) and resid is (n, m).
+    The fits of nested models (fit_nested_ols) also have the fvalue and
+    f_pvalue of the F-test against the previous nested model.
+    """
+
+    def __init__(self, exog_names, params, bse, tvalues, pvalues, rsquared, resid, nobs, df_resid,
+                 fvalue=None, f_pvalue=None):
+        self.exog_names = list(exog_names)
+        self.params = params
+        self.bse = bse
+        self.tvalues = tvalues
+        self.pvalues = pvalues
+        self.rsquared = rsquared
+        self.resid = resid
+        self.nobs = nobs
+        self.df_resid = df_resid
+        self.fvalue = fvalue
+        self.f_pvalue = f_pvalue
+
+    def coef_table(self):
+        # rows: coef, std err, t, P>|t| ; one column per regressor
+        return np.vstack([self.params, self.bse, self.tvalues, self.pvalues])
+
+    def summary(self):
+        lines = ['OLS Regression Results (numpy engine)',
+                 'No. Observations: {}    Df Residuals: {}    R-squared: {:.4f}'.format(
+                     self.nobs, self.df_resid, self.rsquared),
+                 '{:>12} {:>12} {:>12} {:>12} {:>12}'.format('', *COEF_TABLE_INDEX)]
+        for i, name in enumerate(self.exog_names):
+            lines.append('{:>12} {:>12.4f} {:>12.4f} {:>12.3f} {:>12.3f}'.format(
+                name, self.params[i], self.bse[i], self.tvalues[i], self.pvalues[i]))
+        return '\n'.join(lines)
+
+
+def default_exog_names(k):
+    return ['x{}'.format(i) for i in range(k)]
+
+
+def fit_ols(y, x, exog_names=None):
+    # Solve the least squares problem through a QR decomposition of x
+    # instead of going through statsmodels, x must already contain the constant
+    y = np.asarray(y, dtype=np.float64)
+    res = fit_ols_batch(y[:, None], x, exog_names=exog_names)
+    return OLSResult(res.exog_names, res.params[:, 0], res.bse[:, 0], res.tvalues[:, 0], res.pvalues[:, 0],
+                     res.rsquared[0], res.resid[:, 0], res.nobs, res.df_resid)
+
+
+def fit_ols_batch(y, x, exog_names=None):
+    # Fit every column of y (n, m) against the same design x (n, k):
+    # x is factored once and all the series are solved in one BLAS call
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    nobs, k = x.shape
+    if exog_names is None:
+        exog_names = default_exog_names(k)
+
+    q, r = np.linalg.qr(x)
+    params = solve_triangular(r, q.T @ y)
+    resid = y - x @ params
+    df_resid = nobs - k
+    ssr = np.sum(resid ** 2, axis=0)
+    sigma2 = ssr / df_resid
+
+    # diag((X'X)^-1) = row norms of R^-1
+    r_inv = solve_triangular(r, np.eye(k))
+    cov_diag = np.sum(r_inv ** 2, axis=1)
+    bse = np.sqrt(np.outer(cov_diag, sigma2))
+    tvalues = params / bse
+    pvalues = 2 * sp_stats.t.sf(np.abs(tvalues), df_resid)
+
+    centered_tss = np.sum((y - y.mean(axis=0)) ** 2, axis=0)
+    rsquared = 1 - ssr / centered_tss
+
+    return OLSResult(exog_names, params, bse, tvalues, pvalues, rsquared, resid, nobs, df_resid)
+
+
+def fit_nested_ols(y, x, sizes, exog_names=None):
+    # Fit the nested models using the first p columns of x for each p in sizes
+    # from a single QR decomposition: the QR factors of the first p columns
+    # are R[:p, :p] and the first p entries of Q'y.  x must start with the
+    # constant, each model is F-tested against the previous one (the first
+    # against the constant only model).
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    nobs, k = x.shape
+    if exog_names is None:
+        exog_names = default_exog_names(k)
+    exog_names = list(exog_names)
+
+    q, r = np.linalg.qr(x)
+    qty = q.T @ y
+    centered_tss = np.sum((y - y.mean()) ** 2)
+    prev_ssr = centered_tss
+    prev_p = 1
+    results = []
+    for p in sizes:
+        r_p = r[:p, :p]
+        params = solve_triangular(r_p, qty[:p])
+        resid = y - x[:, :p] @ params
+        df_resid = nobs - p
+        ssr = resid @ resid
+        sigma2 = ssr / df_resid
+
+        r_inv = solve_triangular(r_p, np.eye(p))
+        bse = np.sqrt(np.sum(r_inv ** 2, axis=1) * sigma2)
+        tvalues = params / bse
+        pvalues = 2 * sp_stats.t.sf(np.abs(tvalues), df_resid)
+        rsquared = 1 - ssr / centered_tss
+
+        fvalue = ((prev_ssr - ssr) / (p - prev_p)) / sigma2
+        f_pvalue = sp_stats.f.sf(fvalue, p - prev_p, df_resid)
+        results.append(OLSResult(exog_names[:p], params, bse, tvalues, pvalues, rsquared, resid, nobs, df_resid,
+                                 fvalue=fvalue, f_pvalue=f_pvalue))
+        prev_ssr = ssr
+        prev_p = p
+    return results
+
+
+def fit_ols_masked(y, x, mask, exog_names=None):
+    # Batched fit where each column of y only uses the rows flagged in
+    # mask (n, m).  Columns sharing the same mask pattern are solved
+    # together, columns without enough rows are left as NaN.
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    mask = np.asarray(mask, dtype=bool)
+    n, m = y.shape
+    k = x.shape[1]
+    if exog_names is None:
+        exog_names = default_exog_names(k)
+
+    params = np.full((k, m), np.nan)
+    bse = np.full((k, m), np.nan)
+    tvalues = np.full((k, m), np.nan)
+    pvalues = np.full((k, m), np.nan)
+    rsquared = np.full(m, np.nan)
+    resid = np.full((n, m), np.nan)
+    nobs = mask.sum(axis=0)
+
+    if m == 0:
+        return OLSResult(exog_names, params, bse, tvalues, pvalues, rsquared, resid, nobs, nobs - k)
+
+    patterns = np.packbits(mask, axis=0).T
+    _, group_of = np.unique(patterns, axis=0, return_inverse=True)
+    group_of = group_of.ravel()
+    for g in range(group_of.max() + 1):
+        cols = np.flatnonzero(group_of == g)
+        rows = mask[:, cols[0]]
+        if rows.sum() <= k:
+            continue
+        res = fit_ols_batch(y[np.ix_(rows, cols)], x[rows], exog_names=exog_names)
+        params[:, cols] = res.params
+        bse[:, cols] = res.bse
+        tvalues[:, cols] = res.tvalues
+        pvalues[:, cols] = res.pvalues
+        rsquared[cols] = res.rsquared
+        resid[np.ix_(rows, cols)] = res.resid
+
+    return OLSResult(exog_names, params, bse, tvalues, pvalues, rsquared, resid, nobs, nobs - k)
+
+
+def window_cross_products(y, x, mask):
+    # prefix sums of the [x y]'[x y] cross products and of the row counts,
+    # only counting the rows flagged in mask
+    n, k = x.shape
+    z = np.column_stack([x, y])
+    z = np.where(mask[:, None], z, 0.0)
+    sums = np.zeros((n + 1, k + 1, k + 1))
+    np.cumsum(np.einsum('ni,nj->nij', z, z), axis=0, out=sums[1:])
+    counts = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(mask, out=counts[1:])
+    return (sums, counts)
+
+
+def ols_from_cross_products(sums, nobs, exog_names=None):
+    # OLS of each window from its (w, k+1, k+1) [x y]'[x y] sums,
+    # the first column of x must be the constant
+    k = sums.shape[1] - 1
+    if exog_names is None:
+        exog_names = default_exog_names(k)
+    xtx = sums[:, :k, :k]
+    xty = sums[:, :k, k]
+    yty = sums[:, k, k]
+
+    xtx_inv = np.linalg.pinv(xtx)
+    params = np.einsum('wij,wj->wi', xtx_inv, xty)
+    df_resid = nobs - k
+    ssr = np.maximum(yty - np.sum(params * xty, axis=1), 0)
+    sigma2 = ssr / df_resid
+    cov_diag = np.diagonal(xtx_inv, axis1=1, axis2=2)
+    bse = np.sqrt(cov_diag * sigma2[:, None])
+    tvalues = params / bse
+    pvalues = 2 * sp_stats.t.sf(np.abs(tvalues), df_resid[:, None])
+
+    centered_tss = yty - xty[:, 0] ** 2 / nobs
+    rsquared = 1 - ssr / centered_tss
+
+    return OLSResult(exog_names, params.T, bse.T, tvalues.T, pvalues.T, rsquared, None, nobs, df_resid)
+
+
+def rolling_ols(y, x, mask, lo, hi, exog_names=None, cross_products=None):
+    # Fit every window [lo, hi) of the rows of y and x by differencing the
+    # prefix sums of the cross products: O(k^2) per window instead of
+    # refitting O(n k^2) each time.  Rows not in mask (eg: outliers) are skipped.
+    # cross_products can give the window_cross_products already computed for
+    # the same y, x and mask (eg: when fitting several interval lengths).
+    if cross_products is None:
+        y = np.asarray(y, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+        mask = np.asarray(mask, dtype=bool)
+        cross_products = window_cross_products(y, x, mask)
+    (sums, counts) = cross_products
+    lo = np.asarray(lo)
+    hi = np.asarray(hi)
+    return ols_from_cross_products(sums[hi] - sums[lo], counts[hi] - counts[lo], exog_names=exog_names)
@@ -1,10 +1,27 @@
-import pandas as pd
-import statsmodels.api as sm
-import statsmodels.stats as stats
 import numpy as np
+import regression_engine
+import regression_diagnostics
+import regression_results
 
 
-def regression_input_output(all_factor_df, stock_name):
+def statsmodels_coefficients(y, x):
+    # reference engine: fit with statsmodels, imported only when used as it takes
+    # about 2s to import, most of the startup time of a worker process
+    import statsmodels.api as sm
+    model = sm.OLS(y, x).fit()
+    coef_table = np.vstack([model.params.values, model.bse.values, model.tvalues.values, model.pvalues.values])
+    return (model, coef_table)
+
+
+def numpy_coefficients(y, x):
+    model = regression_engine.fit_ols(y.values, x.values, exog_names=x.columns)
+    return (model, model.coef_table())
+
+
+def regression_input_output(all_factor_df, stock_name, engine=regression_engine.DEFAULT_ENGINE,
+                            diagnostics=regression_diagnostics.DEFAULT_DIAGNOSTICS):
+    # returns the fitted model and a regression_results record (structured array
+    # of length 1) holding the coefficients, diagnostics and R squared
     # Separate into independent (x) and dependent (y) factors)
     all_factor_df = all_factor_df.where(
         all_factor_df < 0.5, np.nan)
@@ -18,31 +35,21 @@ def regression_input_output(all_factor_df, stock_name):
         x.insert(0, 'Constant', 1)
 
         # Estimate regression
-        model = sm.OLS(y, x).fit()
-
-        coef_df = pd.read_html(
-         model.summary().tables[1].as_html(), header=0, index_col=0)[0]
-        coef_df_simple = coef_df[['coef', 'std err', 't', 'P>|t|']]
-        coef_df_simple = pd.DataFrame.transpose(coef_df_simple)
-        coef_df_simple['Name'] = stock_name
-        cols = coef_df_simple.columns.tolist()
-        cols = cols[-1:] + cols[:-1]
-        coef_df_simple = coef_df_simple[cols]
-
-        model_dw_stat = stats.stattools.durbin_watson(model.resid)
-        model_jb_stat = stats.stattools.jarque_bera(model.resid)
-        model_bp_stat = stats.diagnostic.het_breuschpagan(
-            model.resid, model.model.exog)
-        coef_df_simple['Jarque-Bera'] = [
-            str(round(model_jb_stat[0], 4)), '', '', str(round(model_jb_stat[1], 4))]
-        coef_df_simple['Breusch-Pagan'] = [
-            str(round(model_bp_stat[0], 4)), '', '', str(round(model_bp_stat[1], 4))]
-        coef_df_simple['Durbin-Watson'] = [
-            str(round(model_dw_stat, 4)), '', '', '']
-        coef_df_simple['R Squared'] = [
-            str(round(model.rsquared, 4)), '', '', '']
-
-        return(model, coef_df_simple)
+        if engine == 'statsmodels':
+            model, coef_table = statsmodels_coefficients(y, x)
+        elif engine in ('numpy', 'rolling'):
+            # a single window has nothing to roll, use the closed form
+            model, coef_table = numpy_coefficients(y, x)
+        else:
+            raise ValueError('Unsupported regression engine: {}'.format(engine))
+
+        d = regression_diagnostics.single_diagnostics(
+            np.asarray(model.resid, dtype=np.float64), x.values.astype(np.float64), mode=diagnostics)
+        result = regression_results.new_records(1, exog_names=x.columns)
+        result['ticker'] = stock_name
+        regression_results.fill_stats(result, x.columns, coef_table[:, :, None], model.rsquared, diagnostics=d)
+
+        return(model, result)
     else:
         print('Error with the data loaded (most likely insufficient data points)')
         return(False, False)
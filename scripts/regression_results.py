@@ -0,0 +1,254 @@
+import os
+import queue
+import threading
+import traceback
+import numpy as np
+import pandas as pd
+import factor_panel
+import regression_diagnostics
+import regression_engine
+
+# stock_stats columns identifying a regression
+KEY_DTYPE = [
+    ('ticker', object),
+    ('frequency', object),
+    ('bmg_factor_name', object),
+    ('from_date', 'datetime64[D]'),
+    ('thru_date', 'datetime64[D]'),
+    ('data_from_date', 'datetime64[D]'),
+    ('data_thru_date', 'datetime64[D]'),
+    ('interval', np.int32),
+]
+# columns used to replace the existing rows of a regression
+KEY_FIELDS = ['ticker', 'frequency', 'bmg_factor_name', 'from_date', 'thru_date', 'interval']
+# primary key of stock_stats and stock_stats_latest
+PRIMARY_KEY_FIELDS = ['ticker', 'frequency', 'bmg_factor_name', 'from_date', 'thru_date']
+# columns of a series of regressions, stock_stats_latest has the rows of the last thru_date of each
+SERIES_FIELDS = ['ticker', 'frequency', 'bmg_factor_name']
+COEF_SUFFIXES = ['', '_std_error', '_t_stat', '_p_gt_abs_t']
+STATS_FIELDS = regression_diagnostics.DIAGNOSTICS_FIELDS + ['r_squared']
+EXOG_NAMES = ['Constant'] + factor_panel.FACTOR_COLUMNS
+
+# number of records buffered before writing them to the DB
+BUFFER_SIZE = 1000
+# blocks of records waiting for the writer thread of the ResultSink, a worker pushing
+# more waits for the writes to catch up
+SINK_QUEUE_SIZE = 16
+# records written in one transaction by the writer thread
+SINK_BATCH_SIZE = 10 * BUFFER_SIZE
+
+_dtypes = {}
+
+
+def sql_field(name):
+    return name.lower().replace(' ', '_').replace('-', '_')
+
+
+def coef_fields(exog_names):
+    return [sql_field(name) + suffix for name in exog_names for suffix in COEF_SUFFIXES]
+
+
+def result_dtype(exog_names=EXOG_NAMES):
+    # one field per stock_stats column, the floats are NaN when not computed
+    exog_names = tuple(exog_names)
+    if exog_names not in _dtypes:
+        _dtypes[exog_names] = np.dtype(KEY_DTYPE + [(f, np.float64) for f in coef_fields(exog_names) + STATS_FIELDS])
+    return _dtypes[exog_names]
+
+
+STOCK_STATS_DTYPE = result_dtype(EXOG_NAMES)
+
+
+def new_records(n, exog_names=EXOG_NAMES):
+    records = np.zeros(n, dtype=result_dtype(exog_names))
+    for name in records.dtype.names:
+        kind = records.dtype[name].kind
+        if kind == 'f':
+            records[name] = np.nan
+        elif kind == 'M':
+            records[name] = np.datetime64('NaT')
+    return records
+
+
+def fill_stats(records, exog_names, coef_tables, rsquared, diagnostics=None):
+    # coef_tables (4, k, n) holds the coef, std err, t and P>|t| of the k regressors
+    # of the n records, diagnostics is a dict of values (or arrays of n values)
+    for i, name in enumerate(exog_names):
+        for j, suffix in enumerate(COEF_SUFFIXES):
+            records[sql_field(name) + suffix] = coef_tables[j, i]
+    # the diagnostics and R squared are stored rounded to 4 decimals
+    records['r_squared'] = np.round(rsquared, 4)
+    if diagnostics is not None:
+        for f in regression_diagnostics.DIAGNOSTICS_FIELDS:
+            records[f] = np.round(diagnostics[f], 4)
+    return records
+
+
+def fill_keys(records, ticker, frequency, factor_name, interval,
+              from_dates, thru_dates, data_from_dates, data_thru_dates):
+    # the dates can be single dates or arrays of one date per record
+    records['ticker'] = ticker
+    records['frequency'] = frequency
+    records['bmg_factor_name'] = factor_name
+    records['interval'] = interval
+    records['from_date'] = np.asarray(from_dates, dtype='datetime64[D]')
+    records['thru_date'] = np.asarray(thru_dates, dtype='datetime64[D]')
+    records['data_from_date'] = np.asarray(data_from_dates, dtype='datetime64[D]')
+    records['data_thru_date'] = np.asarray(data_thru_dates, dtype='datetime64[D]')
+    return records
+
+
+def to_rows(records, fields=None):
+    # one tuple of python values per record, NaN and NaT become None (NULL)
+    if fields is None:
+        fields = records.dtype.names
+    columns = []
+    for name in fields:
+        values = records[name]
+        column = values.astype(object)
+        if values.dtype.kind == 'f':
+            column[np.isnan(values)] = None
+        columns.append(column)
+    return list(zip(*columns))
+
+
+def summary_frame(records, i=0):
+    # coefficients table of the record i for display, one row per regression_engine.COEF_TABLE_INDEX
+    names = [f for f in records.dtype.names if f + '_std_error' in records.dtype.names]
+    record = records[i]
+    data = {'ticker': [record['ticker'], '', '', '']}
+    for name in names:
+        data[name] = [record[name + suffix] for suffix in COEF_SUFFIXES]
+    for name in regression_diagnostics.DIAGNOSTICS_FIELDS + ['r_squared']:
+        if name.endswith('_p_gt_abs_t'):
+            continue
+        p_field = name + '_p_gt_abs_t'
+        data[name] = [record[name], np.nan, np.nan, record[p_field] if p_field in records.dtype.names else np.nan]
+    return pd.DataFrame(data, index=regression_engine.COEF_TABLE_INDEX)
+
+
+class ResultBuffer:
+    """Collects regression records and writes them by blocks.
+
+    Attributes:
+        writer -- function called with a structured array of records to store
+        size -- number of records buffered before calling the writer
+        sink -- ResultSink calling the writer on its own thread, the writer is called directly when None
+    """
+
+    def __init__(self, writer, size=BUFFER_SIZE, sink=None):
+        self.writer = writer
+        self.size = size
+        self.sink = sink
+        self.blocks = []
+        self.count = 0
+
+    def append(self, records):
+        self.blocks.append(records)
+        self.count += len(records)
+        if self.count >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.count == 0:
+            return
+        records = np.concatenate(self.blocks)
+        self.blocks = []
+        self.count = 0
+        if self.sink is not None:
+            self.sink.write(self.writer, records)
+        else:
+            self.writer(records)
+
+
+class ResultSink:
+    """Writes the records on a thread of its own while the regressions go on: the blocks
+    of records queued for the same writer are written together, by up to SINK_BATCH_SIZE
+    records in one transaction. The queue is bounded, write waits while it is full.
+
+    Attributes:
+        queue -- the (writer, records) blocks and the after_writes callbacks, in order
+        error -- first exception of the writer since the last drain
+    """
+
+    def __init__(self, queue_size=SINK_QUEUE_SIZE, batch_size=SINK_BATCH_SIZE):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.error = None
+        # whether a write failed since the last after_writes callback
+        self.failed = False
+        self._thread = None
+
+    def write(self, writer, records):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self.queue.put((writer, records))
+
+    def after_writes(self, callback):
+        # callback(ok) once the records queued so far are written, ok is False when
+        # one of the writes since the previous callback failed
+        if self._thread is None:
+            callback(True)
+        else:
+            self.queue.put((callback, None))
+
+    def drain(self):
+        # wait for the queued records to be written, raises the first error of the writer
+        self.queue.join()
+        error = self.error
+        self.error = None
+        if error is not None:
+            raise error
+
+    def _run(self):
+        item = None
+        while True:
+            if item is None:
+                item = self.queue.get()
+            (func, records) = item
+            item = None
+            if records is None:
+                try:
+                    func(not self.failed)
+                except Exception as e:
+                    traceback.print_exc()
+                    if self.error is None:
+                        self.error = e
+                self.failed = False
+                self.queue.task_done()
+                continue
+            # the next blocks for the same writer and dtype go in the same batch
+            blocks = [records]
+            count = len(records)
+            while count < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] is not func or item[1] is None or item[1].dtype != records.dtype:
+                    break
+                blocks.append(item[1])
+                count += len(item[1])
+                item = None
+            try:
+                func(np.concatenate(blocks) if len(blocks) > 1 else records)
+            except Exception as e:
+                traceback.print_exc()
+                self.failed = True
+                if self.error is None:
+                    self.error = e
+            for _ in blocks:
+                self.queue.task_done()
+
+
+_sinks = {}
+
+
+def get_result_sink():
+    # the ResultSink of the process, a forked child gets its own
+    pid = os.getpid()
+    if pid not in _sinks:
+        _sinks.clear()
+        _sinks[pid] = ResultSink()
+    return _sinks[pid]
@@ -337,9 +337,27 @@ def load_data_files(cursor):
 CONFIG_FILE = 'db.ini'
 
 
+def upgrade_schema():
+    # create the tables missing from a Database initialized by an older init_schema.sql, fill
+    # stock_stats_latest from its stock_stats then create the views again on top of it
+    script_dir = os.getcwd() + '/scripts'
+    print('** upgrade schema')
+    conn = db.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(open(script_dir + '/upgrade_schema.sql', 'r').read())
+    db.rebuild_stock_stats_latest(verbose=True)
+    print('** init views')
+    cursor.execute(open(script_dir + '/init_views.sql', 'r').read())
+    conn.close()
+
+
 def main(args):
+    if args.upgrade:
+        upgrade_schema()
+        return
     if args.update_views:
-        db.refresh_views(verbose=True)
+        db.rebuild_stock_stats_latest(verbose=True)
+        db.refresh_views(verbose=True, force=True)
         return
     if args.update_data:
         conn = db.get_db_connection()
@@ -430,6 +448,7 @@ def main(args):
     script_dir = os.getcwd() + '/scripts'
     print('** init schema')
     cursor.execute(open(script_dir + "/init_schema.sql", "r").read())
+    cursor.execute(open(script_dir + "/init_views.sql", "r").read())
 
     if args.add_data:
         load_data_files(cursor)
@@ -442,8 +461,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--update_data", default=False, action='store_true',
                         help="Update the Data (run after updating the CSV files in data folder)")
+    parser.add_argument("--upgrade", default=False, action='store_true',
+                        help="Create the tables added since the DB was initialized, keeping its data (run after updating the scripts)")
     parser.add_argument("--update_views", default=False, action='store_true',
-                        help="Run a manual refresh of the DB views")
+                        help="Run a manual refresh of the DB views, stock_stats_latest is rebuilt from all the stock_stats")
     parser.add_argument("-d", "--add_data", default=False, action='store_true',
                         help="Import default Fama French factors, monthly carbon risk factors, and index composition data")
     parser.add_argument("-R", "--reuse", action='store_true', help='Reuse the current db.ini config instead of asking for the settings')
@@ -1,18 +1,24 @@
 import argparse
-import yfinance as yf
 import pandas as pd
 import json
 from pandas.tseries.offsets import MonthEnd
 
 
+def yfinance_ticker(ticker):
+    # yfinance is only imported when downloading, the scripts importing this
+    # module (eg: the regression workers) do not pay for it
+    import yfinance as yf
+    return yf.Ticker(ticker)
+
+
 def stock_details_grabber(ticker):
-    stock = yf.Ticker(ticker)
+    stock = yfinance_ticker(ticker)
     info = stock.info
     return info
 
 
 def stock_grabber(ticker, frequency='MONTHLY', period='max', start=None):
-    stock = yf.Ticker(ticker)
+    stock = yfinance_ticker(ticker)
     attempt_num = 3
     while attempt_num > 0:
         try:
@@ -0,0 +1,120 @@
+import contextlib
+import multiprocessing
+import os
+import time
+import traceback
+from multiprocessing import resource_tracker
+import db
+
+# chunks sent per process, more chunks balance the end of the run better
+CHUNKS_PER_PROCESS = 4
+# packages imported once by the forkserver process, the workers are then forked with them
+# already loaded instead of each spawned worker importing them again. The workers still run
+# the script itself (its directory is not on the path of the forkserver) but its imports
+# of these packages are then already done
+FORKSERVER_PRELOAD = ['numpy', 'pandas', 'scipy.stats', 'scipy.linalg', 'psycopg2', 'psycopg2.extras', 'psycopg2.pool']
+
+
+def set_start_method():
+    # forkserver where available, spawn otherwise (eg: Windows), the
+    # MP_START_METHOD environment variable can force one (eg: spawn)
+    method = os.environ.get('MP_START_METHOD')
+    if not method:
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    multiprocessing.set_start_method(method)
+    if method == 'forkserver':
+        multiprocessing.set_forkserver_preload(FORKSERVER_PRELOAD)
+
+
+def history_costs(tickers, lengths):
+    # cost of the task of each ticker from its number of stock_data rows, the tickers
+    # without data yet (eg: a first import) are counted as the longest ones
+    default = max(lengths.values(), default=1)
+    return [lengths.get(ticker, default) for ticker in tickers]
+
+
+def plan_chunks(tasks, costs, processes):
+    # tasks sorted by decreasing cost and grouped into chunks of about the same cost:
+    # a long task makes its own chunk while the short ones are sent together
+    order = sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True)
+    target = sum(costs) / max(1, processes * CHUNKS_PER_PROCESS)
+    chunks = []
+    chunk = []
+    chunk_cost = 0
+    for i in order:
+        chunk.append(tasks[i])
+        chunk_cost += costs[i]
+        if chunk_cost >= target:
+            chunks.append(chunk)
+            chunk = []
+            chunk_cost = 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def new_pool(processes, total_processes=None):
+    # pool of processes with their share of the DB connections, split between total_processes
+    # when other pools run at the same time. The resource tracker is started first so the workers
+    # use it: a worker attaching a shared factor panel would otherwise start its own tracker,
+    # which unlinks the panel when the worker exits
+    resource_tracker.ensure_running()
+    return multiprocessing.Pool(processes=processes, initializer=db.init_worker_pool,
+                                initargs=(total_processes or processes,))
+
+
+@contextlib.contextmanager
+def process_pool(processes, pool=None):
+    # the given pool of a long running process (kept open), or a new pool, closed after the run
+    if pool is not None:
+        yield pool
+        return
+    with new_pool(processes) as pool:
+        yield pool
+
+
+def run_chunk(job):
+    # worker side: run func(*task) for each task of the chunk,
+    # returns (pid, busy seconds, number of tasks, number of failed tasks)
+    (func, chunk) = job
+    start = time.perf_counter()
+    failed = 0
+    for task in chunk:
+        try:
+            func(*task)
+        except Exception:
+            # like Pool.starmap the other tasks still run, the failure is reported at the end
+            traceback.print_exc()
+            failed += 1
+    return (os.getpid(), time.perf_counter() - start, len(chunk), failed)
+
+
+def run_longest_first(pool, func, tasks, costs, processes):
+    # run func(*task) for all the tasks on the pool, the most costly first,
+    # then print how busy each worker process was during the run
+    start = time.perf_counter()
+    chunks = plan_chunks(tasks, costs, processes)
+    busy = {}
+    counts = {}
+    failed = 0
+    for (pid, seconds, n, n_failed) in pool.imap_unordered(run_chunk, [(func, chunk) for chunk in chunks]):
+        busy[pid] = busy.get(pid, 0) + seconds
+        counts[pid] = counts.get(pid, 0) + n
+        failed += n_failed
+    wall = time.perf_counter() - start
+    print_utilization(busy, counts, wall, processes, len(chunks))
+    if failed:
+        print('!! {} of {} tasks failed'.format(failed, len(tasks)))
+    return failed
+
+
+def print_utilization(busy, counts, wall, processes, n_chunks):
+    print('*** Ran {} tasks in {} chunks over {} processes in {:.1f}s'.format(
+        sum(counts.values()), n_chunks, processes, wall))
+    for pid in sorted(busy, key=busy.get, reverse=True):
+        print('  worker {}: {} tasks, busy {:.1f}s ({:.0%})'.format(
+            pid, counts[pid], busy[pid], busy[pid] / wall if wall else 0))
+    if len(busy) < processes:
+        print('  {} workers got no task'.format(processes - len(busy)))
+    if wall:
+        print('*** Overall utilization {:.0%}'.format(sum(busy.values()) / (wall * processes)))
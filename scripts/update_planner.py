@@ -0,0 +1,85 @@
+import datetime
+import db
+import window_planner
+
+connPool = db.get_db_connection_pool()
+
+
+def load_stock_watermarks(tickers, frequency='MONTHLY'):
+    # {ticker: last stock_data date} of the given tickers in one query, the tickers without data are left out
+    sql = '''SELECT ticker, max(date)
+        FROM stock_data
+        WHERE frequency = %s and ticker = ANY(%s)
+        GROUP BY ticker
+        '''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (frequency, list(tickers)))
+            res = dict(cursor.fetchall())
+    return res
+
+
+def load_regression_watermarks(tickers, factor_names, intervals, frequency='MONTHLY', table='stock_stats'):
+    # {(ticker, factor_name, interval): from_date of the last regression window} in one query,
+    # the same dates get_regressions.get_last_regression_start looks up for one ticker
+    sql = '''SELECT ticker, bmg_factor_name, interval, max(from_date)
+        FROM ''' + table + '''
+        WHERE frequency = %s
+        AND ticker = ANY(%s)
+        AND bmg_factor_name = ANY(%s)
+        AND interval = ANY(%s)
+        GROUP BY ticker, bmg_factor_name, interval
+        '''
+    with connPool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(sql, (frequency, list(tickers), list(factor_names), list(intervals)))
+            res = {(t, f, i): d for (t, f, i, d) in cursor.fetchall()}
+    return res
+
+
+def plan_stock_updates(tickers, frequency='MONTHLY', today=None):
+    # ([tickers to update], {ticker: last stock_data date}) for get_stocks.py -u, the
+    # tickers whose data already ends today are left out
+    if today is None:
+        today = datetime.date.today()
+    last_dates = load_stock_watermarks(tickers, frequency=frequency)
+    pending = [t for t in tickers if last_dates.get(t) != today]
+    print('*** update: {} of {} tickers already up to date'.format(len(tickers) - len(pending), len(tickers)))
+    return (pending, last_dates)
+
+
+def plan_regression_updates(tickers, panels, intervals, frequency='MONTHLY', start_date=None, end_date=None,
+                            table='stock_stats', last_dates=None):
+    """Start date of the regressions of each ticker for get_regressions.py -u, from the
+    stock_data and stock_stats watermarks of all the tickers loaded in two queries.
+
+    A (ticker, factor, interval) is up to date when no window past its last one ends
+    by the end date: end_date, or the end of the stock data and of the factor panel.
+    last_dates are the last stock_data dates, loaded when None, the tickers without
+    one (no stock data yet, or still being imported) are not up to date.
+
+    Returns {ticker: {(factor_name, interval): start date}} of the tickers having
+    regressions to run, the start date is start_date for the ones not run yet.
+    """
+    if last_dates is None:
+        last_dates = load_stock_watermarks(tickers, frequency=frequency)
+    last_starts = load_regression_watermarks(tickers, list(panels), intervals, frequency=frequency, table=table)
+    if end_date:
+        end_date = window_planner.period_end_date(end_date, frequency)
+    plan = {}
+    current = 0
+    for ticker in tickers:
+        starts = {}
+        for (factor_name, panel) in panels.items():
+            for interval in intervals:
+                last_start = last_starts.get((ticker, factor_name, interval))
+                end = end_date or (last_dates.get(ticker) and min(last_dates[ticker], panel.series_end))
+                if last_start is not None and end and not len(window_planner.plan_windows(last_start, end, interval, frequency)):
+                    current += 1
+                    continue
+                starts[(factor_name, interval)] = last_start or start_date
+        if starts:
+            plan[ticker] = starts
+    print('*** update: {} of {} regressions already up to date, {} of {} tickers to run'.format(
+        current, len(tickers) * len(panels) * len(intervals), len(plan), len(tickers)))
+    return plan
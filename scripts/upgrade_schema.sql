@@ -0,0 +1,55 @@
+-- brings a Database created by an older init_schema.sql up to date without dropping any data,
+-- run by: python scripts/setup_db.py -R --upgrade, which then fills stock_stats_latest and
+-- creates the views of init_views.sql again
+
+CREATE TABLE IF NOT EXISTS stock_model_stats (
+    ticker text,
+    frequency text,
+    bmg_factor_name text,
+    model_name text,
+    from_date date,
+    thru_date date,
+    data_from_date date,
+    data_thru_date date,
+    interval integer,
+    factor text,
+    coef decimal(12, 5),
+    std_error decimal(12, 5),
+    t_stat decimal(12, 5),
+    p_gt_abs_t decimal(12, 5),
+    nobs integer,
+    r_squared decimal(12, 5),
+    f_stat decimal(12, 5),
+    f_p_gt_f decimal(12, 5),
+    PRIMARY KEY (ticker, frequency, bmg_factor_name, model_name, from_date, thru_date, interval, factor)
+);
+
+CREATE INDEX IF NOT EXISTS model_series_names ON stock_model_stats (ticker, bmg_factor_name, interval, model_name);
+
+CREATE TABLE IF NOT EXISTS job_ledger (
+    job_name text,
+    ticker text,
+    bmg_factor_name text,
+    frequency text,
+    interval integer,
+    status text,
+    started_at timestamp,
+    finished_at timestamp,
+    worker text,
+    heartbeat_at timestamp,
+    PRIMARY KEY (job_name, frequency, ticker, bmg_factor_name, interval)
+);
+
+CREATE INDEX IF NOT EXISTS job_ledger_status ON job_ledger (job_name, frequency, status);
+
+CREATE TABLE IF NOT EXISTS stock_stats_latest (
+    LIKE stock_stats,
+    PRIMARY KEY (ticker, frequency, bmg_factor_name, from_date, thru_date)
+);
+
+CREATE TABLE IF NOT EXISTS view_refresh (
+    stale boolean,
+    refreshed_at timestamp
+);
+
+INSERT INTO view_refresh (stale) SELECT true WHERE NOT EXISTS (SELECT 1 FROM view_refresh);
@@ -0,0 +1,122 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+# default regression interval, in months for MONTHLY and days for DAILY
+DEFAULT_INTERVALS = {
+    'MONTHLY': 60,
+    'DAILY': 730,
+}
+
+
+def get_interval(frequency, interval):
+    if frequency not in DEFAULT_INTERVALS:
+        raise Exception("Unsupported frequency: {}".format(frequency))
+    if interval == 0:
+        interval = DEFAULT_INTERVALS[frequency]
+    return interval
+
+
+def get_intervals(frequency, interval):
+    # interval can be a single interval or a list of them (eg: from parse_intervals)
+    if not isinstance(interval, (list, tuple)):
+        interval = [interval]
+    intervals = []
+    for i in interval:
+        i = get_interval(frequency, i)
+        if i not in intervals:
+            intervals.append(i)
+    return intervals
+
+
+def parse_intervals(value):
+    # argparse type for a comma separated list of intervals, eg: 730,365,180,90
+    try:
+        return [int(i) for i in value.split(',') if i.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Interval must be a number or a comma separated list of numbers, got {}'.format(value))
+
+
+def to_day(value):
+    if type(value) == str:
+        value = pd.Timestamp(value)
+    return np.datetime64(value, 'D')
+
+
+def month_end(months):
+    # last day of the datetime64[M] months
+    return (months + 1).astype('datetime64[D]') - 1
+
+
+def period_end(day, frequency):
+    # last day of the period containing day: the month end for MONTHLY, the day itself for DAILY
+    if frequency == 'MONTHLY':
+        return month_end(day.astype('datetime64[M]'))
+    return day
+
+
+def period_end_date(value, frequency):
+    return period_end(to_day(value), frequency).item()
+
+
+class WindowPlan:
+    """All the regression windows of a ticker.
+
+    Window w covers from_dates[w] to thru_dates[w] inclusive, both datetime64[D].
+    Once bound to a date index, window w is the rows lo[w]:hi[w] of that index.
+
+    Attributes:
+        from_dates -- first day of each window
+        thru_dates -- last day of each window
+        next_from_date -- first day of the window after the last one
+        next_thru_date -- last day of the window after the last one (past the end date)
+        lo -- first row of each window in the bound date index
+        hi -- row after the last row of each window in the bound date index
+    """
+
+    def __init__(self, from_dates, thru_dates, next_from_date, next_thru_date):
+        self.from_dates = from_dates
+        self.thru_dates = thru_dates
+        self.next_from_date = next_from_date.item()
+        self.next_thru_date = next_thru_date.item()
+        self.lo = None
+        self.hi = None
+
+    def __len__(self):
+        return len(self.from_dates)
+
+    def bind(self, dates):
+        # row offsets of every window in a sorted datetime64 date index
+        self.lo = np.searchsorted(dates, self.from_dates.astype(dates.dtype), side='left')
+        self.hi = np.searchsorted(dates, self.thru_dates.astype(dates.dtype), side='right')
+        return self
+
+    def window_dates(self, w):
+        return (self.from_dates[w].item(), self.thru_dates[w].item())
+
+    def windows(self):
+        # list of (from_date, thru_date) as datetime.date
+        return list(zip(self.from_dates.tolist(), self.thru_dates.tolist()))
+
+
+def plan_windows(start_date, end_date, interval, frequency):
+    # Same windows as stepping with relativedelta from the end of the period of
+    # start_date: window k covers the day after the end of period k to the end
+    # of period k + interval, keeping the windows ending on or before end_date.
+    interval = get_interval(frequency, interval)
+    start = period_end(to_day(start_date), frequency)
+    end = to_day(end_date)
+    if frequency == 'MONTHLY':
+        first = start.astype('datetime64[M]')
+        # last month ending on or before end_date
+        last = (end + 1).astype('datetime64[M]') - 1
+        n = max(0, int((last - first).astype(int)) - interval + 1)
+        months = first + np.arange(n + 1)
+        from_dates = month_end(months) + 1
+        thru_dates = month_end(months + interval)
+    else:
+        n = max(0, int((end - start).astype(int)) - interval + 1)
+        days = start + np.arange(n + 1)
+        from_dates = days + 1
+        thru_dates = days + interval
+    return WindowPlan(from_dates[:n], thru_dates[:n], from_dates[n], thru_dates[n])
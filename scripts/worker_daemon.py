@@ -0,0 +1,349 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import traceback
+import bmg_series
+import get_regressions
+import get_stocks
+import task_scheduler
+
+# Unix socket the daemon listens on and the client sends the jobs to
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'open_climate_worker.sock')
+# job priorities, the lowest first: interactive jobs (eg: a single ticker) run right away
+# on their own thread, the batch jobs run one at a time on the worker pool in priority order
+INTERACTIVE = 0
+BATCH = 10
+# first character of the last line sent to the client, with the status of its job
+STATUS_MARK = '\x00'
+
+SCRIPTS = {
+    'get_stocks': get_stocks,
+    'get_regressions': get_regressions,
+    'bmg_series': bmg_series,
+}
+# commands of the daemon itself
+COMMANDS = ['reload', 'stop']
+
+
+class PanelCache:
+    """Factor panels kept loaded between the jobs of the daemon, used by
+    get_regressions.load_factor_panels and share_factor_panels.
+
+    Attributes:
+        panels -- {(factor_name, frequency): FactorPanel}
+        rates -- {frequency: (ff_data, rf_data)} the FF and Rf series the panels were built from
+        shared -- {(factor_name, frequency): (shared memory block, descriptor)} of the panels published to the workers
+    """
+
+    def __init__(self):
+        self.panels = {}
+        self.rates = {}
+        self.shared = {}
+        self.lock = threading.Lock()
+
+    def load(self, factor_names, frequency='MONTHLY', verbose=False):
+        # {factor_name: panel}, only the panels not in the cache are loaded
+        panels = {}
+        with self.lock:
+            for factor_name in factor_names:
+                key = (factor_name, frequency)
+                if key not in self.panels:
+                    if frequency not in self.rates:
+                        self.rates[frequency] = (get_regressions.load_ff_data_from_db(frequency=frequency),
+                                                 get_regressions.load_rf_data_from_db(frequency=frequency))
+                    (ff_data, rf_data) = self.rates[frequency]
+                    panel = get_regressions.load_factor_panel(factor_name, frequency=frequency, ff_data=ff_data,
+                                                              rf_data=rf_data, verbose=verbose)
+                    if panel is None:
+                        print("No carbon data found for factor {} and frequency {}".format(factor_name, frequency))
+                        continue
+                    self.panels[key] = panel
+                panels[factor_name] = self.panels[key]
+        return panels
+
+    def share(self, panel):
+        # descriptor of a cached panel published in shared memory on first use, None for another panel
+        key = (panel.factor_name, panel.frequency)
+        with self.lock:
+            if self.panels.get(key) is not panel:
+                return None
+            if key not in self.shared:
+                self.shared[key] = panel.share()
+            return self.shared[key][1]
+
+    def clear(self, factor_name=None):
+        # drop the panels of the factor, or all of them with the FF and Rf series,
+        # they are loaded again by the next job using them
+        with self.lock:
+            for key in [key for key in self.panels if factor_name in (None, key[0])]:
+                del self.panels[key]
+                if key in self.shared:
+                    (shm, _) = self.shared.pop(key)
+                    shm.close()
+                    shm.unlink()
+            if factor_name is None:
+                self.rates = {}
+
+
+class ThreadOutput:
+    """Replaces sys.stdout (or sys.stderr) so the output of each job goes to its client.
+
+    Attributes:
+        default -- where the output of the threads not running a job goes
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    @property
+    def stream(self):
+        return getattr(self.local, 'stream', None) or self.default
+
+    def write(self, text):
+        try:
+            return self.stream.write(text)
+        except OSError:
+            # the client went away, the job still runs to the end
+            return len(text)
+
+    def flush(self):
+        try:
+            self.stream.flush()
+        except OSError:
+            pass
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        previous = getattr(self.local, 'stream', None)
+        self.local.stream = stream
+        try:
+            yield
+        finally:
+            self.local.stream = previous
+
+
+class Job:
+    """A command sent by a client.
+
+    Attributes:
+        command -- script name (see SCRIPTS) or daemon command (see COMMANDS)
+        args -- parsed args of the script
+        priority -- INTERACTIVE or lower runs right away, the others are queued
+        output -- text stream to the client
+        done -- set when the job is over
+        ok -- whether the job succeeded
+    """
+
+    def __init__(self, command, args, priority, output):
+        self.command = command
+        self.args = args
+        self.priority = priority
+        self.output = output
+        self.done = threading.Event()
+        self.ok = False
+
+
+class WorkerDaemon:
+    """Keeps the imports, DB connections, factor panels and worker processes
+    of the scripts loaded between the jobs sent by the clients.
+
+    Attributes:
+        concurrency -- number of worker processes, the -c of the jobs
+        pool -- the worker processes, None when concurrency is 1
+        panels -- PanelCache of the factor panels
+        jobs -- queue of the batch jobs by (priority, arrival)
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.pool = None
+        if concurrency > 1:
+            self.pool = task_scheduler.new_pool(concurrency)
+        self.panels = PanelCache()
+        get_regressions.panel_cache = self.panels
+        self.jobs = queue.PriorityQueue()
+        self.arrivals = itertools.count()
+        self.server = None
+        threading.Thread(target=self.run_batch_jobs, daemon=True).start()
+
+    def parse(self, request, output):
+        # Job of a client request, None when its args are invalid (the usage goes to the client)
+        command = request.get('command')
+        if command in COMMANDS:
+            return Job(command, None, BATCH if command == 'reload' else INTERACTIVE, output)
+        if command not in SCRIPTS:
+            print('!! Unknown command {}, expected one of {}'.format(command, ', '.join(list(SCRIPTS) + COMMANDS)))
+            return None
+        try:
+            parser = SCRIPTS[command].get_parser()
+            parser.prog = '{}.py'.format(command)
+            args = parser.parse_args(request.get('args', []))
+        except SystemExit:
+            return None
+        priority = request.get('priority')
+        if priority is None:
+            # a single ticker (or showing a series) is interactive
+            priority = INTERACTIVE if getattr(args, 'ticker', None) or getattr(args, 'show', None) else BATCH
+        return Job(command, args, priority, output)
+
+    def submit(self, job):
+        # run the job, or queue it behind the running batch job, then wait for it
+        if job.priority <= INTERACTIVE:
+            self.run_job(job, None)
+        else:
+            self.jobs.put((job.priority, next(self.arrivals), job))
+            print('*** queued behind {} batch jobs'.format(self.jobs.qsize() - 1))
+        job.done.wait()
+        return job.ok
+
+    def run_batch_jobs(self):
+        while True:
+            (_, _, job) = self.jobs.get()
+            try:
+                self.run_job(job, self.pool)
+            except BaseException:
+                # the next batch jobs still run
+                traceback.print_exc()
+
+    def run_job(self, job, pool):
+        # the client always gets the status of its job, even when the job exits (eg: the
+        # SystemExit of db.get_db_connection when the DB is unreachable)
+        try:
+            with sys.stdout.redirect(job.output), sys.stderr.redirect(job.output):
+                try:
+                    job.ok = self.run_command(job, pool)
+                except BaseException:
+                    traceback.print_exc()
+                    job.ok = False
+        finally:
+            job.done.set()
+
+    def run_command(self, job, pool):
+        args = job.args
+        if job.command == 'reload':
+            # eg: after update_ff_data.sh changed the FF and Rf series
+            self.panels.clear()
+            print('*** factor panels dropped, they are loaded again by the next jobs')
+            return True
+        if job.command == 'stop':
+            print('*** stopping the daemon')
+            threading.Thread(target=self.server.shutdown).start()
+            return True
+        if job.command == 'bmg_series':
+            ok = bmg_series.main(args)
+            if args.factor_name and (args.delete or args.green_ticker or args.brown_ticker):
+                self.panels.clear(args.factor_name)
+            return bool(ok)
+        if pool is not None and args.concurrency > 1:
+            # the jobs run on the processes of the daemon
+            args.concurrency = self.concurrency
+        else:
+            pool = None
+        if job.command == 'get_stocks':
+            return bool(get_stocks.main(args, pool=pool))
+        get_regressions.main(args, pool=pool)
+        return True
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.panels.clear()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """One client connection: a JSON request line, then the output of the job
+    and a last line with its status."""
+
+    def handle(self):
+        daemon = self.server.worker_daemon
+        output = io.TextIOWrapper(self.wfile, encoding='utf-8', line_buffering=True, write_through=True)
+        request = json.loads(self.rfile.readline())
+        with sys.stdout.redirect(output), sys.stderr.redirect(output):
+            job = daemon.parse(request, output)
+            if job is not None and request.get('cwd') not in (None, os.getcwd()):
+                print('!! the paths of the job are relative to the daemon directory {}'.format(os.getcwd()))
+            ok = job is not None and daemon.submit(job)
+            print('{}{}'.format(STATUS_MARK, 'ok' if ok else 'failed'))
+        output.detach()
+
+
+def serve(socket_path, concurrency):
+    sys.stdout = ThreadOutput(sys.stdout)
+    sys.stderr = ThreadOutput(sys.stderr)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    daemon = WorkerDaemon(concurrency)
+    try:
+        with socketserver.ThreadingUnixStreamServer(socket_path, JobHandler) as server:
+            server.daemon_threads = True
+            server.worker_daemon = daemon
+            daemon.server = server
+            print('*** listening on {} with {} worker processes'.format(socket_path, concurrency))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    finally:
+        daemon.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+    return True
+
+
+def submit(socket_path, command, args, priority=None):
+    # send a job to the daemon and print its output, returns whether it succeeded
+    request = {'command': command, 'args': args, 'priority': priority, 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith(STATUS_MARK):
+                    return line[1:].strip() == 'ok'
+                sys.stdout.write(line)
+    print('!! the daemon closed the connection before the end of the job')
+    return False
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="Run the get_stocks, get_regressions and bmg_series jobs on a daemon keeping the factor data, "
+                    "DB connections and worker processes loaded, eg: start the daemon with --serve -c 16 then "
+                    "send it jobs with: %(prog)s get_regressions -t AAPL")
+    parser.add_argument("--serve", action='store_true',
+                        help="Start the daemon")
+    parser.add_argument("-c", "--concurrency", default=1, type=int,
+                        help="With --serve, number of worker processes kept for the jobs run with -c")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                        help="Unix socket of the daemon")
+    parser.add_argument("--priority", type=int,
+                        help="Priority of the job, the lowest first, defaults to {} for a single ticker (-t) or showing (-s / -o) which then run right away, or {} for the batch jobs run one at a time".format(INTERACTIVE, BATCH))
+    parser.add_argument("command", nargs='?', choices=list(SCRIPTS) + COMMANDS,
+                        help="Script to run with its args, or reload (drop the factor data, eg: after update_ff_data.sh) or stop the daemon")
+    parser.add_argument("args", nargs=argparse.REMAINDER,
+                        help="args of the script")
+    return parser
+
+
+# run
+if __name__ == "__main__":
+    task_scheduler.set_start_method()
+    parser = get_parser()
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.socket, args.concurrency)
+    elif args.command:
+        sys.exit(0 if submit(args.socket, args.command, args.args, priority=args.priority) else 1)
+    else:
+        parser.print_help()